@@ -1,3 +1,3 @@
 from . import mounts, runners
-from .jaynes import Jaynes, config, add, chain, execute, run, listen, RUN
+from .jaynes import Jaynes, Session, config, add, chain, execute, run, listen, RUN
 from .helpers import tag_instance
@@ -0,0 +1,153 @@
+"""
+Caches for cloud lookups and API clients.
+
+:class:`DiskCache` keeps lookups that rarely change, such as the image of an image family or the discovery
+documents of the google api client, on disk with a TTL, so that new processes do not repeat them. Entries
+are pickled one per file, and the least recently written are evicted past `max_entries`.
+
+:func:`client` keeps one API client per process, shared by all launchers.
+"""
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from .helpers import get_home_dir
+
+CACHE_DIR = os.path.join(get_home_dir(), ".cache", "jaynes")
+
+
+class DiskCache:
+    """A persistent key-value cache with a TTL.
+
+    :param name: the sub-directory of `cache_dir` for this cache.
+    :param ttl: seconds an entry stays valid.
+    :param max_entries: the least recently written entries are evicted past this number.
+    :param cache_dir: the root directory of the caches. Default ~/.cache/jaynes
+    """
+
+    def __init__(self, name, ttl=3600, max_entries=256, cache_dir=CACHE_DIR):
+        self.path = os.path.join(cache_dir, name)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + ".pkl")
+
+    def get(self, key, default=None):
+        try:
+            with open(self._file(key), "rb") as f:
+                _key, expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return default
+        if _key != key or expires < time.time():
+            return default
+        return value
+
+    def set(self, key, value):
+        os.makedirs(self.path, exist_ok=True)
+        path = self._file(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((key, time.time() + self.ttl, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """removes the expired entries, and the least recently written ones past `max_entries`."""
+        with self.lock:
+            entries = []
+            try:
+                for entry in os.scandir(self.path):
+                    if entry.name.endswith(".pkl"):
+                        entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                # other processes evict from the same directory.
+                pass
+            entries.sort(reverse=True)
+            now = time.time()
+            for i, (mtime, path) in enumerate(entries):
+                if i >= self.max_entries or mtime + self.ttl < now:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def __call__(self, fn):
+        """use as a decorator, to cache the results of `fn` by its arguments."""
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (fn.__qualname__, args, sorted(kwargs.items()))
+            value = self.get(key, _missing)
+            if value is _missing:
+                value = fn(*args, **kwargs)
+                self.set(key, value)
+            return value
+
+        wrapper.cache = self
+        return wrapper
+
+
+_missing = object()
+
+
+class DiscoveryCache:
+    """Adapts a :class:`DiskCache` to the `cache` argument of `googleapiclient.discovery.build`. Only used by
+    versions of the client that fetch the discovery documents instead of shipping them."""
+
+    def __init__(self, ttl=24 * 3600):
+        self.cache = DiskCache("discovery", ttl=ttl, max_entries=64)
+
+    def get(self, url):
+        return self.cache.get(url)
+
+    def set(self, url, content):
+        self.cache.set(url, content)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_local = threading.local()
+
+
+def client(key, factory, thread_local=False):
+    """
+    the process-wide API client for `key`, created by `factory` on first use.
+
+    :param thread_local: keep one client per thread instead, for clients that are not thread-safe.
+    """
+    if thread_local:
+        clients = _local.__dict__.setdefault("clients", {})
+        if key not in clients:
+            clients[key] = factory()
+        return clients[key]
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def boto3_client(service, region=None):
+    """boto3 clients are thread-safe, so all threads share one per service and region."""
+    import boto3
+    return client(("boto3", service, region), lambda: boto3.client(service, region_name=region))
+
+
+def google_client(service, version):
+    """google api clients go through httplib2, which is not thread-safe, so each thread gets its own."""
+
+    def build():
+        import googleapiclient.discovery
+        return googleapiclient.discovery.build(service, version, cache=DiscoveryCache())
+
+    return client(("google", service, version), build, thread_local=True)
@@ -1,11 +1,19 @@
+import hashlib
+import os
+import time
+
 import requests
 import json
 from urllib.parse import urlencode, quote
 
+from .helpers import hash_file
+
 
 class JaynesClient:
     def __init__(self, server="http://localhost:8092", token=None):
         self.server = server
+        # reuses the connection across chunks and calls.
+        self.session = requests.Session()
 
     def post(self, path, data, **kwargs):
         if kwargs:
@@ -34,14 +42,61 @@ class JaynesClient:
     def gzip_local(self, dir, target):
         pass
 
-    def upload_file(self, file, remote_path=None):
-        """used to upload files that have been changed"""
+    def stat(self, remote_path):
+        """resume query for `remote_path`.
+
+        :return: dict(offset=<bytes of the partial upload on the server>, sha256=<hash of the completed file or None>)
+        """
+        r = self.session.head(self.server + "/files/" + quote(remote_path))
+        r.raise_for_status()
+        return dict(offset=int(r.headers.get("X-Jaynes-Offset", 0)), sha256=r.headers.get("X-Jaynes-Sha256"))
+
+    def upload_file(self, file, remote_path=None, chunk_size=8 << 20, retries=5, verbose=False):
+        """streams `file` to the server in chunks, resuming from what the server already has.
+
+        Each chunk is sent with its own sha256, and the server only moves the file into place when the
+        sha256 of the whole file matches. Skips the upload when the server already has the same file.
+
+        :return: the sha256 of the file
+        """
         if remote_path is None:
             remote_path = file
-        with open(file, 'rb') as f:
-            text = f.read()
-        r = self.put("/files/" + quote(remote_path), data=text)
-        return r
+        url = self.server + "/files/" + quote(remote_path)
+        sha256 = hash_file(file).hexdigest()
+        size = os.path.getsize(file)
+
+        attempt = 0
+        while True:
+            try:
+                status = self.stat(remote_path)
+                if status['sha256'] == sha256:
+                    return sha256
+                offset = status['offset'] if status['offset'] <= size else 0
+
+                with open(file, 'rb') as f:
+                    f.seek(offset)
+                    while True:
+                        chunk = f.read(chunk_size)
+                        params = dict(offset=offset, chunk_sha256=hashlib.sha256(chunk).hexdigest())
+                        if offset + len(chunk) >= size:
+                            params['sha256'] = sha256
+                        r = self.session.put(url, params=params, data=chunk)
+                        if r.status_code == 409:  # the server has a different offset, resume from there.
+                            offset = r.json()['offset']
+                            f.seek(offset)
+                            continue
+                        r.raise_for_status()
+                        offset += len(chunk)
+                        if verbose:
+                            print(f"uploaded {offset}/{size} bytes of {file}")
+                        if 'sha256' in params:
+                            return sha256
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                attempt += 1
+                if attempt > retries:
+                    raise e
+                print(f"upload of {file} interrupted: {e}. Resuming, attempt {attempt}/{retries}")
+                time.sleep(min(2 ** attempt, 30))
 
     def update_file(self, file, remote_path=None, overwrite=True):
         """used to upload files that have been changed"""
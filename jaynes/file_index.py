@@ -0,0 +1,301 @@
+"""
+File selection for code mounts.
+
+Walks a project directory honoring `.gitignore` files, `exclude_from` files and the tar-style
+`excludes` string the mounts already accept, and keeps an on-disk (mtime, size, hash) index
+so re-scanning a large project only costs a round of `stat` calls.
+
+All tar-based mounts share the same :class:`FileIndex` instance per project root. Mounts are uploaded
+from a thread pool, so access to an index goes through its lock.
+"""
+import hashlib
+import os
+import pickle
+import re
+import shlex
+import threading
+
+from .helpers import get_home_dir, hash_file
+
+# mirrors `tar --exclude-vcs`
+VCS_PATTERNS = (".git", ".gitignore", ".gitattributes", ".gitmodules",
+                ".hg", ".hgignore", ".hgtags", ".svn", ".bzr", ".bzrignore", ".bzrtags",
+                "CVS", ".cvsignore", "_darcs", ".arch-ids", "{arch}", "RCS", "SCCS")
+
+INDEX_DIR = os.path.join(get_home_dir(), ".cache", "jaynes", "index")
+
+
+def parse_tar_excludes(excludes):
+    """"--exclude='*.pkl' --exclude='*.git'" -> ["*.pkl", "*.git"]"""
+    return [token[len("--exclude="):] for token in shlex.split(excludes or "") if token.startswith("--exclude=")]
+
+
+def _translate(pattern):
+    """translate a single gitignore glob into a regular expression source string."""
+    i, n, out = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern[i:i + 3] == "**/":
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern[i:i + 2] == "**":
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 2)
+            if j == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class IgnoreRules:
+    """An ordered list of gitignore patterns, relative to the directory `base`.
+
+    :param patterns: lines of a `.gitignore` file.
+    :param base: the directory the patterns are relative to, as a path relative to the walk root.
+                 Use "" for the root.
+    """
+
+    def __init__(self, patterns, base=""):
+        self.base = base
+        self.rules = []
+        for line in patterns:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if not line.endswith("\\ "):
+                line = line.rstrip()
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\!") or line.startswith("\\#"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            if "/" in line:
+                # patterns with an inner or leading slash are anchored to `base`.
+                regex = _translate(line.lstrip("/"))
+            else:
+                regex = "(?:.*/)?" + _translate(line)
+            self.rules.append((re.compile(regex + r"\Z", re.DOTALL), negate, dir_only))
+
+    @classmethod
+    def from_file(cls, path, base=""):
+        with open(path, "r", errors="replace") as f:
+            return cls(f.readlines(), base=base)
+
+    @classmethod
+    def from_tar_excludes(cls, excludes):
+        """parse a tar flag string such as "--exclude='*.pkl' --exclude='*.git'" into rules."""
+        return cls(parse_tar_excludes(excludes))
+
+    def match(self, rel_path, is_dir):
+        """returns True if ignored, False if re-included by a negation and None if no rule applies."""
+        if self.base:
+            if not rel_path.startswith(self.base + "/"):
+                return None
+            rel_path = rel_path[len(self.base) + 1:]
+        result = None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                result = not negate
+        return result
+
+    def __bool__(self):
+        return bool(self.rules)
+
+
+def is_ignored(rule_sets, rel_path, is_dir):
+    ignored = False
+    for rules in rule_sets:
+        result = rules.match(rel_path, is_dir)
+        if result is not None:
+            ignored = result
+    return ignored
+
+
+class FileIndex:
+    """A persistent (mtime, size, hash) index of the files under `root`.
+
+    Content hashes are computed lazily, and only re-computed for files whose mtime or size changed.
+
+    :param root: absolute path to the project directory.
+    :param index_dir: where the index is pickled. Set to None to keep the index in memory only.
+    """
+
+    def __init__(self, root, index_dir=INDEX_DIR):
+        self.root = os.path.realpath(root)
+        self.entries = {}
+        self.index_path = None
+        self.lock = threading.RLock()
+        if index_dir:
+            key = hashlib.sha1(self.root.encode()).hexdigest()[:16]
+            self.index_path = os.path.join(index_dir, f"{key}.pkl")
+            try:
+                with open(self.index_path, "rb") as f:
+                    self.entries = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                self.entries = {}
+
+    def scan(self, rule_sets=(), use_gitignore=True, sub_paths=(".",)):
+        """walk the tree and refresh the index. Returns the sorted list of selected relative paths.
+
+        :param rule_sets: additional :class:`IgnoreRules` applied from the root.
+        :param use_gitignore: whether `.gitignore` files found during the walk are honored.
+        :param sub_paths: limit the walk to these paths relative to the root (the tar `file_mask`).
+        """
+        selected = []
+        for sub in sub_paths:
+            sub = os.path.normpath(sub)
+            start = "" if sub == "." else sub
+            start_abs = os.path.join(self.root, start)
+            if os.path.isdir(start_abs):
+                self._walk(start, list(rule_sets), use_gitignore, selected)
+            elif os.path.isfile(start_abs) and not is_ignored(rule_sets, start, False):
+                self._stat(start, os.stat(start_abs))
+                selected.append(start)
+
+        # the index is shared by the mounts of the root, whose selections differ. Only drop deleted files.
+        for rel in [rel for rel in self.entries if not os.path.lexists(os.path.join(self.root, rel))]:
+            del self.entries[rel]
+        return sorted(set(selected))
+
+    def _walk(self, rel_dir, rule_sets, use_gitignore, selected):
+        abs_dir = os.path.join(self.root, rel_dir)
+        if use_gitignore:
+            gitignore = os.path.join(abs_dir, ".gitignore")
+            if os.path.isfile(gitignore):
+                rule_sets = rule_sets + [IgnoreRules.from_file(gitignore, base=rel_dir)]
+        try:
+            entries = list(os.scandir(abs_dir))
+        except OSError:
+            return
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if is_ignored(rule_sets, rel, is_dir):
+                continue
+            if is_dir:
+                self._walk(rel, rule_sets, use_gitignore, selected)
+            else:
+                self._stat(rel, entry.stat(follow_symlinks=False))
+                selected.append(rel)
+
+    def _stat(self, rel, stat):
+        key = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(rel)
+        if entry is None or entry[:2] != key:
+            self.entries[rel] = (*key, None)
+
+    def digest(self, rel):
+        mtime, size, digest = self.entries[rel]
+        if digest is None:
+            path = os.path.join(self.root, rel)
+            digest = "link:" + os.readlink(path) if os.path.islink(path) else hash_file(path, "sha1").hexdigest()
+            self.entries[rel] = (mtime, size, digest)
+        return digest
+
+    def tree_hash(self, paths):
+        """content hash over the given relative paths, stable across machines."""
+        h = hashlib.sha1()
+        for rel in sorted(paths):
+            h.update(rel.encode())
+            h.update(b"\0")
+            h.update(self.digest(rel).encode())
+            h.update(b"\n")
+        return h.hexdigest()
+
+    def save(self):
+        if not self.index_path:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def get_index(root):
+    """process-wide FileIndex, shared by all mounts of the same project root."""
+    root = os.path.realpath(root)
+    with _indices_lock:
+        if root not in _indices:
+            _indices[root] = FileIndex(root)
+        return _indices[root]
+
+
+class FileSelection:
+    """The set of files a mount packs, with the same knobs as the tar-based mounts.
+
+    :param local_abs: absolute path to the directory being packed.
+    :param excludes: tar-style exclude string, e.g. "--exclude='*.pkl'"
+    :param file_mask: space separated paths to include, relative to `local_abs`. Default "."
+    :param exclude_vcs: mirrors `tar --exclude-vcs`
+    :param exclude_from: path to a file of gitignore patterns, applied from the root.
+    :param use_gitignore: honor `.gitignore` files found in the tree.
+    """
+
+    def __init__(self, local_abs, excludes=None, file_mask=None, exclude_vcs=True, exclude_from=None,
+                 use_gitignore=True):
+        self.local_abs = local_abs
+        self.sub_paths = shlex.split(file_mask or ".")
+        self.use_gitignore = use_gitignore
+        self.rule_sets = [IgnoreRules.from_tar_excludes(excludes)]
+        if exclude_vcs:
+            self.rule_sets.append(IgnoreRules(VCS_PATTERNS))
+        if exclude_from:
+            self.rule_sets.append(IgnoreRules.from_file(exclude_from))
+        self.index = get_index(local_abs)
+
+    def files(self):
+        with self.index.lock:
+            files = self.index.scan(self.rule_sets, use_gitignore=self.use_gitignore, sub_paths=self.sub_paths)
+            self.index.save()
+        return files
+
+    def tree_hash(self, files=None):
+        """content hash of the selected files, or of `files` from an earlier call to `files()`."""
+        with self.index.lock:
+            if files is None:
+                files = self.files()
+            tree_hash = self.index.tree_hash(files)
+            self.index.save()
+        return tree_hash
+
+    def write(self, path, files=None):
+        """writes a NUL separated file list, to be used with `tar --null -T` or `rsync --from0 --files-from`.
+
+        :param files: the files to write, by default the ones selected now.
+        """
+        if files is None:
+            files = self.files()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\0".join(files))
+        return files
@@ -1,10 +1,7 @@
 import os
+import random
 import time
 
-import googleapiclient.discovery
-from params_proto import ParamsProto, Proto
-from six.moves import input
-
 
 def list_instances(compute, project_id, zone):
     result = compute.instances().list(project=project_id, zone=zone).execute()
@@ -90,24 +87,146 @@ def delete_instance(compute, project_id, zone, name):
         instance=name).execute()
 
 
-def wait_for_operation(compute, project_id, zone, operation):
-    print('Waiting for operation to finish...')
-    while True:
-        result = compute.zoneOperations().get(
-            project=project_id,
-            zone=zone,
-            operation=operation).execute()
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class OperationWaiter:
+    """
+    Waits on many zone operations and instances at once. Each round polls everything that is pending with
+    batches of `zoneOperations.get` and `instances.get` calls, and the rounds back off exponentially.
+
+    .. code:: python
+
+        waiter = OperationWaiter(compute)
+        for op in operations:
+            waiter.add(project_id, zone, op['id'], callback=lambda result: print(result['targetLink']))
+        waiter.wait()
+
+    :param compute: the compute api client.
+    :param batch_size: the calls per batch request.
+    :param base_delay: seconds between the first rounds.
+    :param max_delay: the longest wait between two rounds.
+    :param verbose: print each completed operation.
+    """
+
+    def __init__(self, compute, batch_size=100, base_delay=1, max_delay=30, verbose=False):
+        self.compute = compute
+        self.batch_size = batch_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.verbose = verbose
+        # key -> (request factory, done, callback)
+        self.pending = {}
+        self.results = {}
+        self.errors = {}
+
+    def add(self, project_id, zone, operation, callback=None):
+        """waits for the operation to be DONE. `callback(result)` is called with the finished operation."""
+        def request():
+            return self.compute.zoneOperations().get(project=project_id, zone=zone, operation=operation)
+
+        def done(result):
+            return result['status'] == 'DONE', result.get('error')
+
+        self.pending[("operation", project_id, zone, operation)] = request, done, callback
+
+    def add_instance(self, project_id, zone, instance, status="RUNNING", callback=None):
+        """waits for the instance to reach `status`. Fails if it is terminated or stopped first."""
+        def request():
+            return self.compute.instances().get(project=project_id, zone=zone, instance=instance)
+
+        def done(result):
+            if result['status'] == status:
+                return True, None
+            if result['status'] in ('STOPPING', 'STOPPED', 'SUSPENDED', 'TERMINATED'):
+                return True, f"instance {instance} is {result['status']}"
+            return False, None
+
+        self.pending[("instance", project_id, zone, instance)] = request, done, callback
+
+    def _finish(self, key, result, error):
+        _, _, callback = self.pending.pop(key)
+        self.results[key] = result
+        if error:
+            self.errors[key] = error
+        if self.verbose:
+            print(f"{key[0]} {key[-1]} {'failed' if error else 'done'}.")
+        if callback:
+            callback(result)
+
+    def poll(self):
+        """polls every pending operation once. Returns the number that finished."""
+        keys = list(self.pending)
+        finished = 0
+        for i in range(0, len(keys), self.batch_size):
+            chunk = keys[i:i + self.batch_size]
+            responses = {}
+
+            def callback(request_id, response, exception):
+                responses[chunk[int(request_id)]] = response, exception
+
+            batch = self.compute.new_batch_http_request()
+            for j, key in enumerate(chunk):
+                batch.add(self.pending[key][0](), callback=callback, request_id=str(j))
+            try:
+                batch.execute()
+            except Exception as e:
+                # transport errors: poll the chunk again in the next round.
+                if self.verbose:
+                    print(f"polling {len(chunk)} operations failed: {e}")
+                continue
+
+            for key, (response, exception) in responses.items():
+                if exception is not None:
+                    status = getattr(getattr(exception, "resp", None), "status", None)
+                    if status is None or int(status) in RETRY_STATUS:
+                        continue
+                    self._finish(key, None, exception)
+                else:
+                    is_done, error = self.pending[key][1](response)
+                    if not is_done:
+                        continue
+                    self._finish(key, response, error)
+                finished += 1
+        return finished
+
+    def wait(self, timeout=None, raise_errors=True):
+        """
+        polls until nothing is pending. Callbacks can add more operations to wait on.
+
+        :param timeout: seconds to wait for. Raises a TimeoutError when it runs out.
+        :param raise_errors: raise when an operation finished with an error.
+        :return: dictionary of (kind, project_id, zone, name) -> the finished operation or instance.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = self.base_delay
+        while self.pending:
+            if self.poll():
+                delay = self.base_delay
+            if not self.pending:
+                break
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"{len(self.pending)} operations are still pending.")
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(self.max_delay, delay * 2)
+
+        if raise_errors and self.errors:
+            raise Exception(f"{len(self.errors)} operations failed: {self.errors}")
+        return self.results
 
-        if result['status'] == 'DONE':
-            print("done.")
-            if 'error' in result:
-                raise Exception(result['error'])
-            return result
 
-        time.sleep(1)
+def wait_for_operation(compute, project_id, zone, operation):
+    print('Waiting for operation to finish...')
+    waiter = OperationWaiter(compute)
+    waiter.add(project_id, zone, operation)
+    result, = waiter.wait().values()
+    print("done.")
+    return result
 
 
 def main(project_id, bucket_name, zone, machine_type, instance_name, wait=True):
+    import googleapiclient.discovery
+
     compute = googleapiclient.discovery.build('compute', 'v1')
 
     print('Creating instance.')
@@ -138,6 +257,8 @@ Once the image is uploaded press enter to delete the instance.
 
 
 if __name__ == '__main__':
+    from params_proto import ParamsProto, Proto
+
     class CreateInstance(ParamsProto):
         """Example of using the Compute Engine API to create and delete instances.
 
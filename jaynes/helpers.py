@@ -20,6 +20,28 @@ def tag_instance(Name=None, region="us-west-2", verbose=False, **kwargs):
     return check_call(cmd, shell=True, verbose=verbose)
 
 
+def presign_s3(url, expires=3600, region=None):
+    """a time-limited https url for GET-ing the s3:// object, so that the host needs neither the aws cli
+    nor credentials."""
+    from .cache import boto3_client
+    bucket, _, key = url[len("s3://"):].partition("/")
+    return boto3_client("s3", region).generate_presigned_url(
+        "get_object", Params=dict(Bucket=bucket, Key=key), ExpiresIn=expires)
+
+
+def hash_file(path, algorithm="sha256", chunk_size=1 << 20):
+    """the `hashlib` hash object of the file, read in chunks. Call `.hexdigest()` on it, or keep updating it."""
+    import hashlib
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h
+
+
 def is_interactive():
     """pyCharm emulate terminal confuses this, show up as tty but then runner fails"""
     import os
@@ -73,23 +95,56 @@ def memoize(f):
     return wrapper
 
 
+class Deferred:
+    """A yaml node that is only instantiated when it is used. Loading the config creates these instead of
+    mounts, so that modes that do not run cost nothing. Anchors share the node, and therefore the instance."""
+
+    def __init__(self, Constructor, kwargs, ctx):
+        self.Constructor = Constructor
+        self.kwargs = kwargs
+        self.ctx = ctx
+
+    def materialize(self):
+        if not hasattr(self, "value"):
+            kwargs = {}
+            for k, v in materialize(self.kwargs).items():
+                if isinstance(v, str):
+                    try:
+                        kwargs[k] = v.format(**self.ctx)
+                    except AttributeError as e:
+                        raise Exception(f"during comprehension of <{k}: {v}>: {str(e)}")
+                else:
+                    kwargs[k] = v
+            try:
+                self.value = self.Constructor(**kwargs)
+            except Exception as e:
+                print(f"{self.Constructor} and {kwargs} fails to instantiate")
+                raise e
+        return self.value
+
+    def __repr__(self):
+        return f"Deferred({getattr(self.Constructor, '__name__', self.Constructor)})"
+
+
+def materialize(value):
+    """instantiates the deferred nodes inside `value`. Lists and dictionaries are updated in place."""
+    if isinstance(value, Deferred):
+        return value.materialize()
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            value[i] = materialize(v)
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            value[k] = materialize(v)
+    elif isinstance(value, tuple):
+        return tuple(materialize(v) for v in value)
+    return value
+
+
 # note: now we properly handle the node types.
 def hydrate(Constructor, ctx):
     def _fn(_, node):
-        kwargs = {}
-        for k, v in _.construct_mapping(node).items():
-            if isinstance(v, str):
-                try:
-                    kwargs[k] = v.format(**ctx)
-                except AttributeError as e:
-                    raise Exception(f"during comprehension of <{k}: {v}>: {str(e)}")
-            else:
-                kwargs[k] = v
-        try:
-            return Constructor(**kwargs)
-        except Exception as e:
-            print(f"{Constructor} and {kwargs} fails to instantiate")
-            raise e
+        return Deferred(Constructor, _.construct_mapping(node), ctx)
 
     return _fn
 
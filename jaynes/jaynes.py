@@ -1,7 +1,9 @@
 import glob
 import math
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from types import SimpleNamespace
 from uuid import uuid4
@@ -13,7 +15,8 @@ import jaynes.launchers
 import jaynes.launchers.base_launcher
 import jaynes.mounts
 import jaynes.runners
-from jaynes.helpers import cwd_ancestors, hydrate
+from jaynes.helpers import cwd_ancestors, hydrate, materialize
+from jaynes.param_codec import pickle_by_value, serialize
 
 
 class RUN:
@@ -36,19 +39,49 @@ class RUN:
         cls.__now = None
 
 
-class Jaynes:
-    # Use False as the default mode, to be overwritten on first config
-    mode = False
-    verbose = None
-    mounts = []
-    launcher = None
-    runner_config = None
+# guards `RUN`, which is shared by all sessions.
+_run_lock = threading.RLock()
 
-    _raw_config = None
-    _secret = None
 
-    @classmethod
-    def format_context(cls, config_root=None, **ext):
+class Session:
+    """
+    Holds the state of one launch: the selected mode, the launcher, its runners, and the mounts and their
+    uploads. Sessions are independent, so one process can drive several launches concurrently, e.g. one
+    thread per mode:
+
+    .. code:: python
+
+        session = jaynes.Session()
+        session.config("ec2")
+        session.add(train, lr=0.1)
+        session.execute()
+
+    The module-level `jaynes.config`, `jaynes.add` etc. use the default session.
+    """
+
+    def __init__(self):
+        # Use False as the default mode, to be overwritten on first config
+        self.mode = False
+        self.verbose = None
+        self.mounts = []
+        self.launcher = None
+        self.runner_config = None
+        # the directory of the `.jaynes.yml` file
+        self.config_dir = None
+
+        self._raw_config = None
+        self._secret = None
+
+        # mount -> future of its upload. Uploads run in the background so that serializing thunks and
+        # planning runners overlaps with them.
+        self._uploads = {}
+        self._upload_pool = None
+        self.upload_workers = 4
+        # tree-shaken and by-value mounts -> upload arguments. These are uploaded on execute, once the thunks
+        # are known.
+        self._deferred = {}
+
+    def format_context(self, config_root=None, **ext):
         try:
             with open(config_root + "/.secret.yml", 'r') as f:
                 secret = yaml.safe_load(f)
@@ -58,8 +91,7 @@ class Jaynes:
         return dict(env=SimpleNamespace(**os.environ), now=RUN.now, uuid=uuid4(), RUN=RUN,
                     secret=SimpleNamespace(**secret), **ext)
 
-    @classmethod
-    def config_root(cls, config_path=None):
+    def config_root(self, config_path=None):
         if config_path is None:
             for d in cwd_ancestors():
                 try:
@@ -74,48 +106,75 @@ class Jaynes:
 
         return os.path.dirname(config_path), config_path
 
-    @classmethod
-    def raw_config(cls, config_path=None, ctx={}):
-        if cls._raw_config:
-            return cls._raw_config
+    def raw_config(self, config_path=None, ctx={}):
+        if self._raw_config:
+            return self._raw_config
 
         from inspect import isclass
 
+        # a loader per session, since the constructors hold the interpolation context.
+        class Loader(yaml.SafeLoader):
+            pass
+
         # add env class for interpolation
-        yaml.SafeLoader.add_constructor("!ENV", hydrate(dict, ctx), )
+        Loader.add_constructor("!ENV", hydrate(dict, ctx), )
 
         for k, c in jaynes.mounts.__dict__.items():
             if isclass(c):
-                yaml.SafeLoader.add_constructor("!mounts." + k, hydrate(c, ctx), )
+                Loader.add_constructor("!mounts." + k, hydrate(c, ctx), )
 
         for k, c in jaynes.runners.__dict__.items():
             if hasattr(c, 'from_yaml'):
-                yaml.SafeLoader.add_constructor("!runners." + k, c.from_yaml)
+                Loader.add_constructor("!runners." + k, c.from_yaml)
 
-        yaml.SafeLoader.add_constructor("!host", hydrate(lambda **args: args, ctx))
+        Loader.add_constructor("!host", hydrate(lambda **args: args, ctx))
 
         with open(config_path, 'r') as f:
-            raw = yaml.safe_load(f)
+            raw = yaml.load(f, Loader=Loader)
 
         # order or precendence: mode -> run -> root
-        cls._raw_config = raw
+        self._raw_config = raw
         return raw
 
-    host_unpacked = None
-
-    _uploaded = []
-
-    @classmethod
-    def upload_mount(J, mounts, verbose=None, **host, ):
+    def upload_mount(self, mounts, verbose=None, **host, ):
+        if self._upload_pool is None:
+            self._upload_pool = ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="jaynes-upload")
         for mount in mounts:
-            if mount in J._uploaded:
+            if mount.per_host and self.launcher.UPLOAD_PER_HOST:
+                continue
+            elif mount in self._uploads:
                 print('this package is already uploaded')
+            elif (mount.tree_shake or mount.by_value) and mount not in self._deferred:
+                self._deferred[mount] = dict(verbose=verbose, **host)
             else:
-                J._uploaded.append(mount)
-                mount.upload(verbose=verbose, **host)
+                self._uploads[mount] = self._upload_pool.submit(mount.upload, verbose=verbose, **host)
 
-    @classmethod
-    def config(cls, mode=None, *, config_path=None, runner=None, launch=None, verbose=None,
+    def wait_for_uploads(self, mounts=None):
+        """block until the uploads of `mounts` (all pending uploads by default) are done.
+
+        Re-raises the first upload error.
+        """
+        mounts = list({**self._deferred, **self._uploads} if mounts is None else mounts)
+        # start the deferred uploads first, so that they run concurrently.
+        for mount in mounts:
+            if mount in self._deferred and mount not in self._uploads:
+                shipped = mount.by_value and not mount.by_value_fallback
+                if mount.by_value:
+                    mount.skip_upload(shipped)
+                if not shipped:
+                    self.upload_mount([mount], **self._deferred[mount])
+        try:
+            for mount in mounts:
+                future = self._uploads.get(mount)
+                if future is not None:
+                    future.result()
+        finally:
+            # the pool is started again by the next upload.
+            if self._upload_pool is not None and all(f.done() for f in self._uploads.values()):
+                self._upload_pool.shutdown()
+                self._upload_pool = None
+
+    def config(self, mode=None, *, config_path=None, runner=None, launch=None, verbose=None,
                **ext):
         """
         Configuration function for Jaynes
@@ -132,15 +191,15 @@ class Jaynes:
 
         cprint(f"Launching {mode or '<default>'} mode", color="blue")
         # saving so that ml-logger can use this
-        cls.mode = mode
+        self.mode = mode
         if mode == 'local':
             cprint("running local mode", "green")
             return
 
-        RUN.config_root, config_path = cls.config_root(config_path)
+        self.config_dir, config_path = self.config_root(config_path)
 
-        ctx = cls.format_context(RUN.config_root, **ext)
-        config = cls.raw_config(config_path, ctx).copy()
+        ctx = self.format_context(self.config_dir, **ext)
+        config = self.raw_config(config_path, ctx).copy()
 
         if mode:
             modes = config.get('modes', {})
@@ -152,60 +211,70 @@ class Jaynes:
             config.update(run)
             # config = run
 
+        # the mounts and other `!` nodes are only instantiated for the selected mode. Mounts resolve their
+        # paths against `RUN.config_root`, which is shared between sessions.
+        with _run_lock:
+            RUN.config_root = self.config_dir
+            for k, v in config.items():
+                if k not in ("modes", "run"):
+                    config[k] = materialize(v)
+
         if verbose is not None:
-            cls.verbose = verbose
-        elif cls.verbose is None:
-            cls.verbose = config.get('verbose', None)
+            self.verbose = verbose
+        elif self.verbose is None:
+            self.verbose = config.get('verbose', None)
 
-        if cls.runner_config is None:
-            cls.runner_config = config['runner']
+        if self.runner_config is None:
+            self.runner_config = config['runner']
         if runner:
-            Runner, runner_config = cls.runner_config
+            Runner, runner_config = self.runner_config
             runner_config.update(runner)
             # local_copy = runner_config.copy()
             # local_copy.update(runner)
-            # cls.runner_config = Runner, local_copy
+            # self.runner_config = Runner, local_copy
 
         # launch_config = config['launch'].copy()
         launch_config = config['launch']
         if launch:
             launch_config.update(launch)
 
-        if cls.launcher is None:
+        if self.launcher is None:
             # launch_type = launch_config.pop("type")
             launch_type = launch_config["type"]
-            # J.launcher = getattr(jaynes.launchers, launch_type)(**J.launch_config)
-            cls.launcher = getattr(jaynes.launchers, launch_type)(**launch_config)
+            # self.launcher = getattr(jaynes.launchers, launch_type)(**self.launch_config)
+            self.launcher = getattr(jaynes.launchers, launch_type)(**launch_config)
 
-            cls.mounts = config.get('mounts', [])
+            self.mounts = config.get('mounts', [])
+            self.upload_workers = config.get('upload_workers', self.upload_workers)
 
-            cls.upload_mount(**launch_config, mounts=cls.mounts, verbose=cls.verbose)
+            self.upload_mount(**launch_config, mounts=self.mounts, verbose=self.verbose)
         else:
-            # if cls.launcher.last_runner and cls.launcher.last_runner.chain is None:
-            #     cls.launcher.plan_instance()
-            cls.launcher.__init__(**launch_config)
+            # if self.launcher.last_runner and self.launcher.last_runner.chain is None:
+            #     self.launcher.plan_instance()
+            self.launcher.__init__(**launch_config)
 
-    @classmethod
-    def process_runner_config(cls):
+    def process_runner_config(self):
         # config.RUNNER
-        Runner, runner_kwargs = cls.runner_config
+        Runner, runner_kwargs = self.runner_config
         # interpolation context
-        context = cls.format_context(
-            RUN.config_root,
-            mounts=cls.mounts,
+        with _run_lock:
+            count = RUN.count
+            RUN.count += 1
+        context = self.format_context(
+            self.config_dir,
+            mounts=self.mounts,
             run=SimpleNamespace(
-                count=RUN.count,
+                count=count,
                 cwd=os.getcwd(),
                 now=datetime.now(),
                 uuid=uuid4(),
                 # unclear if this is needed
                 pypaths=SimpleNamespace(
-                    host=":".join([m.host_path for m in cls.mounts if m.pypath]),
-                    container=":".join([m.container_path for m in cls.mounts if m.pypath])
+                    host=":".join([m.host_path for m in self.mounts if m.pypath]),
+                    container=":".join([m.container_path for m in self.mounts if m.pypath])
                 )
             )
         )
-        RUN.count += 1
         # todo: mapping current work directory correction on the remote instance.
 
         hydrated_runner_config = {}
@@ -224,81 +293,149 @@ class Jaynes:
 
         return Runner, hydrated_runner_config
 
-    @classmethod
-    def add(cls, fn, *args, **kwargs, ):
+    def shake_mounts(self, mounts, fn, *args, **kwargs):
+        """add the files the thunk needs to the tree-shaken mounts. A mount that was uploaded without them is
+        uploaded again on the next execute."""
+        for mount in mounts:
+            if not mount.tree_shake:
+                continue
+            new_files = mount.shake(fn, *args, **kwargs)
+            if new_files and mount in self._uploads:
+                cprint(f"{mount.selection.local_abs} was uploaded without {sorted(new_files)}, uploading it again.",
+                       "yellow")
+                # the earlier upload has to finish first, it writes to the same place.
+                self._uploads.pop(mount).result()
+
+    def build_thunk(self, runner, build, build_encoded, fn, *args, **kwargs):
+        """calls `build`, i.e. `runner.build` or `runner.chain`, with the modules of the `by_value` mounts
+        pickled by value when the thunk fits in their `by_value_limit`. Otherwise those mounts are uploaded.
+        The thunk that fits goes to `build_encoded` as it was measured."""
+        mounts = [m for m in runner.mounts if m.by_value and not m.by_value_fallback]
+        if isinstance(runner, jaynes.runners.Container):
+            # the job spec already has the init containers that download the code.
+            for mount in mounts:
+                mount.by_value_fallback = True
+            mounts = []
+        for mount in mounts:
+            root = mount.selection.local_abs
+            if any(glob.glob(os.path.join(root, pattern), recursive=True) for pattern in mount.data_files or ()):
+                cprint(f"{root} has data_files, which the thunks can not carry. Uploading the mount instead.",
+                       "yellow")
+                mount.by_value_fallback = True
+        mounts = [m for m in mounts if not m.by_value_fallback]
+
+        modules = sorted({name for m in mounts for name in m.local_modules(fn, *args, **kwargs)})
+        if modules:
+            with pickle_by_value(modules):
+                encoded_thunk = serialize(fn, args, kwargs)
+            if len(encoded_thunk) <= min(m.by_value_limit for m in mounts):
+                return build_encoded(encoded_thunk)
+            cprint(f"The thunk of {fn} is {len(encoded_thunk)} bytes with its code, which is over the "
+                   f"by_value_limit. Falling back to uploading the code mounts.", "yellow")
+            for mount in mounts:
+                mount.by_value_fallback = True
+        return build(fn, *args, **kwargs)
+
+    def add(self, fn, *args, **kwargs, ):
         """
         Method for adding a runner.
 
         this is aware of the launch type
         """
 
-        if not cls.launcher:
-            cls.config(cls.mode)
+        if not self.launcher:
+            self.config(self.mode)
 
-        if cls.launcher.last_runner:
-            cls.launcher.plan_instance(cls.verbose)
+        if self.launcher.last_runner:
+            self.launcher.plan_instance(self.verbose)
 
-        Runner, hydrated_config = cls.process_runner_config()
+        Runner, hydrated_config = self.process_runner_config()
 
-        runner = Runner(**hydrated_config, mounts=cls.mounts)
-        runner.build(fn, *args, **kwargs)
-        cls.launcher.add_runner(runner)
+        runner = Runner(**hydrated_config, mounts=self.mounts)
+        self.build_thunk(runner, runner.build, runner.build_encoded, fn, *args, **kwargs)
+        self.shake_mounts(runner.mounts, fn, *args, **kwargs)
+        self.launcher.add_runner(runner)
 
-        return cls
+        return self
 
-    @classmethod
-    def chain(cls, fn, *args, **kwargs):
-        assert cls.launcher.last_runner, "launcher must already contain a runner"
-        if cls.launcher.last_runner.chain is None:
+    def chain(self, fn, *args, **kwargs):
+        assert self.launcher.last_runner, "launcher must already contain a runner"
+        if self.launcher.last_runner.chain is None:
             # In Docker for example, chaining should just add another runner.
-            # return cls.add(fn, *args, **kwargs)
-            if not cls.launcher:
-                config()
+            # return self.add(fn, *args, **kwargs)
+            if not self.launcher:
+                self.config(self.mode)
 
-            Runner, hydrated_config = cls.process_runner_config()
+            Runner, hydrated_config = self.process_runner_config()
 
-            runner = Runner(**hydrated_config, mounts=cls.mounts)
-            runner.build(fn, *args, **kwargs)
-            cls.launcher.add_runner(runner)
+            runner = Runner(**hydrated_config, mounts=self.mounts)
+            self.build_thunk(runner, runner.build, runner.build_encoded, fn, *args, **kwargs)
+            self.shake_mounts(runner.mounts, fn, *args, **kwargs)
+            self.launcher.add_runner(runner)
 
         else:
             ### some runners require custom chaining logic. In Kubernetes for example,
             ### chaining extends the command list.
-            Runner, hydrated_config = cls.process_runner_config()
+            Runner, hydrated_config = self.process_runner_config()
 
             # note: there is no mounts here. Reuses instance mounts.
-            cls.launcher.last_runner.__init__(**hydrated_config)
-            cls.launcher.last_runner.chain(fn, *args, **kwargs)
+            self.launcher.last_runner.__init__(**hydrated_config)
+            runner = self.launcher.last_runner
+            self.build_thunk(runner, runner.chain, runner.chain_encoded, fn, *args, **kwargs)
+            self.shake_mounts(runner.mounts, fn, *args, **kwargs)
 
-        return cls
+        return self
 
-    @classmethod
-    def launch_instance(cls, verbose=None):
+    def launch_instance(self, verbose=None):
         """Only used with GCP.
         This returns the request ID for this instance if it is
         a spot request, instance ID if it is on-demand."""
-        return cls.launcher.launch_instance(verbose=verbose or cls.verbose)
-
-    @classmethod
-    def execute(J, verbose=None):
-        verbose = verbose or J.verbose
-        J.launcher.setup_host(verbose=verbose)
-        if J.launcher.last_runner:
-            return J.launcher.execute(verbose=verbose)
+        self.wait_for_uploads(self.launcher.all_mounts)
+        return self.launcher.launch_instance(verbose=verbose or self.verbose)
+
+    def execute(self, verbose=None):
+        verbose = verbose or self.verbose
+        # only wait on the mounts used by the runners of this launch.
+        self.wait_for_uploads(self.launcher.all_mounts)
+        self.launcher.setup_host(verbose=verbose)
+        if self.launcher.last_runner:
+            return self.launcher.execute(verbose=verbose)
         else:
             raise ValueError("No runners in launcher")
 
-    @classmethod
-    def run(J, fn, *args, **kwargs, ):
-        if J.mode == "local":
+    def run(self, fn, *args, **kwargs, ):
+        if self.mode == "local":
             return fn(*args, **kwargs)
 
-        J.add(fn, *args, **kwargs)
-        return J.execute()
+        self.add(fn, *args, **kwargs)
+        return self.execute()
+
+
+class _DefaultSession(type):
+    """forwards attribute access on the `Jaynes` class to the default session."""
+
+    def __getattr__(cls, item):
+        return getattr(default_session, item)
+
+    def __setattr__(cls, key, value):
+        setattr(default_session, key, value)
+
+
+class Jaynes(metaclass=_DefaultSession):
+    """The default session. Kept so that `Jaynes.config(...)`, `Jaynes.mode` etc. keep working."""
+
+
+default_session = Session()
 
 
 def listen(timeout=None, interval=math.pi * 5, command=None, backoff_limit=None):
-    """Just a for-loop, to keep ths process connected to the ssh session"""
+    """Just a for-loop, to keep ths process connected to the ssh session.
+
+    After a Kube launch, follows the jobs of the sweep with a watch until they finish instead, see `Kube.track`.
+    """
+    launcher = default_session.launcher
+    if command is None and isinstance(launcher, jaynes.launchers.Kube) and launcher.submitted:
+        return launcher.track(timeout=timeout)
 
     cprint('Jaynes pipe-back is now listening...', "blue")
     if command:
@@ -319,10 +456,10 @@ def listen(timeout=None, interval=math.pi * 5, command=None, backoff_limit=None)
             backoff += 1
 
 
-config = Jaynes.config
-run = Jaynes.run
-add = Jaynes.add
-chain = Jaynes.chain
-# launch_instance = Jaynes.launch_instance
-# plan = Jaynes.plan
-execute = Jaynes.execute
+config = default_session.config
+run = default_session.run
+add = default_session.add
+chain = default_session.chain
+# launch_instance = default_session.launch_instance
+# plan = default_session.plan
+execute = default_session.execute
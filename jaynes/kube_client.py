@@ -0,0 +1,264 @@
+"""
+A minimal Kubernetes API client for submitting jobs.
+
+Talks to the API server directly over a pooled `requests.Session`, with the cluster, the credentials and the
+namespace of a kubeconfig context, instead of shelling out to `kubectl`. Supports bearer tokens, client
+certificates and `exec` credential plugins such as `gke-gcloud-auth-plugin` and `aws eks get-token`.
+"""
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def _by_name(items, name):
+    for item in items or ():
+        if item["name"] == name:
+            return item
+    raise KeyError(f"{name} is not in the kubeconfig")
+
+
+def _data_file(data, name, suffix):
+    """kubeconfigs can inline certificates and keys as base64, while requests needs file paths. The file is
+    only readable by the user, and named after the cluster or the user entry `name` of the kubeconfig."""
+    from .helpers import get_temp_dir
+
+    key = hashlib.sha1(name.encode()).hexdigest()[:16]
+    path = os.path.join(get_temp_dir(), f"kube-{key}{suffix}")
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+        f.write(base64.b64decode(data))
+    return path
+
+
+def exec_token(spec):
+    """runs a kubeconfig `exec` credential plugin, and returns its bearer token."""
+    env = dict(os.environ, **{e["name"]: e["value"] for e in spec.get("env") or ()})
+    output = subprocess.check_output([spec["command"], *(spec.get("args") or ())], env=env)
+    return json.loads(output)["status"]["token"]
+
+
+class KubeClient:
+    """
+    :param server: the url of the API server, e.g. https://10.0.0.1
+    :param token: the bearer token
+    :param exec_spec: an `exec` credential plugin, run for a new token when the token is rejected.
+    :param verify: the path to the CA bundle of the cluster, or False to skip the verification.
+    :param cert: (certificate, key) paths of the client certificate.
+    :param namespace: the default namespace.
+    :param pool_size: the connections kept open to the API server.
+    """
+
+    def __init__(self, server, token=None, exec_spec=None, verify=True, cert=None, namespace="default",
+                 pool_size=16):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.server = server.rstrip("/")
+        self.namespace = namespace
+        self.exec_spec = exec_spec
+        self.session = requests.Session()
+        self.session.mount(self.server, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.verify = verify
+        self.session.cert = cert
+        self.token_lock = threading.Lock()
+        if exec_spec and not token:
+            token = exec_token(exec_spec)
+        self.set_token(token)
+
+    def set_token(self, token):
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    @classmethod
+    def from_kubeconfig(cls, path=None, context=None, **kwargs):
+        """
+        :param path: the kubeconfig. Defaults to the first file in $KUBECONFIG, then ~/.kube/config
+        :param context: the kubeconfig context. Defaults to the current context.
+        """
+        import yaml
+
+        path = path or os.environ.get("KUBECONFIG", "~/.kube/config").split(os.pathsep)[0]
+        with open(os.path.expanduser(path)) as f:
+            config = yaml.safe_load(f)
+        context = _by_name(config.get("contexts"), context or config["current-context"])["context"]
+        cluster = _by_name(config.get("clusters"), context["cluster"])["cluster"]
+        user = (_by_name(config.get("users"), context["user"]).get("user") or {}) if context.get("user") else {}
+
+        if cluster.get("insecure-skip-tls-verify"):
+            verify = False
+        elif cluster.get("certificate-authority-data"):
+            verify = _data_file(cluster["certificate-authority-data"], context["cluster"], ".ca.crt")
+        else:
+            verify = cluster.get("certificate-authority") or True
+
+        cert = None
+        if user.get("client-certificate-data") or user.get("client-certificate"):
+            name = context["user"]
+            cert = (user.get("client-certificate") or _data_file(user["client-certificate-data"], name, ".crt"),
+                    user.get("client-key") or _data_file(user["client-key-data"], name, ".key"))
+
+        token = user.get("token")
+        if not token and user.get("tokenFile"):
+            with open(user["tokenFile"]) as f:
+                token = f.read().strip()
+
+        return cls(cluster["server"], token=token, exec_spec=user.get("exec"), verify=verify, cert=cert,
+                   namespace=context.get("namespace", "default"), **kwargs)
+
+    def request(self, method, path, retries=5, base_delay=0.5, max_delay=30, **kwargs):
+        """
+        sends the request, and retries rate limits, server errors and connection errors with exponential
+        backoff and full jitter. Honors the Retry-After header of the API server.
+
+        :return: the `requests.Response`. Raises `requests.HTTPError` for the other error statuses. Its
+                 `retried` attribute is True when an earlier attempt may have gone through, i.e. failed with a
+                 connection error or a server error.
+        """
+        import requests
+
+        attempt, refreshed, retried = 0, False, False
+        while True:
+            try:
+                r = self.session.request(method, self.server + path, **kwargs)
+            except requests.ConnectionError:
+                if attempt == retries:
+                    raise
+                r = None
+            if r is not None and r.status_code == 401 and self.exec_spec and not refreshed:
+                # exec plugin tokens expire.
+                with self.token_lock:
+                    self.set_token(exec_token(self.exec_spec))
+                refreshed = True
+                continue
+            if r is not None and (r.status_code not in RETRY_STATUS or attempt == retries):
+                r.retried = retried
+                r.raise_for_status()
+                return r
+            # rate limited requests were not processed.
+            retried = retried or r is None or r.status_code != 429
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if r is not None and r.headers.get("Retry-After", "").isdigit():
+                delay = int(r.headers["Retry-After"])
+            time.sleep(delay)
+            attempt += 1
+
+    def create_job(self, job, namespace=None):
+        """creates the Job object. Returns dict(name, uid) of the created job."""
+        import requests
+
+        namespace = job["metadata"].get("namespace") or namespace or self.namespace
+        job = dict(job, metadata=dict(job["metadata"], namespace=namespace))
+        try:
+            r = self.request("POST", self.jobs_path(namespace), json=job)
+        except requests.HTTPError as e:
+            # an earlier attempt created the job, but its response was lost.
+            if e.response is None or e.response.status_code != 409 or not getattr(e.response, "retried", False):
+                raise
+            r = self.request("GET", f"{self.jobs_path(namespace)}/{job['metadata']['name']}")
+        metadata = r.json()["metadata"]
+        return dict(name=metadata["name"], uid=metadata["uid"])
+
+    def jobs_path(self, namespace=None):
+        return f"/apis/batch/v1/namespaces/{namespace or self.namespace}/jobs"
+
+    def list_jobs(self, namespace=None, label_selector=None):
+        """the JobList, whose `metadata.resourceVersion` is where a watch picks up."""
+        return self.request("GET", self.jobs_path(namespace), params=dict(labelSelector=label_selector)).json()
+
+    def watch_jobs(self, namespace=None, label_selector=None, resource_version=None, timeout=300):
+        """
+        streams the watch events of the jobs, as dict(type, object). The stream ends after `timeout` seconds,
+        or when the connection drops.
+        """
+        params = dict(watch=1, labelSelector=label_selector, resourceVersion=resource_version,
+                      timeoutSeconds=timeout, allowWatchBookmarks="true")
+        r = self.request("GET", self.jobs_path(namespace), params=params, stream=True, timeout=(10, timeout + 30))
+        with r:
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def stream_jobs(self, namespace=None, label_selector=None, timeout=300, deadline=None):
+        """
+        lists the jobs, then follows them with watches that resume from the last resourceVersion seen when
+        a stream ends or drops. Lists again when the API server no longer has that version (410 Gone).
+
+        Yields ("SYNC", the list of jobs) after each list, and (event type, job) for the watch events. The
+        bookmarks of the API server only move the resourceVersion along, and are not yielded.
+
+        :param timeout: seconds each watch stays open.
+        :param deadline: the `time.time()` at which the stream ends, even when no event arrives. The watches
+                         are cut short to end by then. None follows the jobs indefinitely.
+        """
+        import requests
+
+        resource_version = None
+        while deadline is None or time.time() < deadline:
+            if resource_version is None:
+                listing = self.list_jobs(namespace, label_selector)
+                resource_version = listing["metadata"]["resourceVersion"]
+                yield "SYNC", listing["items"]
+            watch_timeout = timeout if deadline is None else max(1, min(timeout, math.ceil(deadline - time.time())))
+            try:
+                for event in self.watch_jobs(namespace, label_selector, resource_version, timeout=watch_timeout):
+                    if event["type"] == "ERROR":
+                        if event["object"].get("code") != 410:
+                            raise RuntimeError(f"watch failed: {event['object'].get('message')}")
+                        resource_version = None
+                        break
+                    resource_version = event["object"]["metadata"]["resourceVersion"]
+                    if event["type"] != "BOOKMARK":
+                        yield event["type"], event["object"]
+                    if deadline is not None and time.time() >= deadline:
+                        return
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 410:
+                    raise
+                resource_version = None
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                # resumes from resource_version.
+                pass
+
+    def create_jobs(self, jobs, namespace=None, workers=16, verbose=False):
+        """
+        creates the jobs concurrently on `workers` threads, over the pooled connections.
+
+        :return: the dict(name, uid) of each job, in order.
+        :raises RuntimeError: when some jobs failed, with the `created` list of the others, None in place of
+                              the failed jobs.
+        """
+        if not jobs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(workers, len(jobs)), thread_name_prefix="jaynes-kube") as pool:
+            futures = [pool.submit(self.create_job, job, namespace) for job in jobs]
+        created, errors = [], []
+        for job, future in zip(jobs, futures):
+            try:
+                created.append(future.result())
+                if verbose:
+                    print(f"job.batch/{created[-1]['name']} created")
+            except Exception as e:
+                created.append(None)
+                errors.append((job["metadata"]["name"], e))
+        if errors:
+            error = RuntimeError(f"{len(errors)} of {len(jobs)} jobs failed: {errors[:5]}, created: "
+                                 f"{[c['name'] for c in created if c]}")
+            # the dict(name, uid) of each job, None for those that failed.
+            error.created = created
+            raise error from errors[0][1]
+        return created
+
+
+def kube_client(path=None, context=None):
+    """the process-wide client of the kubeconfig context, see `jaynes.cache.client`."""
+    from .cache import client
+
+    return client(("kube", path, context), lambda: KubeClient.from_kubeconfig(path, context))
@@ -1,11 +1,13 @@
 from .ec2_launch import EC2
 from .gcp_launch import GCE
 from .ssh_launch import SSH
+from .ssh_pool_launch import SSHPool
 from .manager_launch import Manager
 from .kube_launch import Kube
 
 ec2 = EC2
 gce = GCE
 ssh = SSH
+ssh_pool = SSHPool
 manager = Manager
 kube = Kube
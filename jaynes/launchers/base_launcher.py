@@ -1,14 +1,21 @@
+import hashlib
 import os
+import shlex
 from textwrap import dedent
 from typing import Union, Tuple, Sequence
 
 from jaynes.mounts import Mount
 from jaynes.runners import Runner
-from jaynes.templates import ec2_terminate, gce_terminate, ec2_tag_instance
+from jaynes.templates import ec2_terminate, gce_terminate, ec2_tag_instance, bootstrap_stub
+
+# limits on the raw size of the launch script, see `stage_launch_script`.
+EC2_USER_DATA_LIMIT = 16 * 1024
+GCE_METADATA_LIMIT = 256 * 1024
 
 
 class Launcher:
     BATCH_EXE = False  # class flag for batch execution support
+    UPLOAD_PER_HOST = False  # class flag for launchers that upload the `per_host` mounts themselves
     runners = None
 
     def __init__(self, **kwargs):
@@ -40,13 +47,134 @@ class Launcher:
         pass
 
 
-def make_host_unpack_script(mounts: Sequence[Mount], launch_dir="/tmp/jaynes-mount", delay=None, root_config=None, **_):
+def default_script_prefix(mounts, scheme):
+    """the prefix of the first code mount that uploads to `scheme`, e.g. "s3://" """
+    for mount in mounts:
+        prefix = getattr(mount, "prefix", None)
+        if isinstance(prefix, str) and prefix.startswith(scheme):
+            return prefix
+
+
+def stage_launch_script(launch_script, limit, script_prefix=None, script_url_expires=7 * 24 * 3600):
+    """
+    returns the launch script if it fits in `limit` bytes. Otherwise uploads it to the object store under
+    `script_prefix`, keyed by its sha256, and returns a bootstrap stub that downloads, verifies and runs it.
+
+    s3:// scripts are downloaded with curl through a presigned url, gs:// scripts with gsutil using the
+    service account of the instance.
+
+    :param launch_script: the output of `make_launch_script`
+    :param limit: the size limit in bytes, e.g. EC2_USER_DATA_LIMIT
+    :param script_prefix: an s3:// or gs:// prefix, e.g. s3://ge-bair/jaynes-debug
+    :param script_url_expires: seconds the presigned s3 url stays valid. Spot requests have to be fulfilled
+                               before it expires. At most 7 days, and shorter with temporary credentials.
+    """
+    data = launch_script.encode()
+    if len(data) <= limit:
+        return launch_script
+    if not script_prefix:
+        raise ValueError(f"The launch script is {len(data)} bytes, over the {limit} bytes limit. Set "
+                         f"`script_prefix` to an s3:// or gs:// prefix to upload it instead.")
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    url = f"{script_prefix.rstrip('/')}/jaynes-launch/{sha256}.sh"
+    if url.startswith("s3://"):
+        from jaynes.cache import boto3_client
+        from jaynes.helpers import presign_s3
+
+        bucket, _, key = url[len("s3://"):].partition("/")
+        boto3_client("s3").put_object(Bucket=bucket, Key=key, Body=data)
+        fetch = f"curl -sfL -o $JAYNES_SCRIPT '{presign_s3(url, expires=script_url_expires)}'"
+    elif url.startswith("gs://"):
+        import subprocess
+        subprocess.run(["gsutil", "-q", "cp", "-", url], input=data, check=True)
+        fetch = f"gsutil -q cp {url} $JAYNES_SCRIPT"
+    else:
+        raise NotImplementedError(f"script_prefix {script_prefix} is not supported, use s3:// or gs://")
+    return bootstrap_stub(fetch, sha256)
+
+
+def log_phase(label):
+    return f"""echo "[jaynes] $(date -u +%T.%3N) {label}" """
+
+
+def concurrent_steps(steps, on_failure=""):
+    """
+    runs the (label, script) steps concurrently in background subshells, followed by a barrier that waits for
+    all of them. Each step logs when it starts and finishes, and runs with `set -e`, so that it fails on its
+    first failed command. When a step fails, the barrier prints the failed steps, runs `on_failure` and exits
+    with 1.
+
+    :param steps: a list of (label, script) tuples. Empty scripts are skipped.
+    :param on_failure: script that runs before the exit, e.g. the termination of the instance.
+    """
+    steps = [(label, dedent(script).strip()) for label, script in steps if script and script.strip()]
+    if not steps:
+        return ""
+    blocks = [f"""
+(
+{log_phase(f"{label} started")}
+(
+set -e
+{script}
+)
+JAYNES_STATUS=$?
+{log_phase(f"{label} finished, exit code $JAYNES_STATUS")}
+exit $JAYNES_STATUS
+) &
+JAYNES_SETUP_PIDS+=($!)
+JAYNES_SETUP_LABELS+=({shlex.quote(label)})""" for label, script in steps]
+    return "JAYNES_SETUP_PIDS=()\nJAYNES_SETUP_LABELS=()" + "".join(blocks) + f"""
+# barrier: nothing runs before every setup step is done.
+JAYNES_SETUP_FAILED=0
+for i in "${{!JAYNES_SETUP_PIDS[@]}}"; do
+    if ! wait ${{JAYNES_SETUP_PIDS[$i]}}; then
+        echo "[jaynes] setup step failed: ${{JAYNES_SETUP_LABELS[$i]}}" >&2
+        JAYNES_SETUP_FAILED=1
+    fi
+done
+if [ $JAYNES_SETUP_FAILED != 0 ]; then
+{dedent(on_failure).strip()}
+exit 1
+fi
+{log_phase("host setup done")}
+"""
+
+
+def setup_steps(mounts=(), runners=(), on_failure=""):
+    """
+    the mount downloads and extractions and the runner prefetches, e.g. `docker pull`, as concurrent steps.
+
+    The prefetch of a runner with a `setup_script` is left out, since that setup may log in to the registry.
+    Those run after the runner setup instead, see :func:`late_prefetch`. A failed prefetch does not fail the
+    setup, the runner pulls the image again when it starts.
+    """
+    steps = [(f"{type(m).__name__} {getattr(m, 'host_path', '')}", m.host_setup)
+             for m in mounts if hasattr(m, "host_setup") and m.host_setup]
+    # the same image is only pulled once.
+    prefetch = {}
+    for r in runners:
+        if r.prefetch_script and not (r.setup_script or "").strip():
+            prefetch.setdefault(r.prefetch_script, f"{type(r).__name__} prefetch")
+    steps += [(label, f"{script} || true") for script, label in prefetch.items()]
+    return concurrent_steps(steps, on_failure=on_failure)
+
+
+def late_prefetch(runners=()):
+    """the prefetches of the runners with a `setup_script`, once each."""
+    scripts = {r.prefetch_script: None for r in runners if r.prefetch_script and (r.setup_script or "").strip()}
+    return "\n".join(scripts)
+
+
+def make_host_unpack_script(mounts: Sequence[Mount], launch_dir="/tmp/jaynes-mount", delay=None, root_config=None,
+                            runners=(), **_):
     """
 
     :param mounts:
     :param launch_dir:
     :param delay:
     :param root_config: a setup script **before** anything is ran.
+    :param runners: the runners' `prefetch_script`, e.g. `docker pull`, runs concurrently with the mounts.
     :param _:
     :return:
     """
@@ -54,9 +182,7 @@ def make_host_unpack_script(mounts: Sequence[Mount], launch_dir="/tmp/jaynes-mou
     log_path = os.path.join(launch_dir, "jaynes-launch.log")
     error_path = os.path.join(launch_dir, "jaynes-launch.err.log")
 
-    all_setup = "\n".join(
-        [m.host_setup for m in mounts if hasattr(m, "host_setup") and m.host_setup]
-    )
+    all_setup = setup_steps(mounts, runners)
 
     host_unpack_script = dedent(f"""
         #!/bin/bash
@@ -116,16 +242,6 @@ def make_launch_script(runners: Tuple[Runner],
     upload_script = '\n'.join(
         [m.upload_script for m in mounts if hasattr(m, "upload_script") and m.upload_script]
     )
-    # does not unpack if the self.host_unpack_script has already been generated.
-    if unpack_on_host:
-        host_unpack_script = "\n".join(
-            [m.host_setup for m in mounts if hasattr(m, "host_setup") and m.host_setup]
-        )
-    else:
-        host_unpack_script = ""
-    if instance_name:
-        assert len(instance_name) <= 128, "Error: ws limits instance tag to 128 unicode characters."
-
     # NOTE: path.join is running on local computer, so it might not be quite right if remote is say windows.
     # NOTE: dedent is required by aws EC2.
     terminate_commands = ""
@@ -137,13 +253,23 @@ def make_launch_script(runners: Tuple[Runner],
         else:
             raise NotImplementedError(f"terminate_after is not supported with {type}")
 
+    # does not unpack if the self.host_unpack_script has already been generated. Mount downloads and
+    # extractions run concurrently with each other and with the runner prefetch (docker pull). A failed step
+    # stops the launch, and still terminates the instance.
+    host_unpack_script = setup_steps(mounts if unpack_on_host else (), runners, on_failure=terminate_commands)
+    if instance_name:
+        assert len(instance_name) <= 128, "Error: ws limits instance tag to 128 unicode characters."
+
     setup_scripts = "\n".join([r.setup_script for r in runners])
     # note: add wait at the end to terminate process only after all launch scripts finish. Always blocking
     if len(runners) == 1:
         run_scripts = runners[0].run_script
     else:
         # todo: does not return the correct exit code.
-        run_scripts = "& \n".join([r.run_script for r in runners] + ["wait"])
+        # note: wait on the pids, a bare `wait` also waits for the `tee` process substitutions in bash>=5.1,
+        #   which only exit after this script does.
+        run_scripts = "".join(f"{r.run_script} &\nJAYNES_RUN_PIDS+=($!)\n" for r in runners) + \
+                      'for pid in "${JAYNES_RUN_PIDS[@]}"; do wait $pid; done'
     post_scripts = "\n".join([r.post_script for r in runners])
 
     return f"""
@@ -160,8 +286,11 @@ set +o posix
 # upload_script from within the host.
 {upload_script}
 # runner.setup script
+{log_phase("runner setup started") if setup_scripts.strip() else ""}
 {setup_scripts}
+{late_prefetch(runners)}
 # run script
+{log_phase("run started")}
 {run_scripts}
 # post script
 {post_scripts}
@@ -1,12 +1,21 @@
 import base64
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
 
+from jaynes.cache import boto3_client
 from jaynes.helpers import snake2camel
-from jaynes.launchers.base_launcher import Launcher, make_launch_script
-
+from jaynes.launchers.base_launcher import Launcher, make_launch_script, stage_launch_script, \
+    default_script_prefix, EC2_USER_DATA_LIMIT
+from jaynes.templates import launch_index_dispatch
 
 # "image_id instance_type key_name security_group spot_price iam_instance_profile_arn "
 # "verbose region availability_zone dry name tags"
 
+THROTTLING_ERRORS = ("RequestLimitExceeded", "Throttling", "ThrottlingException", "TooManyRequestsException")
+
 
 class EC2(Launcher):
     _instance_plan = None
@@ -24,31 +33,103 @@ class EC2(Launcher):
     def plan_instance(self, verbose=None):
         launch_script = make_launch_script(runners=self.runners, mounts=self.all_mounts,
                                            unpack_on_host=True, **self.config)
-        launch_config = self.runners[0].launch_config
+        plan = dict(launch_script=launch_script, **self.runners[0].launch_config)
+        if not plan.get("script_prefix"):
+            plan["script_prefix"] = default_script_prefix(self.all_mounts, "s3://")
         self.runners.clear()
 
         if verbose:
             print(launch_script)
 
-        self.instance_plan.append(dict(launch_script=launch_script, **launch_config))
+        self.instance_plan.append(plan)
 
     def execute(self, verbose=None):
+        """launches the planned instances. Plans with the same instance config go out as one multi-count
+        request, and the requests run concurrently on `launch_workers` threads (default 8).
+
+        :return: the instance ids, or spot request ids, in the order of the plans.
+        """
         self.plan_instance(verbose=verbose)
 
-        ids = []
-        for instance_config in self.instance_plan:
-            request_id = launch_ec2(**instance_config, verbose=verbose)
-            ids.append(request_id)
+        groups = group_plans(self.instance_plan)
+        ids = [None] * len(self.instance_plan)
+        workers = min(self.config.get("launch_workers", 8), len(groups))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jaynes-ec2") as pool:
+            futures = []
+            for indices in groups:
+                plan = dict(self.instance_plan[indices[0]],
+                            launch_script=group_script([self.instance_plan[i]["launch_script"] for i in indices]))
+                futures.append((pool.submit(request_instances, **plan, count=len(indices), verbose=verbose), indices))
+        errors = []
+        for future, indices in futures:
+            try:
+                for i, _id in zip(indices, future.result()):
+                    ids[i] = _id
+            except Exception as e:
+                errors.append((indices, e))
 
         self.instance_plan.clear()
+        if errors:
+            launched = [_id for _id in ids if _id is not None]
+            raise RuntimeError(f"{sum(len(i) for i, _ in errors)} of {len(ids)} instances failed to launch, "
+                               f"launched: {launched}") from errors[0][1]
         return ids
 
 
-def launch_ec2(launch_script, image_id, instance_type, key_name, security_group, spot_price=None,
-               iam_instance_profile_arn=None, region=None, availability_zone=None,
-               dry=False, name=None, tags={}, verbose=False, **_):
+def group_plans(plans):
+    """
+    indices of the instance plans that only differ by their launch script, in the order of their first
+    occurrence. Each instance of the request then runs its own script, see :func:`group_script`.
+
+    Spot instances are launched one by one, each with an `ami-launch-index` of 0, so spot plans with
+    different launch scripts each get their own request.
+    """
+    groups = {}
+    for i, plan in enumerate(plans):
+        config = plan if plan.get("spot_price") else {k: v for k, v in plan.items() if k != "launch_script"}
+        key = json.dumps(config, sort_keys=True, default=str)
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def group_script(launch_scripts):
+    """the user data of a request for the instances with these launch scripts, in the order of the launch index."""
+    if len(set(launch_scripts)) == 1:
+        return launch_scripts[0]
+    return launch_index_dispatch(launch_scripts)
+
+
+def ec2_client(region=None):
+    """all launches to a region share one client, see `jaynes.cache.boto3_client`."""
+    return boto3_client("ec2", region)
+
+
+def with_retry(fn, *args, retries=8, base_delay=0.5, max_delay=20, **kwargs):
+    """calls `fn`, and retries with exponential backoff and full jitter when the API throttles the request."""
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            code = (getattr(e, "response", None) or {}).get("Error", {}).get("Code")
+            if code not in THROTTLING_ERRORS or attempt == retries:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+def request_instances(launch_script, image_id, instance_type, key_name, security_group, spot_price=None,
+                      iam_instance_profile_arn=None, region=None, availability_zone=None,
+                      dry=False, name=None, tags={}, count=1, client=None, script_prefix=None,
+                      script_url_expires=7 * 24 * 3600, client_token=None, verbose=False, **_):
+    """launches `count` instances with one request. Tags are set inline with `TagSpecifications`.
+
+    :param client: the boto3 ec2 client. Defaults to the shared client of the region.
+    :param client_token: makes the request idempotent, so that retries after throttling or a dropped
+                         connection do not launch the instances twice. Defaults to a new uuid4 per call.
+    :param script_prefix: s3:// prefix for launch scripts over the 16KB user data limit. The user data is then
+                          a stub that downloads and verifies the script. See `stage_launch_script`.
+    :return: the list of instance ids, or of spot request ids when `spot_price` is set.
+    """
     from termcolor import cprint
-    import boto3
     if verbose:
         print('Using the default AWS Profile')
 
@@ -63,8 +144,12 @@ def launch_ec2(launch_script, image_id, instance_type, key_name, security_group,
         tags["Name"] = name
     tag_str = [dict(Key=k, Value=v) for k, v in tags.items()]
 
+    launch_script = stage_launch_script(launch_script, EC2_USER_DATA_LIMIT, script_prefix, script_url_expires)
+
     # note: region needs to agree with availability_zone.
-    ec2 = boto3.client("ec2", region_name=region)
+    ec2 = client or ec2_client(region)
+    # the same token on every retry.
+    client_token = client_token or str(uuid4())
     if spot_price:
         # for detailed settings see:
         #     http://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.request_spot_instances
@@ -72,26 +157,32 @@ def launch_ec2(launch_script, image_id, instance_type, key_name, security_group,
         instance_config.update(UserData=base64.b64encode(launch_script.encode()).decode("utf-8"))
         if verbose:
             print(instance_config)
-        response = ec2.request_spot_instances(
-            InstanceCount=1, LaunchSpecification=instance_config,
-            SpotPrice=str(spot_price), DryRun=dry)
-        spot_request_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
+        tag_spec = dict(TagSpecifications=[dict(ResourceType="spot-instances-request", Tags=tag_str)]) if tags else {}
+        response = with_retry(ec2.request_spot_instances, InstanceCount=count, LaunchSpecification=instance_config,
+                              SpotPrice=str(spot_price), DryRun=dry, ClientToken=client_token, **tag_spec)
+        spot_request_ids = [r['SpotInstanceRequestId'] for r in response['SpotInstanceRequests']]
         if verbose:
             import yaml
             print(yaml.dump(response))
-        if tags:
-            ec2.create_tags(DryRun=dry, Resources=[spot_request_id], Tags=tag_str)
-        cprint(f'made instance request {spot_request_id}', 'blue')
-        return spot_request_id
+        cprint(f'made instance request {", ".join(spot_request_ids)}', 'blue')
+        return spot_request_ids
     else:
         instance_config.update(UserData=launch_script)
         if verbose:
             print(instance_config)
-        response = ec2.run_instances(MaxCount=1, MinCount=1, **instance_config, DryRun=dry)
-        instance_id = response['Instances'][0]['InstanceId']
+        tag_spec = dict(TagSpecifications=[dict(ResourceType="instance", Tags=tag_str)]) if tags else {}
+        response = with_retry(ec2.run_instances, MaxCount=count, MinCount=count, **instance_config, DryRun=dry,
+                              ClientToken=client_token, **tag_spec)
+        # in the order of the launch index, which picks the launch script of the instance.
+        instances = sorted(response['Instances'], key=lambda i: i.get('AmiLaunchIndex', 0))
+        instance_ids = [i['InstanceId'] for i in instances]
         if verbose:
             print(response)
-        if tags:
-            ec2.create_tags(DryRun=dry, Resources=[instance_id], Tags=tag_str)
-        cprint(f'launched instance {instance_id}', 'green')
-        return instance_id
+        cprint(f'launched instance {", ".join(instance_ids)}', 'green')
+        return instance_ids
+
+
+def launch_ec2(*args, **kwargs):
+    """launches a single instance. Returns the instance id, or the spot request id."""
+    _id, = request_instances(*args, count=1, **kwargs)
+    return _id
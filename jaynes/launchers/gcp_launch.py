@@ -1,33 +1,187 @@
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from uuid import uuid4
 
 import jaynes
-from jaynes.helpers import memoize
-from jaynes.launchers.base_launcher import Launcher, make_launch_script
+from jaynes.cache import DiskCache, google_client
+from jaynes.launchers.base_launcher import Launcher, make_launch_script, stage_launch_script, \
+    default_script_prefix, GCE_METADATA_LIMIT
 from jaynes.runners import Runner
+from jaynes.templates import gzip_base64, instance_name_dispatch
 
+# the most calls the compute API accepts in one batch request.
+GCE_BATCH_LIMIT = 1000
+RETRY_STATUS = (429, 500, 502, 503, 504)
 
-def launch_gcp(launch_scripts, **kws):
-    import googleapiclient.discovery
-
-    compute = googleapiclient.discovery.build('compute', 'v1')
-    # todo: there is a way to do this in batch mode that is a lot faster.
-
-    batch_request = compute.new_batch_http_request()
-    for ls in launch_scripts:
-        instance_config = gce_instance_config(ls, **kws)
-        batch_request.instances().insert(**instance_config)
 
-    batch_request.execute()['id']
-
-
-@memoize
+def launch_gcp(launch_scripts, **kws):
+    """launches one instance per launch script, and returns their insert operation ids."""
+    return insert_instances([gce_instance_config(ls, **kws) for ls in launch_scripts])
+
+
+def compute_client():
+    """the compute api client of this thread, see `jaynes.cache.google_client`."""
+    return google_client('compute', 'v1')
+
+
+def startup_script(body):
+    """the startup-script in the metadata of an instance body, or None."""
+    items = body.get('metadata', {}).get('items', [])
+    return next((item['value'] for item in items if item['key'] == 'startup-script'), None)
+
+
+def instance_properties(body):
+    """the instance body without its name and startup-script, which differ between the instances of a sweep."""
+    properties = {k: v for k, v in body.items() if k != 'name'}
+    if 'metadata' in body:
+        items = [item for item in body['metadata'].get('items', []) if item['key'] != 'startup-script']
+        properties['metadata'] = dict(body['metadata'], items=items)
+    return properties
+
+
+def group_configs(instance_configs, limit=GCE_METADATA_LIMIT):
+    """
+    indices of the instance configs that only differ by their unique names and their startup-scripts, in the
+    order of first occurrence. The startup-scripts of a group are embedded in one, see `bulk_insert_config`,
+    so groups are split to keep that under `limit` bytes.
+    """
+    groups = {}
+    for i, config in enumerate(instance_configs):
+        key = json.dumps(dict(config, body=instance_properties(config['body'])), sort_keys=True, default=str)
+        groups.setdefault(key, []).append(i)
+    split = []
+    for indices in groups.values():
+        # bulkInsert needs unique instance names.
+        if len({instance_configs[i]['body']['name'] for i in indices}) < len(indices):
+            split.extend([i] for i in indices)
+            continue
+        chunk, size = [], 0
+        for i in indices:
+            script = startup_script(instance_configs[i]['body']) or ""
+            # the embedded script, and its case in the dispatch script.
+            script_size = len(gzip_base64(script)) + 128
+            if chunk and size + script_size > limit:
+                split.append(chunk)
+                chunk, size = [], 0
+            chunk.append(i)
+            size += script_size
+        split.append(chunk)
+    return split
+
+
+def bulk_insert_config(instance_configs):
+    """
+    one `instances.bulkInsert` request for instance configs that only differ by name and startup-script.
+    `perInstanceProperties` only take a name, so different startup-scripts are sent as one that picks the
+    script by the name of the instance, see `jaynes.templates.instance_name_dispatch`.
+    """
+    project, zone, body = instance_configs[0]['project'], instance_configs[0]['zone'], instance_configs[0]['body']
+    properties = instance_properties(body)
+    # instance properties take resource names instead of zonal urls.
+    properties['machineType'] = body['machineType'].split('/')[-1]
+    if 'guestAccelerators' in body:
+        properties['guestAccelerators'] = [dict(a, acceleratorType=a['acceleratorType'].split('/')[-1])
+                                           for a in body['guestAccelerators']]
+    scripts = {c['body']['name']: startup_script(c['body']) for c in instance_configs}
+    if any(script is not None for script in scripts.values()):
+        if len(set(scripts.values())) > 1:
+            script = instance_name_dispatch({name: script or "" for name, script in scripts.items()})
+        else:
+            script = startup_script(body)
+        items = [dict(key='startup-script', value=script), *properties['metadata']['items']]
+        properties['metadata'] = dict(properties['metadata'], items=items)
+    return dict(project=project, zone=zone, body={
+        'count': len(scripts),
+        'minCount': len(scripts),
+        'perInstanceProperties': {name: {} for name in scripts},
+        'instanceProperties': properties,
+    })
+
+
+def _retryable(e):
+    status = getattr(getattr(e, "resp", None), "status", None)
+    # transport errors carry no response, and are retried as well.
+    return status is None or int(status) in RETRY_STATUS
+
+
+def _execute_batch(calls):
+    """sends the (method, kwargs) calls in one batch request. Returns a list of operation ids or exceptions."""
+    compute = compute_client()
+    results = [None] * len(calls)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = exception or response['id']
+
+    batch = compute.new_batch_http_request()
+    for i, (method, kwargs) in enumerate(calls):
+        batch.add(getattr(compute.instances(), method)(**kwargs), callback=callback, request_id=str(i))
+    try:
+        batch.execute()
+    except Exception as e:
+        results = [r if r is not None else e for r in results]
+    return results
+
+
+def insert_instances(instance_configs, bulk=True, batch_size=100, workers=8, retries=5, base_delay=1,
+                     max_delay=30, verbose=False):
+    """
+    inserts the instances in batch requests of `batch_size` calls, sent concurrently on `workers` threads.
+    Calls that fail with a rate limit or a server error are retried in a new batch, with exponential backoff
+    and full jitter.
+
+    :param instance_configs: the outputs of `gce_instance_config`
+    :param bulk: insert instance configs that only differ by name and startup-script with a single `bulkInsert`
+                 call, see `bulk_insert_config`.
+    :param batch_size: the calls per batch request, at most GCE_BATCH_LIMIT.
+    :return: the insert operation ids, in the order of `instance_configs`. Instances inserted together with
+             `bulkInsert` share the id of the bulk operation.
+    """
+    from termcolor import cprint
+
+    assert batch_size <= GCE_BATCH_LIMIT, f"the compute API takes at most {GCE_BATCH_LIMIT} calls per batch."
+    if not instance_configs:
+        return []
+    groups = group_configs(instance_configs) if bulk else [[i] for i in range(len(instance_configs))]
+    calls = [("bulkInsert", bulk_insert_config([instance_configs[i] for i in indices])) if len(indices) > 1
+             else ("insert", instance_configs[indices[0]]) for indices in groups]
+    # a retried call keeps its requestId, so the API does not insert twice when the first attempt went through.
+    calls = [(method, dict(kwargs, requestId=str(uuid4()))) for method, kwargs in calls]
+
+    results, pending = [None] * len(calls), list(range(len(calls)))
+    for attempt in range(retries + 1):
+        chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        with ThreadPoolExecutor(max_workers=min(workers, len(chunks)), thread_name_prefix="jaynes-gce") as pool:
+            for chunk, chunk_results in zip(chunks, pool.map(_execute_batch, [[calls[j] for j in c] for c in chunks])):
+                for j, result in zip(chunk, chunk_results):
+                    results[j] = result
+        pending = [j for j in pending if isinstance(results[j], Exception) and _retryable(results[j])]
+        if not pending or attempt == retries:
+            break
+        if verbose:
+            print(f"retrying {len(pending)} of {len(calls)} insert calls")
+        time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+    ids = [None] * len(instance_configs)
+    errors = []
+    for indices, result in zip(groups, results):
+        for i in indices:
+            ids[i] = result
+        if isinstance(result, Exception):
+            errors.append((indices, result))
+    if errors:
+        launched = [_id for _id in ids if not isinstance(_id, Exception)]
+        raise RuntimeError(f"{sum(len(i) for i, _ in errors)} of {len(ids)} instances failed to launch, "
+                           f"launched operations: {launched}") from errors[0][1]
+    cprint(f'launched {len(ids)} instances in {len(calls)} calls', 'green')
+    return ids
+
+
+@DiskCache("gce-images", ttl=3600)
 def get_image_id(image_project, image_family):
-    import googleapiclient.discovery
-
-    compute = googleapiclient.discovery.build('compute', 'v1')
-
-    image_response = compute.images().getFromFamily(project=image_project, family=image_family).execute()
+    image_response = compute_client().images().getFromFamily(project=image_project, family=image_family).execute()
     image_id = image_response['selfLink']
     return image_id
 
@@ -35,11 +189,17 @@ def get_image_id(image_project, image_family):
 def gce_instance_config(launch_script, project_id, zone, instance_type, image_id=None,
                         image_project='deeplearning-platform-release', image_family='pytorch-latest-gpu',
                         accelerator_type=None, accelerator_count=None,
-                        preemptible=False, boot_size=60,
+                        preemptible=False, boot_size=60, script_prefix=None,
                         verbose=False, name=f"jaynes-job-{uuid4()}", tags={}, **_):
+    """
+    :param script_prefix: gs:// prefix for launch scripts over the 256KB metadata limit. The startup-script is
+                          then a stub that downloads and verifies the script. See `stage_launch_script`.
+    """
     if verbose:
         print('Using the default GCLoud Profile')
 
+    launch_script = stage_launch_script(launch_script, GCE_METADATA_LIMIT, script_prefix)
+
     image_id = image_id or get_image_id(image_project, image_family)
 
     import re
@@ -129,52 +289,78 @@ class GCE(Launcher):
         # cache the launch config
         runner.launch_config = self.config.copy()
 
-    _gce_batch_request = None
+    _instance_plan = None
 
     @property
-    def gce_batch_request(self):
-        if self._gce_batch_request is None:
-            import googleapiclient.discovery
-
-            compute = googleapiclient.discovery.build('compute', 'v1')
-            # todo: there is a way to do this in batch mode that is a lot faster.
-            self._gce_batch_request = compute.new_batch_http_request()
+    def instance_plan(self):
+        if self._instance_plan is None:
+            self._instance_plan = []
+        return self._instance_plan
 
-        return self._gce_batch_request
-
-    def launch_instance(self, verbose=None):
+    def _instance_config(self, verbose=None):
         launch_script = make_launch_script(runners=self.runners, mounts=self.all_mounts,
                                            unpack_on_host=True, **self.config)
         launch_config = self.runners[0].launch_config
+        if not launch_config.get("script_prefix"):
+            launch_config = dict(launch_config, script_prefix=default_script_prefix(self.all_mounts, "gs://"))
         self.runners.clear()
 
         if verbose:
             print(launch_script)
 
-        import googleapiclient.discovery
-        compute = googleapiclient.discovery.build('compute', 'v1')
-        instance_config = gce_instance_config(launch_script, **launch_config)
-        request = compute.instances().insert(**instance_config)
+        return gce_instance_config(launch_script, **launch_config)
 
-        return request.execute()['id']
+    def launch_instance(self, verbose=None, wait=False):
+        instance_config = self._instance_config(verbose=verbose)
+        request = compute_client().instances().insert(**instance_config)
 
-    def plan_instance(self, verbose=None):
-        launch_script = make_launch_script(runners=self.runners, mounts=self.all_mounts,
-                                           unpack_on_host=True, **self.config)
-        launch_config = self.runners[0].launch_config
-        self.runners.clear()
+        _id = request.execute()['id']
+        if wait:
+            wait_for_instances([instance_config], [_id], verbose=verbose)
+        return _id
 
-        if verbose:
-            print(launch_script)
-
-        import googleapiclient.discovery
-        compute = googleapiclient.discovery.build('compute', 'v1')
-        instance_config = gce_instance_config(launch_script, **launch_config)
-        self.gce_batch_request.add(compute.instances().insert(**instance_config))
-
-    def execute(self, verbose=None):
-        if self._gce_batch_request is None:
-            return self.launch_instance(verbose=verbose)
+    def plan_instance(self, verbose=None):
+        self.instance_plan.append(self._instance_config(verbose=verbose))
+
+    def execute(self, verbose=None, wait=None):
+        """
+        launches the planned instances with `insert_instances`. Takes the `batch_size`, `launch_workers` and
+        `bulk_insert` options from the launcher config.
+
+        :param wait: block until every instance is RUNNING. Defaults to the `wait` option of the launcher config.
+        :return: the insert operation ids in the order of the plans, or the single id when nothing was planned.
+        """
+        wait = self.config.get("wait", False) if wait is None else wait
+        if not self.instance_plan:
+            return self.launch_instance(verbose=verbose, wait=wait)
         self.plan_instance(verbose=verbose)
-        # todo: needs to return a list of request_ids.
-        self.gce_batch_request.execute()
+        try:
+            ids = insert_instances(self.instance_plan, bulk=self.config.get("bulk_insert", True),
+                                   batch_size=self.config.get("batch_size", 100),
+                                   workers=self.config.get("launch_workers", 8), verbose=verbose)
+            if wait:
+                wait_for_instances(self.instance_plan, ids, verbose=verbose)
+            return ids
+        finally:
+            self.instance_plan.clear()
+
+
+def wait_for_instances(instance_configs, operation_ids, timeout=None, verbose=False):
+    """waits for the insert operations, and then for each instance to be RUNNING, with one `OperationWaiter`."""
+    from collections import defaultdict
+    from jaynes.gce_utils import OperationWaiter
+
+    waiter = OperationWaiter(compute_client(), verbose=verbose)
+    instances = defaultdict(list)
+    for config, _id in zip(instance_configs, operation_ids):
+        instances[config['project'], config['zone'], _id].append(config['body']['name'])
+
+    for (project, zone, _id), names in instances.items():
+        def on_done(result, project=project, zone=zone, names=names):
+            # None when polling the operation failed, e.g. with a 404. The waiter keeps that error.
+            if result and 'error' not in result:
+                for name in names:
+                    waiter.add_instance(project, zone, name)
+
+        waiter.add(project, zone, _id, callback=on_done)
+    return waiter.wait(timeout=timeout)
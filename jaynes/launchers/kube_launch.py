@@ -1,19 +1,219 @@
-from datetime import datetime
+import heapq
+import itertools
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from uuid import uuid4
 
 import jaynes
 from jaynes.launchers.base_launcher import Launcher, make_launch_script
 from jaynes.runners import Runner
 
 
+SWEEP_LABEL = "jaynes/sweep"
+
+
+def job_finished(job):
+    """whether the Job object has a Complete or Failed condition."""
+    conditions = (job.get("status") or {}).get("conditions") or ()
+    return any(c["type"] in ("Complete", "Failed") and c["status"] == "True" for c in conditions)
+
+
+class AdmissionQueue:
+    """
+    Keeps at most `max_active` unfinished jobs of a sweep on the cluster. The other jobs wait in a local
+    priority queue, and are released as a watch on the sweep label reports the earlier ones finished.
+
+    :param client: a `jaynes.kube_client.KubeClient`
+    :param label_selector: selects the jobs of the sweep, e.g. "jaynes/sweep=2021-sweep"
+    :param max_active: the most unfinished jobs on the cluster at a time.
+    """
+
+    def __init__(self, client, label_selector, max_active, namespace=None, workers=16, verbose=False):
+        self.client = client
+        self.label_selector = label_selector
+        self.max_active = max_active
+        self.namespace = namespace
+        self.workers = workers
+        self.verbose = verbose
+        self.heap = []
+        self.counter = itertools.count()
+        self.active = set()
+        self.created = []
+
+    def push(self, job, priority=0):
+        """jobs with a higher priority are released first, and jobs of the same priority in order."""
+        heapq.heappush(self.heap, (-priority, next(self.counter), job))
+
+    def release(self):
+        """
+        creates the queued jobs that fit under `max_active`. When some fail, the others are still recorded in
+        `created`, and the failed jobs go back in the queue before the error is raised.
+        """
+        n = min(self.max_active - len(self.active), len(self.heap))
+        if n <= 0:
+            return
+        entries = [heapq.heappop(self.heap) for _ in range(n)]
+        jobs = [entry[-1] for entry in entries]
+        try:
+            created = self.client.create_jobs(jobs, namespace=self.namespace, workers=self.workers,
+                                              verbose=self.verbose)
+        except Exception as e:
+            created = getattr(e, "created", None) or [None] * len(jobs)
+            for entry, c in zip(entries, created):
+                if c is None:
+                    heapq.heappush(self.heap, entry)
+            self.record([c for c in created if c])
+            raise
+        self.record(created)
+
+    def record(self, created):
+        self.active.update(c["uid"] for c in created)
+        self.created.extend(created)
+        if self.verbose:
+            print(f"{len(self.active)} jobs active, {len(self.heap)} queued")
+
+    def run(self):
+        """blocks until every queued job is released. Returns the dict(name, uid) of the jobs in release order."""
+        if not self.heap:
+            return self.created
+        for kind, obj in self.client.stream_jobs(self.namespace, self.label_selector):
+            if kind == "SYNC":
+                self.active = {j["metadata"]["uid"] for j in obj if not job_finished(j)}
+            elif kind == "DELETED" or job_finished(obj):
+                self.active.discard(obj["metadata"]["uid"])
+            else:
+                self.active.add(obj["metadata"]["uid"])
+            self.release()
+            if not self.heap:
+                break
+        return self.created
+
+
+def job_state(job):
+    """one of "succeeded", "failed", "running" or "pending"."""
+    status = job.get("status") or {}
+    for c in status.get("conditions") or ():
+        if c["status"] == "True" and c["type"] == "Complete":
+            return "succeeded"
+        if c["status"] == "True" and c["type"] == "Failed":
+            return "failed"
+    return "running" if status.get("active") else "pending"
+
+
+def _parse_time(timestamp):
+    return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+
+def job_duration(job, now=None):
+    """seconds from the start of the job until it finished, or until `now` while it runs. None before it starts."""
+    status = job.get("status") or {}
+    if not status.get("startTime"):
+        return None
+    end = status.get("completionTime")
+    for c in status.get("conditions") or ():
+        if c["status"] == "True" and c["type"] == "Failed":
+            end = end or c.get("lastTransitionTime")
+    end = _parse_time(end) if end else now or datetime.now(timezone.utc)
+    return (end - _parse_time(status["startTime"])).total_seconds()
+
+
+class SweepTracker:
+    """
+    Follows the jobs of a sweep with a watch on the sweep label, and reports how many succeeded, failed,
+    are running and are pending, along with the duration of each job.
+
+    :param client: a `jaynes.kube_client.KubeClient`
+    :param sweep: the value of the sweep label
+    :param expected: the number of jobs in the sweep. The sweep is only done once this many have finished,
+                     or were deleted before they finished.
+    """
+
+    def __init__(self, client, sweep, namespace=None, expected=None, verbose=True):
+        self.client = client
+        self.sweep = sweep
+        self.namespace = namespace
+        self.expected = expected
+        self.verbose = verbose
+        # name -> the last seen Job object. Finished jobs stay after they are deleted, e.g. by
+        # `ttlSecondsAfterFinished`.
+        self.jobs = {}
+        # names of the jobs deleted before they finished.
+        self.deleted = set()
+
+    def update(self, kind, obj):
+        if kind == "SYNC":
+            finished = {name: j for name, j in self.jobs.items() if job_finished(j)}
+            self.jobs = {**finished, **{j["metadata"]["name"]: j for j in obj}}
+        elif kind == "DELETED":
+            name = obj["metadata"]["name"]
+            if job_finished(obj):
+                self.jobs[name] = obj
+            elif not job_finished(self.jobs.get(name, {})):
+                self.jobs.pop(name, None)
+                self.deleted.add(name)
+        else:
+            self.jobs[obj["metadata"]["name"]] = obj
+
+    def counts(self):
+        counts = Counter(job_state(j) for j in self.jobs.values())
+        counts["deleted"] = len(self.deleted)
+        return {state: counts[state] for state in ("succeeded", "failed", "running", "pending", "deleted")}
+
+    def durations(self):
+        """seconds each job ran, see `job_duration`."""
+        now = datetime.now(timezone.utc)
+        return {name: job_duration(job, now) for name, job in self.jobs.items()}
+
+    @property
+    def done(self):
+        counts = self.counts()
+        finished = counts["succeeded"] + counts["failed"]
+        # a sweep with all its jobs deleted before they finished is done as well.
+        return bool(self.jobs or self.deleted) and finished == len(self.jobs) and finished + counts["deleted"] >= (self.expected or 0)
+
+    def report(self):
+        counts = self.counts()
+        return f"sweep {self.sweep}: " + ", ".join(f"{n} {state}" for state, n in counts.items())
+
+    def run(self, timeout=None):
+        """
+        blocks until every job of the sweep finished, printing the counts as they change.
+
+        :param timeout: seconds to follow the sweep for, also when no job changes in the meantime.
+        :return: the counts of the jobs in each state.
+        """
+        from termcolor import cprint
+
+        deadline = None if timeout is None else time.time() + timeout
+        last = None
+        for kind, obj in self.client.stream_jobs(self.namespace, f"{SWEEP_LABEL}={self.sweep}", deadline=deadline):
+            self.update(kind, obj)
+            if self.verbose and self.report() != last:
+                last = self.report()
+                cprint(last, "blue")
+            if self.done:
+                break
+        return self.counts()
+
+
 class Kube(Launcher):
     jobs = None
-    def __init__(self, namespace=None, verbose=False, name=None, tags={}, **_):
+    priorities = None
+    sweep = None
+    # the number of jobs of the sweep submitted so far.
+    submitted = 0
+
+    def __init__(self, namespace=None, verbose=False, name=None, tags={}, sweep=None, **_):
         super().__init__(namespace=namespace,
                          verbose=verbose,
                          name=name or f"jaynes-job-{datetime.utcnow():%H%M%S}-{jaynes.RUN.count}",
-                         tags=tags, **_)
+                         tags=tags, sweep=sweep, **_)
         if self.jobs is None:
             self.jobs = []
+            self.priorities = []
+        # all jobs of this launcher carry the sweep label, which the admission queue watches.
+        self.sweep = sweep or self.sweep or f"{datetime.utcnow():%Y%m%d-%H%M%S}-{uuid4().hex[:6]}"
 
     def add_runner(self, runner: Runner):
         """Adds a job/Pod to the list of jobs to launch"""
@@ -26,15 +226,57 @@ class Kube(Launcher):
         while self.last_runner:
             runner = self.runners.pop(-1)
             runner.job["metadata"]["namespace"] = runner.launch_config["namespace"]
+            runner.job["metadata"].setdefault("labels", {})[SWEEP_LABEL] = self.sweep
             self.jobs.append(runner.job)
+            self.priorities.append(runner.launch_config.get("priority", 0))
 
             if verbose:
                 print(runner.job)
 
     def execute(self, verbose=None):
-        import yaml
+        """
+        submits the planned jobs. By default, POSTs them to the API server with `jaynes.kube_client`, on
+        `submit_workers` threads (default 16), using the `kubeconfig` and `context` launch options.
+        With `submit: kubectl`, applies them with `kubectl apply` instead.
+
+        With the `max_active_jobs` launch option, at most that many jobs of the sweep run or wait on the
+        cluster at a time. The rest stay in a local queue, ordered by the `priority` launch option (higher
+        first), and this call blocks until the last of them is submitted.
+
+        :return: the dict(name, uid) of each job, or the output of kubectl.
+        """
         self.plan_instance(verbose=verbose)
+        self.submitted += len(self.jobs)
+        if self.config.get("submit", "api") == "kubectl":
+            self.priorities.clear()
+            return self.kubectl_apply(verbose=verbose)
+
+        from jaynes.kube_client import kube_client
 
+        client = kube_client(self.config.get("kubeconfig"), self.config.get("context"))
+        jobs, priorities, self.jobs, self.priorities = self.jobs, self.priorities, [], []
+        workers = self.config.get("submit_workers", 16)
+        max_active = self.config.get("max_active_jobs")
+        if not max_active:
+            return client.create_jobs(jobs, namespace=self.config.get("namespace"), workers=workers, verbose=verbose)
+
+        queue = AdmissionQueue(client, f"{SWEEP_LABEL}={self.sweep}", max_active,
+                               namespace=self.config.get("namespace"), workers=workers, verbose=verbose)
+        for job, priority in zip(jobs, priorities):
+            queue.push(job, priority)
+        return queue.run()
+
+    def track(self, timeout=None, verbose=True):
+        """follows the submitted jobs of the sweep until they finish, see `SweepTracker`."""
+        from jaynes.kube_client import kube_client
+
+        client = kube_client(self.config.get("kubeconfig"), self.config.get("context"))
+        tracker = SweepTracker(client, self.sweep, namespace=self.config.get("namespace"),
+                               expected=self.submitted, verbose=verbose)
+        return tracker.run(timeout=timeout)
+
+    def kubectl_apply(self, verbose=None):
+        import yaml
         from tempfile import NamedTemporaryFile
 
         # packing all jobs into one request and launch
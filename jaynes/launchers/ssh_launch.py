@@ -6,12 +6,13 @@ from textwrap import dedent
 from jaynes.helpers import omit
 from jaynes.launchers.base_launcher import Launcher, make_host_unpack_script, make_launch_script
 from jaynes.shell import check_call
+from jaynes.ssh_control import get_control_master
 from jaynes.templates import ssh_remote_exec
 
 
 def ssh(script, ip, port=None, username="ubuntu", pem=None, profile=None,
         password=None, sudo=False, cleanup=True, block=False, console_mode=False, dry=False,
-        verbose=False, **_):
+        multiplex=True, verbose=False, **_):
     """
     run launch_script remotely by ip_address. First saves the run script locally as a file, then use
     scp to transfer the script to remote instance then run.
@@ -28,6 +29,7 @@ def ssh(script, ip, port=None, username="ubuntu", pem=None, profile=None,
                     pass in a different user name. This is inserted in the ssh boostrapping command, so the script
                     you run will not be affected (and will take up this user's login envs instead).
     :param password: The password for the user in case it is needed.
+    :param multiplex: run over the shared ControlMaster connection to the host, see `jaynes.ssh_control`.
     :param dry:
     :param verbose:
     :return:
@@ -47,12 +49,19 @@ def ssh(script, ip, port=None, username="ubuntu", pem=None, profile=None,
         f.write(script + cleanup_script if cleanup else "")
     tf.file.close()
 
+    control = None
+    if multiplex:
+        control = get_control_master(username, ip, port=port, pem=pem, password=password,
+                                     ssh_options="-o StrictHostKeyChecking=no")
+        # the sessions reuse the authentication of the master. Without one, they log in on their own.
+        if not dry and not control.start(verbose=verbose):
+            control = None
     prelaunch_upload_script, launch = ssh_remote_exec(username, ip, tf.name,
                                                       port=port, pem=pem,
                                                       profile=profile,
                                                       password=password,
                                                       require_password=(profile is not None),
-                                                      sudo=sudo)
+                                                      sudo=sudo, control=control)
 
     # todo: use pipe back to send binary from RPC calls
     if dry:
@@ -102,7 +111,7 @@ class SSH(Launcher):
             return
         self.host_unpacked = True
 
-        unpack_script = make_host_unpack_script(mounts=self.all_mounts, **self.config)
+        unpack_script = make_host_unpack_script(mounts=self.all_mounts, runners=self.runners, **self.config)
 
         if verbose:
             print('Unpacking On Remote')
@@ -0,0 +1,232 @@
+"""
+A launcher that spreads the runners over a pool of SSH hosts.
+
+Before each launch, the hosts are probed concurrently over SSH for their free GPUs, available memory and load
+average. Each runner then goes to the least loaded host that still has a free slot, and the runners that land
+on the same host are packed into one launch script. Probe results are cached for `probe_ttl` seconds, and the
+jobs placed since a probe count against the capacity it reported.
+
+.. code:: yaml
+
+    launch:
+      type: ssh_pool
+      username: ubuntu
+      pem: ~/.ssh/lab.pem
+      max_jobs: 2
+      gpus_per_job: 1
+      hosts:
+        - ip: visiongpu01
+        - ip: visiongpu02
+          max_jobs: 4
+        - ip: 10.0.0.12
+          username: lab
+"""
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jaynes.launchers.base_launcher import Launcher, make_launch_script
+from jaynes.launchers.ssh_launch import ssh
+from jaynes.ssh_control import get_control_master
+
+# a GPU with less memory in use, and a lower utilization, counts as free.
+FREE_GPU_MEMORY = 0.05
+FREE_GPU_UTILIZATION = 10
+
+PROBE_SCRIPT = """
+nvidia-smi --query-gpu=index,memory.used,memory.total,utilization.gpu --format=csv,noheader,nounits 2>/dev/null
+echo ---
+cat /proc/loadavg
+nproc
+awk '/MemAvailable/ {print int($2 / 1024)}' /proc/meminfo
+"""
+
+
+def parse_probe(output):
+    """
+    parses the output of PROBE_SCRIPT.
+
+    :return: dictionary with the `gpus` count, the indices of the `free_gpus`, the 1-minute `load` per cpu,
+             the `cpus` count, and the available memory `mem_free` in MB.
+    """
+    gpu_lines, _, rest = output.partition("---")
+    gpus, free_gpus = 0, []
+    for line in gpu_lines.strip().splitlines():
+        try:
+            index, used, total, utilization = [float(v) for v in line.split(",")]
+        except ValueError:
+            continue
+        gpus += 1
+        if used <= FREE_GPU_MEMORY * total and utilization < FREE_GPU_UTILIZATION:
+            free_gpus.append(int(index))
+    loadavg, cpus, mem_free = rest.strip().splitlines()[:3]
+    cpus = int(cpus)
+    return dict(gpus=gpus, free_gpus=free_gpus, load=float(loadavg.split()[0]) / cpus, cpus=cpus,
+                mem_free=int(mem_free))
+
+
+def probe_host(ip, username="ubuntu", port=None, pem=None, password=None, timeout=10, **_):
+    """runs PROBE_SCRIPT on the host. Returns None when the host can not be reached."""
+    control = get_control_master(username, ip, port=port, pem=pem, password=password,
+                                 ssh_options="-o StrictHostKeyChecking=no")
+    control.start()
+    cmd = f"ssh {control.options} -o BatchMode=yes -o ConnectTimeout={timeout} -o StrictHostKeyChecking=no " \
+          f"{control.target} bash -s"
+    try:
+        p = subprocess.run(cmd, shell=True, input=PROBE_SCRIPT, capture_output=True, text=True, timeout=3 * timeout)
+        return parse_probe(p.stdout) if p.returncode == 0 else None
+    except (subprocess.TimeoutExpired, ValueError):
+        return None
+
+
+def remaining(status, placed, gpus_per_job=0, memory_per_job=0):
+    """the probed `status`, minus the GPUs and the memory of the jobs placed on the host since the probe."""
+    if status is None or not placed:
+        return status
+    return dict(status, free_gpus=status['free_gpus'][placed * gpus_per_job:],
+                mem_free=status['mem_free'] - placed * memory_per_job)
+
+
+def capacity(status, max_jobs=1, gpus_per_job=0, memory_per_job=0, max_load=None):
+    """the number of jobs a host with the probed `status` can take."""
+    if status is None or (max_load is not None and status['load'] > max_load):
+        return 0
+    slots = max_jobs
+    if gpus_per_job:
+        slots = min(slots, len(status['free_gpus']) // gpus_per_job)
+    if memory_per_job:
+        slots = min(slots, status['mem_free'] // memory_per_job)
+    return max(slots, 0)
+
+
+def pack(n, statuses, caps):
+    """
+    assigns `n` jobs one by one, each to the host with the lowest share of its slots in use, and the lowest
+    load on ties.
+
+    :param statuses: the probed status of each host.
+    :param caps: the number of free slots of each host.
+    :return: the host index of each job.
+    """
+    assigned = [0] * len(statuses)
+    placement = []
+    for _ in range(n):
+        candidates = [i for i, cap in enumerate(caps) if assigned[i] < cap]
+        if not candidates:
+            raise RuntimeError(f"The host pool only has room for {sum(caps)} of the {n} jobs.")
+        i = min(candidates, key=lambda i: (assigned[i] / caps[i], statuses[i]['load']))
+        assigned[i] += 1
+        placement.append(i)
+    return placement
+
+
+_probes = {}
+_probes_lock = threading.Lock()
+
+
+class SSHPool(Launcher):
+    """
+    Launches the runners over a pool of SSH hosts. Host entries override the launcher options, which include
+    the options of `ssh_launch.ssh`, e.g. username, pem, port, password and sudo.
+
+    :param hosts: list of host options, each with at least the `ip`.
+    :param max_jobs: the most jobs one launch places on a host. Can be set per host.
+    :param gpus_per_job: the free GPUs each job needs. The runners on the host only get their GPUs, see
+                         `Runner.use_gpus`.
+    :param memory_per_job: the available memory each job needs, in MB.
+    :param max_load: skip hosts with a higher 1-minute load average per cpu.
+    :param probe_ttl: seconds a probe result is reused for.
+    :param probe_workers: the number of hosts probed at the same time.
+    """
+    # SSHCode mounts are uploaded to the hosts the runners land on, instead of to a single `ip`.
+    UPLOAD_PER_HOST = True
+    probe = staticmethod(probe_host)
+
+    def __init__(self, hosts, max_jobs=1, gpus_per_job=0, memory_per_job=0, max_load=None, probe_ttl=30,
+                 probe_workers=16, **ssh_config):
+        super().__init__(hosts=hosts, max_jobs=max_jobs, gpus_per_job=gpus_per_job, memory_per_job=memory_per_job,
+                         max_load=max_load, probe_ttl=probe_ttl, probe_workers=probe_workers, **ssh_config)
+        self.ssh_config = ssh_config
+        self.hosts = [{'username': 'ubuntu', **ssh_config, **host} for host in hosts]
+        self.uploaded = getattr(self, "uploaded", None) or set()
+
+    @staticmethod
+    def host_key(host):
+        return host['ip'], host.get('port'), host.get('username', 'ubuntu')
+
+    def probe_all(self):
+        """the status of every host, probing concurrently those without a fresh cached result.
+
+        :return: the status of each host, minus what the jobs placed since its probe take up.
+        """
+        now = time.time()
+        with _probes_lock:
+            stale = [h for h in self.hosts if self.host_key(h) not in _probes
+                     or now - _probes[self.host_key(h)][0] > self.config['probe_ttl']]
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(self.config['probe_workers'], len(stale)),
+                                    thread_name_prefix="jaynes-probe") as pool:
+                statuses = list(pool.map(lambda h: self.probe(**h), stale))
+            with _probes_lock:
+                for host, status in zip(stale, statuses):
+                    # [time of the probe, status, jobs placed since]
+                    _probes[self.host_key(host)] = [now, status, 0]
+        with _probes_lock:
+            return [remaining(*_probes[self.host_key(h)][1:], gpus_per_job=self.config['gpus_per_job'],
+                              memory_per_job=self.config['memory_per_job']) for h in self.hosts]
+
+    def plan_instance(self, verbose=None):
+        # runners are placed together in `execute`.
+        pass
+
+    def execute(self, verbose=None):
+        """
+        places the runners on the hosts and launches one script per host.
+
+        :return: the ip of the host of each runner, in the order they were added.
+        """
+        runners, self.runners = self.runners, []
+        statuses = self.probe_all()
+        caps = [capacity(status, max_jobs=host.get('max_jobs', self.config['max_jobs']),
+                         gpus_per_job=self.config['gpus_per_job'], memory_per_job=self.config['memory_per_job'],
+                         max_load=self.config['max_load'])
+                for host, status in zip(self.hosts, statuses)]
+
+        placement = pack(len(runners), statuses, caps)
+        by_host = {}
+        for runner, i in zip(runners, placement):
+            by_host.setdefault(i, []).append(runner)
+        with _probes_lock:
+            for i, host_runners in by_host.items():
+                _probes[self.host_key(self.hosts[i])][2] += len(host_runners)
+
+        with ThreadPoolExecutor(max_workers=len(by_host), thread_name_prefix="jaynes-ssh") as pool:
+            futures = [pool.submit(self.launch_host, self.hosts[i], host_runners, statuses[i], verbose=verbose)
+                       for i, host_runners in by_host.items()]
+            for future in futures:
+                future.result()
+        return [self.hosts[i]['ip'] for i in placement]
+
+    def launch_host(self, host, runners, status, verbose=None):
+        gpus_per_job = self.config['gpus_per_job']
+        for k, runner in enumerate(runners if gpus_per_job else ()):
+            gpus = ",".join(map(str, status['free_gpus'][k * gpus_per_job:(k + 1) * gpus_per_job]))
+            runner.use_gpus(gpus)
+
+        mounts = list(dict.fromkeys(sum([r.mounts for r in runners], [])))
+        self.upload_host_mounts(host, mounts, verbose=verbose)
+        launch_script = make_launch_script(runners=runners, mounts=mounts, unpack_on_host=True, **host)
+        if verbose:
+            print(f"{host['ip']}:\n{launch_script}")
+        return ssh(launch_script, **host, verbose=verbose)
+
+    _upload_lock = threading.Lock()
+
+    def upload_host_mounts(self, host, mounts, verbose=None):
+        # SSHCode.upload rewrites the upload script of the mount for each host, hence the lock.
+        for mount in mounts:
+            if getattr(mount, "per_host", False) and (mount, self.host_key(host)) not in self.uploaded:
+                with self._upload_lock:
+                    mount.upload(verbose=verbose, **host)
+                self.uploaded.add((mount, self.host_key(host)))
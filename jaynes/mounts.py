@@ -4,19 +4,141 @@ from textwrap import dedent
 from uuid import uuid4
 
 from jaynes.shell import check_call
-from .helpers import get_temp_dir
+from .helpers import get_temp_dir, presign_s3
+from .templates import cached_unpack, ranged_get
 
 
 class Mount:
     local_script = None
+    # uploads to the launch host itself. Launchers with many hosts upload these once per host.
+    per_host = False
 
     # used by kubernetes
     init_container = None
     volume_mount = None
+    # pod volumes this mount needs, added to the job spec by the Container runner.
+    volumes = None
+
+    # set by the tar-based mounts when `gitignore` or `host_cache` is on. The file list is written right
+    # before tar runs.
+    selection = None
+    file_list = None
+    # content hash of the selected files, used as the code cache key.
+    tree_hash = None
+    # the files the tree hash was computed from, which the tar packs as well.
+    hashed_files = None
+
+    # with `tree_shake`, only the files the thunks import are packed. The upload is deferred until
+    # the thunks are known, see `Jaynes.add`.
+    tree_shake = False
+    data_files = None
+    shaken = None
+    _module_finder = None
+
+    # with `by_value`, thunks carry this mount's modules pickled by value when they fit in `by_value_limit`
+    # bytes, and the mount is only uploaded if some thunk does not.
+    by_value = False
+    by_value_limit = None
+    by_value_fallback = False
+    _host_setup = None
+
+    def select_files(self, local_abs, name, excludes, file_mask, exclude_vcs, exclude_from, use_gitignore=True):
+        """use the shared file index instead of tar's exclude globs.
+
+        :return: the tar arguments that read the file list.
+        """
+        from .file_index import FileSelection
+
+        self.selection = FileSelection(local_abs, excludes=excludes, file_mask=file_mask,
+                                       exclude_vcs=exclude_vcs, exclude_from=exclude_from,
+                                       use_gitignore=use_gitignore)
+        self.file_list = pathJoin(self.temp_dir, f"{name}.files")
+        return f"--null -T {self.file_list}"
+
+    def enable_tree_shake(self, data_files=None, cache=None):
+        assert not cache, "the code cache is keyed by the tree hash, which is not known until the thunks are added."
+        self.tree_shake = True
+        self.data_files = data_files
+        self.shaken = set()
+        # nothing is packed until a thunk is added.
+        self.selection.sub_paths = []
+
+    def shake(self, fn, *args, **kwargs):
+        """add the files the thunk needs from this mount to the file selection.
+
+        :return: the files that were not selected before.
+        """
+        from .tree_shake import find_files
+
+        # the data files are selected with the first thunk.
+        files = find_files(self.selection.local_abs, (fn, args, kwargs), finder=self.module_finder(),
+                           data_files=None if self.shaken else self.data_files)
+        new = set(files) - self.shaken
+        self.shaken |= new
+        self.selection.sub_paths = sorted(self.shaken)
+        return new
+
+    def enable_by_value(self, limit):
+        self.by_value = True
+        self.by_value_limit = limit
+
+    def module_finder(self):
+        """the `ModuleFinder` of this mount, shared by its thunks so that the imports are only parsed once."""
+        from .tree_shake import ModuleFinder
+
+        if self._module_finder is None:
+            self._module_finder = ModuleFinder(self.selection.local_abs)
+        return self._module_finder
+
+    def local_modules(self, fn, *args, **kwargs):
+        """the modules from this mount that the thunk needs."""
+        from .tree_shake import find_modules
+
+        return find_modules(self.selection.local_abs, (fn, args, kwargs), finder=self.module_finder())
+
+    def skip_upload(self, skip=True):
+        """when the thunks carry the code, only create the directory on the host. `skip=False` restores the setup."""
+        if self._host_setup is None:
+            self._host_setup = self.host_setup
+        self.host_setup = f"mkdir -p {self.host_path}" if skip else self._host_setup
+
+    def code_hash(self):
+        if self.tree_hash is None and self.selection is not None:
+            self.hashed_files = self.selection.files()
+            self.tree_hash = self.selection.tree_hash(self.hashed_files)
+        return self.tree_hash
+
+    def use_node_cache(self, fetch, node_cache=None, node_cache_claim=None, cache_volume="jaynes-code-cache"):
+        """switch the kubernetes init container to a node-local (hostPath) or shared (PVC) code cache.
+
+        The init container only downloads on a cache miss, under a file lock, and the job container mounts
+        the cached tree read-only through `subPath`, so nothing is copied on a hit.
+        """
+        cache_dir = "/jaynes-cache"
+        if node_cache:
+            self.volumes = [{"name": cache_volume, "hostPath": {"path": node_cache, "type": "DirectoryOrCreate"}}]
+        else:
+            self.volumes = [{"name": cache_volume, "persistentVolumeClaim": {"claimName": node_cache_claim}}]
+        self.init_container = {
+            **self.init_container,
+            "args": ['-c', cached_unpack(cache_dir, self.code_hash(), fetch, None, link=None).strip()],
+            "volumeMounts": [{"name": cache_volume, "mountPath": cache_dir}]}
+        self.volume_mount = {
+            "name": cache_volume,
+            "mountPath": self.container_path,
+            "subPath": f"code/{self.code_hash()}",
+            "readOnly": True}
+
+    def write_file_list(self):
+        """writes the files to pack. Once the code hash is known, these are the files it was computed from, so
+        that files added in the meantime do not end up under the cache key of the older tree."""
+        if self.selection is not None:
+            self.selection.write(self.file_list, self.hashed_files)
 
     def upload(self, verbose=None, **_):
         if self.local_script is None:
             return
+        self.write_file_list()
         assert not check_call(dedent(self.local_script or ""), verbose=verbose, shell=True)
 
 
@@ -78,6 +200,27 @@ class S3Code(Mount):
                 This is needed for aws s3 download without credentials.
     :param no_sign: Whether to sign the s3 url. When set to true, the aws s3 download does not require credientials.
                     This needs to be used with the [acl: "public-read"] option.
+    :param gitignore: Select files with the `.gitignore`-aware file index instead of tar's exclude globs.
+                      `excludes`, `exclude_vcs` and `exclude_from` are still honored.
+    :param host_cache: Directory on the host for a content-addressed code cache, e.g. /var/cache/jaynes. Jobs on
+                       the same host with the same code tree hash download and extract it only once.
+    :param cache_link: How the cached tree is linked into `host_path`, one of "hardlink", "symlink" or "bind".
+    :param node_cache: Kubernetes only. A hostPath directory on the node for the code cache. The init container
+                       only downloads on a miss, and the job container mounts the cached tree read-only.
+    :param node_cache_claim: Kubernetes only. Use this PersistentVolumeClaim for the code cache instead.
+    :param cache_volume: The name of the pod volume for the code cache.
+    :param tree_shake: Only pack the modules the launched functions import from `local_path`, found from the thunks
+                       passed to `jaynes.add`. The upload is deferred until `jaynes.execute`.
+    :param data_files: glob patterns relative to `local_path` that are packed along with `tree_shake`.
+    :param by_value: Ship the modules the launched functions use from `local_path` inside the thunks, pickled by
+                     value, and skip the upload. Falls back to uploading the mount when a thunk is larger than
+                     `by_value_limit` bytes. Requires cloudpickle>=2.0 locally and on the host.
+    :param by_value_limit: Default 256KB, the GCE metadata limit.
+    :param presign: Embed a presigned https url in the host script instead of using the aws cli, so the host needs
+                    neither the cli nor credentials. The host downloads with parallel ranged GETs through curl,
+                    and pipes the tar ball straight into tar.
+    :param presign_expires: Seconds the presigned url stays valid. Default 24 hours, at most 7 days.
+    :param download_workers: The number of concurrent range requests with `presign`.
     :return: self
     """
 
@@ -90,20 +233,29 @@ class S3Code(Mount):
                  docker_mount_type="bind",
                  pypath=False, excludes=None, file_mask=None,
                  name=None, compress=True, no_signin=False, acl=None, region=None,
-                 exclude_vcs=True, exclude_from=None, **tar_options):
+                 exclude_vcs=True, exclude_from=None, gitignore=False, host_cache=None, cache_link="hardlink",
+                 node_cache=None, node_cache_claim=None, cache_volume="jaynes-code-cache",
+                 tree_shake=False, data_files=None, by_value=False,
+                 by_value_limit=1 << 18, presign=False, presign_expires=24 * 3600, download_workers=8,
+                 **tar_options):
         # I fucking hate the behavior of python defaults. -- GY
         from .jaynes import RUN
         local_path = os.path.expandvars(local_path)
         local_abs = os.path.join(RUN.config_root, local_path)
 
         tar_options = ' '.join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
-        if exclude_vcs:
-            tar_options += " --exclude-vcs"
-        if exclude_from:
-            ignore_file_path = os.path.join(RUN.config_root, exclude_from)
-            tar_options += f" --exclude-from='{ignore_file_path}'"
+        ignore_file_path = os.path.join(RUN.config_root, exclude_from) if exclude_from else None
+        # the code caches are keyed by the tree hash, which requires packing the file index's selection.
+        use_index = gitignore or host_cache or node_cache or node_cache_claim or tree_shake or by_value
+        if not use_index:
+            if exclude_vcs:
+                tar_options += " --exclude-vcs"
+            if exclude_from:
+                tar_options += f" --exclude-from='{ignore_file_path}'"
 
         name = name or str(uuid4())
+        # also where the launchers upload oversized launch scripts, see `stage_launch_script`.
+        self.prefix = prefix
 
         sub_path = sub_path or name
         mount_path = mount_path or "/tmp"
@@ -123,17 +275,46 @@ class S3Code(Mount):
             tar_name = f"{name}.tar"
             self.temp_dir = get_temp_dir()
             local_tar = pathJoin(self.temp_dir, tar_name)
+            if use_index:
+                tar_flags = tar_options
+                tar_paths = self.select_files(local_abs, name, excludes, file_mask, exclude_vcs, ignore_file_path,
+                                              use_gitignore=gitignore)
+                if tree_shake:
+                    self.enable_tree_shake(data_files, cache=host_cache or node_cache or node_cache_claim)
+                if by_value:
+                    self.enable_by_value(by_value_limit)
+            else:
+                tar_flags, tar_paths = f"{excludes} {tar_options}", file_mask
 
             self.local_script = f"""
                     type gtar >/dev/null 2>&1 && alias tar=`which gtar`
                     mkdir -p {self.temp_dir}
                     # Do not use absolute path in tar.
-                    tar {excludes} {tar_options} -c{"z" if compress else ""}f {local_tar} -C {local_abs} {file_mask}
+                    tar {tar_flags} -c{"z" if compress else ""}f {local_tar} -C {local_abs} {tar_paths}
                     aws s3 cp {local_tar} {prefix}/{tar_name} {'--acl {}'.format(acl) if acl else ''} {'--region {}'.format(region) if region else ''}
                     """
             remote_tar = remote_tar or f"/tmp/{tar_name}"
             self.host_path = host_path
-            self.host_setup = f"""
+            if presign:
+                url = presign_s3(pathJoin(prefix, tar_name), presign_expires, region)
+                fetch_script = f"""
+                    {ranged_get(url, download_workers)} | tar -{"z" if compress else ""}xf - -C $JAYNES_CACHE_TMP
+                    """
+            else:
+                # used by the code caches, extracts into $JAYNES_CACHE_TMP
+                fetch_script = f"""
+                    aws s3 cp {pathJoin(prefix, tar_name)} {remote_tar} {'--no-sign-request' if no_signin else ''}
+                    tar -{"z" if compress else ""}xf {remote_tar}{tar_name if remote_tar.endswith('/') else ""} -C $JAYNES_CACHE_TMP
+                    """
+            if host_cache:
+                self.host_setup = cached_unpack(host_cache, self.code_hash(), fetch_script, host_path, link=cache_link)
+            elif presign:
+                self.host_setup = f"""
+                    mkdir -p {host_path}
+                    {ranged_get(url, download_workers)} | tar -{"z" if compress else ""}xf - -C {host_path}
+                    """
+            else:
+                self.host_setup = f"""
                     aws s3 cp {pathJoin(prefix, tar_name)} {remote_tar} {'--no-sign-request' if no_signin else ''}
                     mkdir -p {host_path}
                     tar -{"z" if compress else ""}xf {remote_tar}{tar_name if remote_tar.endswith('/') else ""} -C {host_path}
@@ -145,7 +326,13 @@ class S3Code(Mount):
                     """
             self.host_path = host_path
             host_dir = os.path.dirname(host_path)
-            self.host_setup = f"""
+            if presign:
+                self.host_setup = f"""
+                    mkdir -p {host_dir}
+                    {ranged_get(presign_s3(f"{prefix}/{filename}", presign_expires, region), download_workers)} > {host_path}
+                    """
+            else:
+                self.host_setup = f"""
                     mkdir -p {host_dir}
                     aws s3 cp {prefix}/{filename} {host_path} {'--no-sign-request' if no_signin else ''}
                     """
@@ -169,6 +356,9 @@ class S3Code(Mount):
             "mountPath": self.container_path,
             "subPath": sub_path}
 
+        if (node_cache or node_cache_claim) and os.path.isdir(local_path):
+            self.use_node_cache(fetch_script, node_cache, node_cache_claim, cache_volume)
+
 
 class GSCode(Mount):
     """
@@ -205,6 +395,19 @@ class GSCode(Mount):
     :param pypath (bool): Whether this directory should be added to the python path
     :param excludes: The files paths to exclude, default to "--exclude='*__pycache__'"
     :param file_mask: The file mask for files to include. Default to "."
+    :param gitignore: Select files with the `.gitignore`-aware file index instead of tar's exclude globs.
+    :param host_cache: Directory on the host for a content-addressed code cache, e.g. /var/cache/jaynes.
+    :param cache_link: How the cached tree is linked into `host_path`, one of "hardlink", "symlink" or "bind".
+    :param node_cache: Kubernetes only. A hostPath directory on the node for the code cache.
+    :param node_cache_claim: Kubernetes only. Use this PersistentVolumeClaim for the code cache instead.
+    :param cache_volume: The name of the pod volume for the code cache.
+    :param tree_shake: Only pack the modules the launched functions import from `local_path`, found from the thunks
+                       passed to `jaynes.add`. The upload is deferred until `jaynes.execute`.
+    :param data_files: glob patterns relative to `local_path` that are packed along with `tree_shake`.
+    :param by_value: Ship the modules the launched functions use from `local_path` inside the thunks, pickled by
+                     value, and skip the upload. Falls back to uploading the mount when a thunk is larger than
+                     `by_value_limit` bytes. Requires cloudpickle>=2.0 locally and on the host.
+    :param by_value_limit: Default 256KB, the GCE metadata limit.
     :return: self
     """
 
@@ -214,20 +417,28 @@ class GSCode(Mount):
                  remote_tar=None, container_path=None,
                  docker_mount_type="bind",
                  pypath=False, excludes=None, file_mask=None,
-                 name=None, compress=True, exclude_vcs=True, exclude_from=None, **tar_options):
+                 name=None, compress=True, exclude_vcs=True, exclude_from=None, gitignore=False,
+                 host_cache=None, cache_link="hardlink", node_cache=None, node_cache_claim=None,
+                 cache_volume="jaynes-code-cache", tree_shake=False, data_files=None, by_value=False,
+                 by_value_limit=1 << 18, **tar_options):
         # I fucking hate the behavior of python defaults. -- GY
         from .jaynes import RUN
         local_path = os.path.expandvars(local_path)
         local_abs = os.path.join(RUN.config_root, local_path)
 
         tar_options = ' '.join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
-        if exclude_vcs:
-            tar_options += " --exclude-vcs"
-        if exclude_from:
-            ignore_file_path = os.path.join(RUN.config_root, exclude_from)
-            tar_options += f" --exclude-from='{ignore_file_path}'"
+        ignore_file_path = os.path.join(RUN.config_root, exclude_from) if exclude_from else None
+        # the code caches are keyed by the tree hash, which requires packing the file index's selection.
+        use_index = gitignore or host_cache or node_cache or node_cache_claim or tree_shake or by_value
+        if not use_index:
+            if exclude_vcs:
+                tar_options += " --exclude-vcs"
+            if exclude_from:
+                tar_options += f" --exclude-from='{ignore_file_path}'"
 
         name = name or str(uuid4())
+        # also where the launchers upload oversized launch scripts, see `stage_launch_script`.
+        self.prefix = prefix
 
         sub_path = sub_path or name
         mount_path = mount_path or "/tmp"
@@ -247,17 +458,35 @@ class GSCode(Mount):
             tar_name = f"{name}.tar"
             self.temp_dir = get_temp_dir()
             local_tar = pathJoin(self.temp_dir, tar_name)
+            if use_index:
+                tar_flags = tar_options
+                tar_paths = self.select_files(local_abs, name, excludes, file_mask, exclude_vcs, ignore_file_path,
+                                              use_gitignore=gitignore)
+                if tree_shake:
+                    self.enable_tree_shake(data_files, cache=host_cache or node_cache or node_cache_claim)
+                if by_value:
+                    self.enable_by_value(by_value_limit)
+            else:
+                tar_flags, tar_paths = f"{excludes} {tar_options}", file_mask
 
             self.local_script = f"""
                     type gtar >/dev/null 2>&1 && alias tar=`which gtar`
                     mkdir -p {self.temp_dir}
                     # Do not use absolute path in tar.
-                    tar {excludes} {tar_options} -c{"z" if compress else ""}f {local_tar} -C {local_abs} {file_mask}
+                    tar {tar_flags} -c{"z" if compress else ""}f {local_tar} -C {local_abs} {tar_paths}
                     gsutil cp {local_tar} {prefix}/{tar_name}
                     """
             remote_tar = remote_tar or f"/tmp/{tar_name}"
             self.host_path = host_path
-            self.host_setup = f"""
+            # used by the code caches, extracts into $JAYNES_CACHE_TMP
+            fetch_script = f"""
+                    gsutil cp {pathJoin(prefix, tar_name)} {remote_tar}
+                    tar -{"z" if compress else ""}xf {remote_tar}{tar_name if remote_tar.endswith('/') else ""} -C $JAYNES_CACHE_TMP
+                    """
+            if host_cache:
+                self.host_setup = cached_unpack(host_cache, self.code_hash(), fetch_script, host_path, link=cache_link)
+            else:
+                self.host_setup = f"""
                     gsutil cp {pathJoin(prefix, tar_name)} {remote_tar}
                     mkdir -p {host_path}
                     tar -{"z" if compress else ""}xf {remote_tar}{tar_name if remote_tar.endswith('/') else ""} -C {host_path}
@@ -293,6 +522,9 @@ class GSCode(Mount):
             "mountPath": self.container_path,
             "subPath": sub_path}
 
+        if (node_cache or node_cache_claim) and os.path.isdir(local_path):
+            self.use_node_cache(fetch_script, node_cache, node_cache_claim, cache_volume)
+
 
 class S3Output(Mount):
     """
@@ -314,11 +546,25 @@ class S3Output(Mount):
     :param interval:
     :param pypath:
     :param sync_s3:
+    :param incremental: run the `jaynes.s3_sync` agent on the host instead of the `aws s3 cp --recursive`
+                        loop. Only files that changed since the last pass are uploaded, and a spot-termination
+                        notice triggers a final flush, small files first. Requires python3 on the host.
+    :param workers: number of concurrent uploads for the incremental agent.
+    :param pack_below: with `incremental`, files smaller than this many bytes are packed into rolling segment
+                       archives instead of being uploaded one object each. Read them back with
+                       `jaynes.s3_sync.SegmentReader`, or let `incremental_download` unpack them.
+    :param incremental_download: download with the `jaynes.s3_sync` puller instead of the
+                                 `aws s3 cp --recursive` loop. Only new or changed objects are fetched.
+                                 Requires boto3 locally.
+    :param tail: with `incremental_download`, glob patterns of append-only files, e.g. ["*.log"]. When they grow,
+                 only the new bytes are downloaded. Files that are rewritten, e.g. a csv of metrics, should not
+                 be listed.
     :return:
     """
 
     def __init__(self, *, container_path, prefix, host_path=None, name=None, local_path=None, interval=15,
-                 pypath=False, sync_s3=True):
+                 pypath=False, sync_s3=True, incremental=False, workers=8, pack_below=None,
+                 incremental_download=False, tail=()):
 
         if host_path is None:
             host_path = f"/tmp/jaynes_mounts/{uuid4() if name is None else name}"
@@ -336,9 +582,18 @@ class S3Output(Mount):
             local_path = os.path.expandvars(local_path)
             local_abs = os.path.join(RUN.config_root, local_path)
 
-            download_script = f"""
+            if incremental_download:
+                import sys
+
+                self.local_script = f"""
+                mkdir -p {local_abs}
+                {sys.executable} -m jaynes.s3_sync pull {prefix} {local_abs} --interval {interval or 15} \\
+                    {" ".join(f"--tail '{pattern}'" for pattern in tail)} & echo 'incremental sync {local_path} initiated'
+            """
+            else:
+                download_script = f"""
                 aws s3 cp --recursive {prefix} {local_path} || echo "s3 bucket is EMPTY" """
-            self.local_script = f"""
+                self.local_script = f"""
                 mkdir -p {local_abs}
                 while true; do
                     echo "downloading..." {download_script}
@@ -350,7 +605,20 @@ class S3Output(Mount):
             # pass
         self.upload_script = f"""
                 aws s3 cp --recursive {host_path} {prefix} """  # --only-show-errors"""
-        self.host_setup = f"""
+        if incremental:
+            from . import s3_sync
+
+            args = [host_path, prefix, "--interval", interval or 15, "--workers", workers]
+            if pack_below:
+                args += ["--pack-below", pack_below]
+            sync_script = s3_sync.host_script(*args, name=f"jaynes_s3_sync-{uuid4().hex[:8]}")
+            self.host_setup = f"""
+                echo 'making main_log directory {host_path}'
+                mkdir -p {host_path}""" + ("" if not sync_s3 else f"""{sync_script}
+                echo "incremental sync {host_path} initiated"
+                """)
+        else:
+            self.host_setup = f"""
                 echo 'making main_log directory {host_path}'
                 mkdir -p {host_path}
                 echo "made main_log directory" """ + ("" if not sync_s3 else f"""
@@ -381,6 +649,10 @@ class SSHCode(Mount):
     Tars a local folder, uploads the content to S3, downloads the tar ball on the remote instance and mounts it
     in docker.
 
+    With `rsync: true`, the source directory is rsynced as-is into a persistent `sync_dir` on the host instead,
+    so that re-launches after small edits only transfer the delta. `host_path` is then a hardlink snapshot of
+    `sync_dir`. The mkdir and the transfer run over the SSH ControlMaster connection the launcher uses as well,
+    see `jaynes.ssh_control`.
 
     :param profile: The profile to use for untaring the code ball. Not used.
     :param password: The password to use for untaring the code ball. Not used.
@@ -391,12 +663,29 @@ class SSHCode(Mount):
     :param pypath (bool): Whether this directory should be added to the python path
     :param excludes: The files paths to exclude, default to "--exclude='*__pycache__'"
     :param file_mask: The file mask for files to include. Default to "."
+    :param gitignore: Select files with the `.gitignore`-aware file index instead of tar's exclude globs.
+    :param host_cache: Directory on the host for a content-addressed code cache, e.g. /var/cache/jaynes.
+    :param cache_link: How the cached tree is linked into `host_path`, one of "hardlink", "symlink" or "bind".
+    :param rsync: rsync the source directory with the same exclude rules, instead of shipping a tar ball.
+    :param sync_dir: The persistent per-project directory on the host for `rsync` mode. The jobs run from a
+                     snapshot of it at `host_path`. Default /tmp/jaynes-sync/<user>-<local directory name>-<hash>,
+                     where the hash is of the absolute local path.
+    :param tree_shake: Only pack the modules the launched functions import from `local_path`, found from the thunks
+                       passed to `jaynes.add`. The upload is deferred until `jaynes.execute`.
+    :param data_files: glob patterns relative to `local_path` that are packed along with `tree_shake`.
+    :param by_value: Ship the modules the launched functions use from `local_path` inside the thunks, pickled by
+                     value, and skip the upload. Falls back to uploading the mount when a thunk is larger than
+                     `by_value_limit` bytes. Requires cloudpickle>=2.0 locally and on the host.
+    :param by_value_limit: Default 256KB, the GCE metadata limit.
     :return: self
     """
+    per_host = True
 
     def __init__(self, *, local_path, local_tar=None, host_path=None, remote_tar=None,
                  container_path=None, pypath=False, excludes=None, file_mask=None, name=None,
-                 compress=True, exclude_vcs=True, exclude_from=None, **tar_options):
+                 compress=True, exclude_vcs=True, exclude_from=None, gitignore=False, host_cache=None,
+                 cache_link="hardlink", rsync=False, sync_dir=None, tree_shake=False, data_files=None,
+                 by_value=False, by_value_limit=1 << 18, **tar_options):
 
         # I fucking hate the behavior of python defaults. -- GY
         self.local_path = local_path
@@ -416,11 +705,12 @@ class SSHCode(Mount):
         self.container_path = os.path.join(RUN.config_root, container_path) if container_path else local_abs
 
         tar_options = ' '.join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
-        if exclude_vcs:
-            tar_options += " --exclude-vcs"
-        if exclude_from:
-            ignore_file_path = os.path.join(RUN.config_root, exclude_from)
-            tar_options += f" --exclude-from='{ignore_file_path}'"
+        ignore_file_path = os.path.join(RUN.config_root, exclude_from) if exclude_from else None
+        if not (gitignore or host_cache or tree_shake or by_value):
+            if exclude_vcs:
+                tar_options += " --exclude-vcs"
+            if exclude_from:
+                tar_options += f" --exclude-from='{ignore_file_path}'"
 
         if local_tar is None:
             tar_name = f"{name}.tar"
@@ -431,16 +721,60 @@ class SSHCode(Mount):
             self.temp_dir = os.path.dirname(local_tar)
             self.local_tar = local_tar
 
+        if gitignore or host_cache or tree_shake or by_value:
+            tar_flags = tar_options
+            tar_paths = self.select_files(local_abs, name, self.excludes, self.file_mask, exclude_vcs,
+                                          ignore_file_path, use_gitignore=gitignore)
+            if tree_shake:
+                self.enable_tree_shake(data_files, cache=host_cache)
+            if by_value:
+                self.enable_by_value(by_value_limit)
+        else:
+            tar_flags, tar_paths = f"{self.excludes} {tar_options}", self.file_mask
+
         self.remote_tar = remote_tar or f"/tmp/{tar_name}"
 
         self.tar_script = f"""
                 type gtar >/dev/null 2>&1 && alias tar=`which gtar`
                 mkdir -p {self.temp_dir}
                 # Do not use absolute path in tar.
-                tar {self.excludes} {tar_options} -c{"z" if self.compress else ""}f {self.local_tar} -C {local_abs} {self.file_mask}
+                tar {tar_flags} -c{"z" if self.compress else ""}f {self.local_tar} -C {local_abs} {tar_paths}
                 """
 
-        self.host_setup = f"""
+        self.rsync = rsync
+        if rsync:
+            import shlex
+            from .file_index import VCS_PATTERNS, parse_tar_excludes
+
+            assert not host_cache, "rsync mode already keeps a persistent copy on the host, use one or the other."
+            assert not (tree_shake or by_value), "tree_shake and by_value are not supported in rsync mode."
+            self.sync_dir = sync_dir or default_sync_dir(local_abs)
+            filters = [f"--exclude='{p}'" for p in parse_tar_excludes(self.excludes)]
+            if exclude_vcs:
+                filters += [f"--exclude='{p}'" for p in VCS_PATTERNS]
+            if exclude_from:
+                filters.append(f"--exclude-from='{ignore_file_path}'")
+            if gitignore:
+                filters.append("--filter=':- .gitignore'")
+            self.rsync_filters = " ".join(filters)
+            # -R with the /./ marker keeps the paths relative to local_abs.
+            self.rsync_sources = " ".join(f"{os.path.realpath(local_abs)}/./{p}" for p in shlex.split(self.file_mask))
+
+            # the jobs run from a hard-linked snapshot, since the next sync changes the sync_dir. rsync replaces
+            # changed files instead of writing in place, so the snapshot stays intact.
+            fixed_host_path = bool(self.host_path)
+            # one snapshot per mount by default, shared by the jobs of this process on the host.
+            self.host_path = self.host_path or f"/tmp/jaynes-mounts/{name}"
+            tmp = f"{self.host_path}.tmp-$$"
+            snapshot = f"mkdir -p `dirname {self.host_path}` && rm -rf {tmp} && cp -al {self.sync_dir} {tmp} && " \
+                       f"rm -rf {self.host_path} && mv {tmp} {self.host_path}"
+            self.host_setup = snapshot if fixed_host_path else f"[ -d {self.host_path} ] || ( {snapshot} )"
+        elif host_cache:
+            self.host_setup = cached_unpack(host_cache, self.code_hash(), f"""
+                tar -{"z" if self.compress else ""}xf {self.remote_tar}{tar_name if self.remote_tar.endswith('/') else ''} -C $JAYNES_CACHE_TMP
+                """, self.host_path, link=cache_link)
+        else:
+            self.host_setup = f"""
                 mkdir -p {self.host_path}
                 tar -{"z" if self.compress else ""}xf {self.remote_tar}{tar_name if self.remote_tar.endswith('/') else ''} -C {self.host_path}
                 """
@@ -448,13 +782,25 @@ class SSHCode(Mount):
         self.docker_mount = f"-v {self.host_path}:{self.container_path}"
 
     def upload(self, verbose=None, *, username, ip, pem=None, port=None, password=None, profile=None, **_):
+        from .ssh_control import get_control_master
+
         _port = "" if port is None else f"-p {port}"
         _pem = "" if pem is None else f"-i {pem}"
-
-        ssh_string = f"ssh {_port} {_pem}" if _port or _pem else 'ssh'
-        mkdir_script = f"{ssh_string} {username}@{ip} mkdir -p {os.path.dirname(self.remote_tar)}"
-        rsync_script = f"rsync -az -e '{ssh_string}' --info=progress2 {self.local_tar} {username}@{ip}:{self.remote_tar}"
-        if password is not None:  # note: now supports password log in!
+        # the mkdir and the transfer reuse the master connection that the launcher uses as well, and its
+        # authentication. They only log in on their own when the master does not start.
+        control = get_control_master(username, ip, port=port, pem=pem, password=password,
+                                     ssh_options="-o StrictHostKeyChecking=no")
+        connected = control.start(verbose=verbose)
+
+        ssh_string = f"ssh {control.options} {_port} {_pem}"
+        if self.rsync:
+            mkdir_script = f"{ssh_string} {username}@{ip} mkdir -p {self.sync_dir}"
+            rsync_script = f"rsync -azR --delete {self.rsync_filters} -e '{ssh_string}' --info=progress2 " \
+                           f"{self.rsync_sources} {username}@{ip}:{self.sync_dir}/"
+        else:
+            mkdir_script = f"{ssh_string} {username}@{ip} mkdir -p {os.path.dirname(self.remote_tar)}"
+            rsync_script = f"rsync -az -e '{ssh_string}' --info=progress2 {self.local_tar} {username}@{ip}:{self.remote_tar}"
+        if password is not None and not connected:  # note: now supports password log in!
             # rsync_script = f'expect <<EOF\nspawn {rsync_script};expect \"password:\";send \"{password}\\r\"\nEOF'
             # need to install sshpass from:
             # https://gist.github.com/arunoda/7790979
@@ -465,18 +811,31 @@ class SSHCode(Mount):
         # remote_tar_dir = os.path.dirname(remote_tar)
         # scp_script = f"scp {port_.upper()} {pem} {self.local_tar} {username}@{ip}:{remote_tar_dir}"
 
-        self.local_script = dedent(self.tar_script) + mkdir_script + "\n" + rsync_script + "\n"
+        tar_script = "" if self.rsync else dedent(self.tar_script)
+        self.local_script = tar_script + mkdir_script + "\n" + rsync_script + "\n"
 
         return super().upload(verbose=verbose)
 
 
+def default_sync_dir(local_abs):
+    """the sync directory of `SSHCode` on the host, per local user and local project directory."""
+    import getpass
+    import hashlib
+
+    local_abs = os.path.realpath(local_abs)
+    digest = hashlib.sha1(local_abs.encode()).hexdigest()[:12]
+    return f"/tmp/jaynes-sync/{getpass.getuser()}-{os.path.basename(local_abs)}-{digest}"
+
+
 class TarMount(Mount):
     tar_path = None
     host_path = None
 
     def __init__(self, *_, local_path, local_tar=None, remote_tar=None, host_path=None,
                  container_path=None, pypath=False, name=None, excludes=None, file_mask=None,
-                 compress=True, exclude_vcs=True, exclude_from=None, **tar_options):
+                 compress=True, exclude_vcs=True, exclude_from=None, gitignore=False, host_cache=None,
+                 cache_link="hardlink", tree_shake=False, data_files=None, by_value=False,
+                 by_value_limit=1 << 18, **tar_options):
         self.local_path = local_path
         self.host_path = host_path
         self.container_path = container_path or host_path
@@ -493,11 +852,12 @@ class TarMount(Mount):
         local_abs = os.path.join(RUN.config_root, local_path)
 
         tar_options = ' '.join([f"--{key.replace('_', '-')}={value}" for key, value in tar_options.items()])
-        if exclude_vcs:
-            tar_options += " --exclude-vcs"
-        if exclude_from:
-            ignore_file_path = os.path.join(RUN.config_root, exclude_from)
-            tar_options += f" --exclude-from='{ignore_file_path}'"
+        ignore_file_path = os.path.join(RUN.config_root, exclude_from) if exclude_from else None
+        if not (gitignore or host_cache or tree_shake or by_value):
+            if exclude_vcs:
+                tar_options += " --exclude-vcs"
+            if exclude_from:
+                tar_options += f" --exclude-from='{ignore_file_path}'"
 
         if local_tar is None:
             tar_name = f"{name}.tar"
@@ -508,15 +868,31 @@ class TarMount(Mount):
             self.temp_dir = os.path.dirname(local_tar)
             self.local_tar = local_tar
 
+        if gitignore or host_cache or tree_shake or by_value:
+            tar_flags = tar_options
+            tar_paths = self.select_files(local_abs, name, self.excludes, self.file_mask, exclude_vcs,
+                                          ignore_file_path, use_gitignore=gitignore)
+            if tree_shake:
+                self.enable_tree_shake(data_files, cache=host_cache)
+            if by_value:
+                self.enable_by_value(by_value_limit)
+        else:
+            tar_flags, tar_paths = f"{self.excludes} {tar_options}", self.file_mask
+
         self.remote_tar = remote_tar or f"$TMPDIR/{tar_name}"
 
         self.local_script = f"""
                 type gtar >/dev/null 2>&1 && alias tar=`which gtar`
                 mkdir -p {self.temp_dir}
                 # Do not use absolute path in tar.
-                tar {self.excludes} {tar_options} -c{"z" if compress else ""}f {self.local_tar} -C {local_abs} {self.file_mask}
+                tar {tar_flags} -c{"z" if compress else ""}f {self.local_tar} -C {local_abs} {tar_paths}
                 """
-        self.host_setup = f"""
+        if host_cache:
+            self.host_setup = cached_unpack(host_cache, self.code_hash(), f"""
+                tar -{"z" if compress else ""}xf {self.remote_tar} -C $JAYNES_CACHE_TMP
+                """, host_path, link=cache_link)
+        else:
+            self.host_setup = f"""
                 mkdir -p {host_path}
                 tar -{"z" if compress else ""}xf {self.remote_tar} -C {host_path}
                 """
@@ -527,26 +903,13 @@ class TarMount(Mount):
         if os.path.exists(self.local_tar):
             print('local tar already exists', self.local_tar)
         else:
+            self.write_file_list()
             script = dedent(self.local_script)
             check_call(script, verbose=verbose, shell=True)
 
-        parent_dir = os.path.dirname(self.remote_tar)
-        tar_name = os.path.basename(self.remote_tar)
-
         client = JaynesClient(host, token=token)
 
-        # grep to speed up transmission
-        stdout, stderr, error = client.execute(f"ls {parent_dir} | grep {tar_name}")
-
-        if tar_name in stdout:
-            print('remote tar already exists', self.remote_tar)
-            return
-
-        client.execute(f"mkdir -p {parent_dir}")
-        client.upload_file(self.local_tar, self.remote_tar)
-
-        stdout, *_ = client.execute(f"echo {parent_dir}")
-        if verbose:
-            print(stdout, parent_dir, self.remote_tar, )
-        stdout, *_ = client.execute(f"ls {parent_dir} | grep {tar_name}")
-        assert tar_name in stdout, "file upload failed" + stdout
+        # the upload is skipped when the server already has a file with the same hash, and resumed
+        # when a previous attempt was interrupted.
+        sha256 = client.upload_file(self.local_tar, self.remote_tar, verbose=verbose)
+        assert client.stat(self.remote_tar)['sha256'] == sha256, f"file upload failed {self.remote_tar}"
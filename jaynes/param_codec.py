@@ -1,6 +1,9 @@
 import pickle
 
 import base64
+import sys
+import threading
+from contextlib import contextmanager
 from typing import Any, Dict, Tuple
 
 import cloudpickle
@@ -23,3 +26,33 @@ def serialize(fn, args: Tuple[Any] = None, kwargs: Dict[Any, Any] = None,
     """
     code = cloudpickle.dumps(dict(thunk=fn, args=args, kwargs=kwargs), protocol=protocol)
     return base64.b64encode(code).decode("ascii")
+
+
+_by_value_lock = threading.RLock()
+
+
+@contextmanager
+def pickle_by_value(module_names):
+    """
+    Pickle the given modules by value inside the context, so that the thunk carries their code and can be
+    unpickled without them installed. Requires cloudpickle>=2.0, both locally and on the remote.
+
+    :param module_names: names of imported modules. Modules that are not imported are skipped.
+    """
+    if not hasattr(cloudpickle, "register_pickle_by_value"):
+        raise RuntimeError(f"pickling modules by value requires cloudpickle>=2.0, found {cloudpickle.__version__}")
+
+    registered = []
+    # the registry is process-wide, so concurrent sessions take turns.
+    with _by_value_lock:
+        try:
+            for name in module_names:
+                module = sys.modules.get(name)
+                if module is None or name == "__main__":
+                    continue
+                cloudpickle.register_pickle_by_value(module)
+                registered.append(module)
+            yield registered
+        finally:
+            for module in registered:
+                cloudpickle.unregister_pickle_by_value(module)
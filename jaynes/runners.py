@@ -18,6 +18,8 @@ class Runner:
     launch_config = None
 
     setup_script = ""
+    # runs on the host concurrently with the mount setup, e.g. pulling the docker image.
+    prefetch_script = ""
     run_script = ""
     post_script = ""
 
@@ -54,16 +56,26 @@ class Runner:
         return f"{cmd} {entry_env} {self.entry_script}"
 
     def build(self, fn, *args, **kwargs):
-        encoded_thunk = serialize(fn, args, kwargs)
+        return self.build_encoded(serialize(fn, args, kwargs))
+
+    def build_encoded(self, encoded_thunk):
+        """`build` with the thunk already serialized, see `jaynes.param_codec.serialize`."""
         self.main_script = self.main_script_thunk.format(JYNS_encoded_thunk=encoded_thunk)
         self.run_script = self.run_script_thunk.format(JYNS_main_script=self.main_script)
         return self
 
     def chain(self, fn, *args, __sep=" &\n", **kwargs):
-        encoded_thunk = serialize(fn, args, kwargs)
-        self.main_script += __sep + self.main_script_thunk.format(JYNS_encoded_thunk=encoded_thunk)
+        self.chain_encoded(serialize(fn, args, kwargs), __sep)
+
+    def chain_encoded(self, encoded_thunk, sep=" &\n"):
+        """`chain` with the thunk already serialized."""
+        self.main_script += sep + self.main_script_thunk.format(JYNS_encoded_thunk=encoded_thunk)
         self.run_script = self.run_script_thunk.format(JYNS_main_script=self.main_script)
 
+    def use_gpus(self, gpus):
+        """restricts the built run script to the GPUs of the host with these indices, e.g. "0,2"."""
+        self.run_script = f"(\nexport CUDA_VISIBLE_DEVICES={gpus}\n{self.run_script}\n)"
+
 
 class Slurm(Runner):
     """
@@ -311,8 +323,11 @@ class Docker(Runner):
 
         mount_string = " ".join([m.docker_mount for m in mounts])
         self.setup_script = setup
+        # pull while the mounts are downloading, instead of inside `docker run`.
+        self.prefetch_script = f"{docker_cmd} image inspect {image} >/dev/null 2>&1 || {docker_cmd} pull {image}"
 
         is_gpu = options.get('gpus', None) or "nvidia" in docker_cmd
+        gpus = options.pop('gpus', None)
 
         # dynamically generate the job name to avoid conflict
         docker_container_name = name or f"jaynes-job-{datetime.utcnow():%H%M%S}-{jaynes.RUN.count}"
@@ -336,17 +351,30 @@ echo -ne 'remove existing container '
 
         rest_config = " ".join(f"--{k.replace('_', '-')}={v}" for k, v in options.items())
 
+        gpus_config = f"--gpus={gpus}" if gpus else ""
+
         test_gpu = f"""
             echo 'Testing nvidia-smi inside docker'
-            {docker_cmd} run --rm {rest_config} {image} nvidia-smi
+            {docker_cmd} run --rm {gpus_config} {rest_config} {image} nvidia-smi
             """
+
         # note: always connect the docker to stdin and stdout.
-        self.run_script_thunk = f"""
+        def run_script_thunk(gpus_config):
+            return f"""
 {remove_by_name if name else ""}
 echo 'running {image} on' `hostname`
-{docker_cmd} run -i{"t" if tty else ""} {config} {rest_config} {mount_string} --name '{docker_container_name}' \\
+{docker_cmd} run -i{"t" if tty else ""} {config} {gpus_config} {rest_config} {mount_string} --name '{docker_container_name}' \\
 {image} /bin/bash -c '{{JYNS_main_script}} & wait' """
 
+        self._run_script_thunk = run_script_thunk
+        self.run_script_thunk = run_script_thunk(gpus_config)
+
+    def use_gpus(self, gpus):
+        """the container gets the GPUs of the host with these indices, e.g. "0,2", in place of the `gpus` option.
+        A CUDA_VISIBLE_DEVICES on the host would not reach the container."""
+        self.run_script_thunk = self._run_script_thunk(f"""--gpus '"device={gpus}"'""")
+        self.run_script = self.run_script_thunk.format(JYNS_main_script=self.main_script)
+
     chain = None
     # def chain(self, fn, *args, __sep=" &\n", **kwargs):
     #     encoded_thunk = serialize(fn, args, kwargs)
@@ -429,6 +457,12 @@ class Container(Runner):
         # self.mounts reuses the mounts from the Runner class
         init_containers = [m.init_container for m in self.mounts]
         volume_mounts = [m.volume_mount for m in self.mounts]
+        # volumes required by the mounts themselves, e.g. the node-local code cache.
+        volumes = list(volumes or [])
+        for m in self.mounts:
+            for v in m.volumes or []:
+                if v["name"] not in [_["name"] for _ in volumes]:
+                    volumes.append(v)
 
         self.is_gpu = options.get('gpus', None) or "nvidia" in docker_cmd
 
@@ -0,0 +1,527 @@
+"""
+Incremental sync between an output directory on the host and S3.
+
+The `push` side runs on the remote host. It keeps an (mtime, size) index of the output directory,
+uploads only the files that changed since the last pass with a pool of `aws s3 cp` workers, and
+does a prioritized final flush when the instance receives a spot-termination notice (or SIGTERM).
+
+The `pull` side runs locally. It keeps an ETag/size manifest of what it has already downloaded,
+lists the prefix with pagination, downloads new or changed objects concurrently, and tails the
+files declared append-only with ranged GETs instead of downloading them again.
+
+With `--pack-below`, the push side packs small files into rolling segment archives under
+`_jaynes_segments/`, each with a json index of its members, and uploads only the larger files as
+individual objects. :class:`SegmentReader` lists and extracts files from those segments, and the
+pull side unpacks new segments into the local directory as they arrive.
+
+The push side only depends on the standard library and the aws cli, because `S3Output` ships its
+source inside the host setup script, see :func:`host_source`. The pull side uses boto3.
+
+    python -m jaynes.s3_sync push <host_path> <prefix> --interval 15 --workers 8
+    python -m jaynes.s3_sync pull <prefix> <local_path> --interval 15 --workers 16
+"""
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+METADATA_URL = "http://169.254.169.254/latest"
+SEGMENT_DIR = "_jaynes_segments"
+
+
+def scan(root, index):
+    """returns the files under `root` whose (mtime, size) differ from `index`, as {rel_path: stat_key}."""
+    changed = {}
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # removed during the walk
+                continue
+            key = (stat.st_mtime_ns, stat.st_size)
+            rel = os.path.relpath(path, root)
+            if index.get(rel) != key:
+                changed[rel] = key
+    return changed
+
+
+def priority(item):
+    """small and recently modified files (logs, metrics) go first, large checkpoints last."""
+    rel, (mtime_ns, size) = item
+    return size, -mtime_ns
+
+
+def aws_cp(src, dst, region=None):
+    cmd = ["aws", "s3", "cp", src, dst, "--only-show-errors"]
+    if region:
+        cmd += ["--region", region]
+    return subprocess.call(cmd) == 0
+
+
+class SpotNotice:
+    """polls the EC2 instance metadata for a spot interruption notice.
+
+    Disables itself when the metadata service is not reachable, e.g. on non-EC2 hosts.
+    """
+
+    def __init__(self, timeout=1):
+        self.timeout = timeout
+        self.available = True
+
+    def _token(self):
+        from urllib.request import Request, urlopen
+        request = Request(METADATA_URL + "/api/token", method="PUT",
+                          headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"})
+        try:
+            return urlopen(request, timeout=self.timeout).read().decode()
+        except Exception:
+            return None
+
+    def __call__(self):
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        if not self.available:
+            return False
+        token = self._token()
+        headers = {"X-aws-ec2-metadata-token": token} if token else {}
+        try:
+            urlopen(Request(METADATA_URL + "/meta-data/spot/instance-action", headers=headers),
+                    timeout=self.timeout)
+            return True
+        except HTTPError:  # 404 until the instance is marked for interruption
+            return False
+        except Exception:
+            self.available = False
+            return False
+
+
+class Pusher:
+    """uploads changed files under `host_path` to `prefix`.
+
+    :param host_path: the output directory on the host
+    :param prefix: the s3 prefix, e.g. s3://bucket/path
+    :param workers: number of concurrent uploads
+    :param region: passed on to the aws cli
+    :param pack_below: files smaller than this many bytes are packed into segment archives
+                       instead of being uploaded one object each. None turns packing off.
+    :param segment_size: the maximum number of bytes of file content in one segment.
+    """
+
+    def __init__(self, host_path, prefix, workers=8, region=None, pack_below=None, segment_size=64 << 20):
+        self.host_path = host_path
+        self.prefix = prefix.rstrip("/")
+        self.workers = workers
+        self.region = region
+        self.pack_below = pack_below
+        self.segment_size = segment_size
+        self.index = {}
+        # files whose latest version lives in a segment
+        self.packed = set()
+        self.counter = itertools.count()
+
+    def upload(self, rel, key):
+        if aws_cp(os.path.join(self.host_path, rel), f"{self.prefix}/{rel}", region=self.region):
+            self.index[rel] = key
+            return rel
+
+    def pack(self, items, tombstones=()):
+        """write `items` into one segment archive and upload it, followed by its index.
+
+        Files that moved out of segments are recorded as `None` in the index, so that readers
+        fall back to the individual object.
+        """
+        import tarfile
+        import tempfile
+
+        # packs of the same flush run concurrently, the counter keeps their names apart.
+        name = "%020d-%06d" % (int(time.time() * 1e6), next(self.counter))
+        members = {rel: None for rel in tombstones}
+        with tempfile.TemporaryDirectory(prefix="jaynes_segment-") as tmp_dir:
+            tar_path = os.path.join(tmp_dir, name + ".tar")
+            with tarfile.open(tar_path, "w") as tar:
+                for rel, key in items:
+                    try:
+                        tar.add(os.path.join(self.host_path, rel), arcname=rel, recursive=False)
+                    except OSError:  # changed during the read, picked up by the next pass.
+                        continue
+                    members[rel] = list(key)
+            if not members:
+                return []
+            index_path = os.path.join(tmp_dir, name + ".json")
+            with open(index_path, "w") as f:
+                json.dump(members, f)
+
+            segment = f"{self.prefix}/{SEGMENT_DIR}/{name}"
+            if any(v is not None for v in members.values()) and \
+                    not aws_cp(tar_path, segment + ".tar", region=self.region):
+                return []
+            # the index goes last, so readers never see an index without its archive.
+            if not aws_cp(index_path, segment + ".json", region=self.region):
+                return []
+
+        for rel, key in members.items():
+            if key is None:
+                self.packed.discard(rel)
+            else:
+                self.index[rel] = tuple(key)
+                self.packed.add(rel)
+        return list(members)
+
+    def segments(self, items):
+        batch, batch_size = [], 0
+        for rel, key in items:
+            if batch and batch_size + key[1] > self.segment_size:
+                yield batch
+                batch, batch_size = [], 0
+            batch.append((rel, key))
+            batch_size += key[1]
+        if batch:
+            yield batch
+
+    def flush(self, workers=None):
+        """upload the files that changed since the last pass, in priority order."""
+        changed = sorted(scan(self.host_path, self.index).items(), key=priority)
+        n = len(changed)
+        if not n:
+            return 0
+        packs = []
+        with ThreadPoolExecutor(workers or self.workers) as pool:
+            if self.pack_below:
+                small = [item for item in changed if item[1][1] < self.pack_below]
+                changed = [item for item in changed if item[1][1] >= self.pack_below]
+                packs = [pool.submit(self.pack, batch) for batch in self.segments(small)]
+            uploaded = self.results([pool.submit(self.upload, *item) for item in changed])
+            # a tombstone sends readers to the individual object, so it goes after that object is up.
+            tombstones = [rel for rel in uploaded if rel and rel in self.packed]
+            if tombstones:
+                packs.append(pool.submit(self.pack, [], tombstones))
+            self.results(packs)
+        return n
+
+    @staticmethod
+    def results(futures):
+        """waits for the uploads. Failed files stay out of the index, and are retried by the next pass."""
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"upload failed: {e!r}", file=sys.stderr, flush=True)
+                results.append(None)
+        return results
+
+    def run(self, interval=15, poll=3, notice=None):
+        """flush every `interval` seconds, checking for termination every `poll` seconds."""
+        notice = notice or SpotNotice()
+        terminating = []
+        signal.signal(signal.SIGTERM, lambda *_: terminating.append(True))
+
+        next_flush = 0
+        while not terminating:
+            if notice():
+                print("spot termination notice received, final flush.", flush=True)
+                break
+            if time.time() >= next_flush:
+                n = self.flush()
+                if n:
+                    print(f"uploaded {n} files from {self.host_path}", flush=True)
+                next_flush = time.time() + interval
+            time.sleep(poll)
+        self.flush(workers=self.workers * 2)
+
+
+class SegmentReader:
+    """reads the segment archives under `local_path/_jaynes_segments`, as downloaded by the puller.
+
+    Later segments take precedence over earlier ones. Files recorded as `None` have moved out of
+    segments, and are read from the individual file under `local_path` instead.
+
+    :param local_path: the local copy of the output prefix.
+    """
+
+    def __init__(self, local_path):
+        self.local_path = local_path
+        self.segment_dir = os.path.join(local_path, SEGMENT_DIR)
+
+    def segment_names(self):
+        try:
+            return sorted(f[:-len(".json")] for f in os.listdir(self.segment_dir) if f.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def members(self, names=None):
+        """returns {rel_path: segment_name or None}, with None for files stored individually."""
+        members = {}
+        for name in self.segment_names() if names is None else sorted(names):
+            with open(os.path.join(self.segment_dir, name + ".json"), "r") as f:
+                for rel, key in json.load(f).items():
+                    members[rel] = name if key is not None else None
+        return members
+
+    def list(self):
+        """all files, from segments and individual downloads."""
+        files = {rel for rel, name in self.members().items() if name is not None}
+        for dir_path, dir_names, file_names in os.walk(self.local_path):
+            if dir_path == self.local_path and SEGMENT_DIR in dir_names:
+                dir_names.remove(SEGMENT_DIR)
+            for file_name in file_names:
+                if file_name.startswith(".jaynes_s3_manifest") or file_name.endswith(".jaynes-part"):
+                    continue
+                files.add(os.path.relpath(os.path.join(dir_path, file_name), self.local_path))
+        return sorted(files)
+
+    def read(self, rel):
+        import tarfile
+
+        name = self.members().get(rel)
+        if name is None:
+            with open(os.path.join(self.local_path, rel), "rb") as f:
+                return f.read()
+        with tarfile.open(os.path.join(self.segment_dir, name + ".tar")) as tar:
+            return tar.extractfile(rel).read()
+
+    def extract(self, dest=None, names=None):
+        """write the latest version of every packed file to `dest`, default to `local_path`.
+
+        :param names: only extract from these segments, e.g. the ones that just arrived.
+        :return: the list of extracted files
+        """
+        import tarfile
+
+        dest = dest or self.local_path
+        by_segment = {}
+        for rel, name in self.members(names).items():
+            if name is not None:
+                by_segment.setdefault(name, []).append(rel)
+        for name, rels in by_segment.items():
+            with tarfile.open(os.path.join(self.segment_dir, name + ".tar")) as tar:
+                for rel in rels:
+                    path = os.path.join(dest, rel)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, "wb") as f:
+                        f.write(tar.extractfile(rel).read())
+        return sorted(rel for rels in by_segment.values() for rel in rels)
+
+
+def parse_s3(prefix):
+    """s3://bucket/some/path -> ("bucket", "some/path/")"""
+    assert prefix.startswith("s3://"), f"{prefix} is not an s3:// url"
+    bucket, _, key = prefix[len("s3://"):].partition("/")
+    key = key.strip("/")
+    return bucket, key + "/" if key else ""
+
+
+class Puller:
+    """downloads new or changed objects under `prefix` into `local_path`.
+
+    :param prefix: the s3 prefix, e.g. s3://bucket/path
+    :param local_path: the local directory to download into
+    :param workers: number of concurrent downloads
+    :param tail: glob patterns of append-only files, e.g. ("*.log",). Off by default. When such an object grows,
+                 only the new bytes are fetched with a ranged GET and appended to the local copy, after
+                 checking that the last `TAIL_OVERLAP` bytes of the local copy are still in place. A file that
+                 was rewritten is downloaded again.
+    :param unpack_segments: extract the files from newly arrived segment archives into `local_path`.
+    :param client: a boto3 s3 client. Created on first use when None.
+    """
+    MANIFEST = ".jaynes_s3_manifest.json"
+    TAIL_OVERLAP = 4096
+
+    def __init__(self, prefix, local_path, workers=16, tail=(),
+                 unpack_segments=True, client=None):
+        self.bucket, self.key_prefix = parse_s3(prefix)
+        self.local_path = local_path
+        self.workers = workers
+        self.tail = tail
+        self.unpack_segments = unpack_segments
+        self._client = client
+        self.manifest_path = os.path.join(local_path, self.MANIFEST)
+        try:
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            from .cache import boto3_client
+            self._client = boto3_client("s3")
+        return self._client
+
+    def list(self):
+        """returns {rel_path: [etag, size]} for every object under the prefix."""
+        objects = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key_prefix):
+            for obj in page.get("Contents", []):
+                rel = obj["Key"][len(self.key_prefix):]
+                if rel and not rel.endswith("/"):
+                    objects[rel] = [obj["ETag"], obj["Size"]]
+        return objects
+
+    def is_tail(self, rel):
+        from fnmatch import fnmatch
+        return any(fnmatch(os.path.basename(rel), pattern) for pattern in self.tail)
+
+    def download(self, rel, etag, size):
+        key = self.key_prefix + rel
+        local = os.path.join(self.local_path, rel)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+
+        old = self.manifest.get(rel)
+        if not (old and self.is_tail(rel) and size > old[1] and os.path.exists(local)
+                and os.path.getsize(local) == old[1] and self.append(key, local, old[1], size)):
+            tmp_path = f"{local}.jaynes-part"
+            self.client.download_file(self.bucket, key, tmp_path)
+            os.replace(tmp_path, local)
+        self.manifest[rel] = [etag, size]
+
+    def append(self, key, local, start, size):
+        """appends the bytes of the object after `start` to the local copy. Returns False, without writing,
+        when the object does not start with the end of the local copy, i.e. it was rewritten."""
+        overlap = min(start, self.TAIL_OVERLAP)
+        response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start - overlap}-")
+        data = response["Body"].read()
+        with open(local, "rb+") as f:
+            f.seek(start - overlap)
+            if f.read(overlap) != data[:overlap] or len(data) != size - start + overlap:
+                return False
+            f.write(data[overlap:])
+        return True
+
+    def pull(self):
+        """download everything that changed since the last pull. Returns the number of objects fetched."""
+        changed = [(rel, etag, size) for rel, (etag, size) in self.list().items()
+                   if self.manifest.get(rel) != [etag, size]]
+        if not changed:
+            return 0
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                list(pool.map(lambda item: self.download(*item), changed))
+        finally:
+            self.save()
+        if self.unpack_segments:
+            new_segments = [rel[len(SEGMENT_DIR) + 1:-len(".json")] for rel, *_ in changed
+                            if rel.startswith(SEGMENT_DIR + "/") and rel.endswith(".json")]
+            if new_segments:
+                SegmentReader(self.local_path).extract(names=new_segments)
+        return len(changed)
+
+    def save(self):
+        os.makedirs(self.local_path, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def run(self, interval=15):
+        while True:
+            n = self.pull()
+            if n:
+                print(f"downloaded {n} files to {self.local_path}", flush=True)
+            time.sleep(interval)
+
+
+HOST_HEADER = f"""\
+# the push side of jaynes.s3_sync, shipped by the host setup script.
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+METADATA_URL = {METADATA_URL!r}
+SEGMENT_DIR = {SEGMENT_DIR!r}
+"""
+
+
+def host_source():
+    """the source of the push side only. The puller and the segment reader stay out of the setup script,
+    which counts against the 16KB EC2 user data limit."""
+    import inspect
+
+    objects = [scan, priority, aws_cp, SpotNotice, Pusher, push_arguments, push, push_main]
+    return "\n\n".join([HOST_HEADER, *map(inspect.getsource, objects),
+                         'if __name__ == "__main__":\n    push_main()\n'])
+
+
+def host_script(*args, name="jaynes_s3_sync"):
+    """bash snippet that writes the push side onto the host and runs it in the background with the push
+    arguments `args`."""
+    import base64
+    import gzip
+    encoded = base64.b64encode(gzip.compress(host_source().encode())).decode()
+    script_path = f"/tmp/{name}.py"
+    return f"""
+                echo {encoded} | base64 -d | gunzip > {script_path}
+                python3 {script_path} {" ".join(str(a) for a in args)} &"""
+
+
+def push_arguments(parser):
+    parser.add_argument("host_path")
+    parser.add_argument("prefix")
+    parser.add_argument("--interval", type=float, default=15)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--region", default=None)
+    parser.add_argument("--pack-below", type=int, default=None,
+                        help="pack files smaller than this many bytes into segment archives")
+    parser.add_argument("--once", action="store_true", help="flush once and exit")
+    return parser
+
+
+def push(args):
+    os.makedirs(args.host_path, exist_ok=True)
+    pusher = Pusher(args.host_path, args.prefix, workers=args.workers, region=args.region,
+                    pack_below=args.pack_below)
+    if args.once:
+        pusher.flush()
+    else:
+        pusher.run(interval=args.interval)
+
+
+def push_main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="incremental sync of a directory to s3, run on the host")
+    push(push_arguments(parser).parse_args(argv))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="incremental sync between a directory and s3")
+    sub = parser.add_subparsers(dest="command")
+    push_arguments(sub.add_parser("push", help="run on the host, uploads changed files"))
+    pull = sub.add_parser("pull", help="run locally, downloads new or changed objects")
+    pull.add_argument("prefix")
+    pull.add_argument("local_path")
+    pull.add_argument("--interval", type=float, default=15)
+    pull.add_argument("--workers", type=int, default=16)
+    pull.add_argument("--tail", action="append", default=[], help="glob pattern of append-only files")
+    pull.add_argument("--once", action="store_true", help="pull once and exit")
+
+    args = parser.parse_args(argv)
+    if args.command == "push":
+        push(args)
+    elif args.command == "pull":
+        puller = Puller(args.prefix, args.local_path, workers=args.workers, tail=args.tail)
+        if args.once:
+            puller.pull()
+        else:
+            puller.run(interval=args.interval)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
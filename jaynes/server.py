@@ -2,10 +2,11 @@ import os
 import asyncio
 from aiofile import AIOFile, Reader, Writer
 from sanic import Sanic
-from sanic.response import json
-from sanic.response import json
+from sanic.response import json, text
 from params_proto import ParamsProto
 
+from jaynes import uploads
+
 
 # todo use neo_proto to support better logic in
 #  init call
@@ -52,26 +53,18 @@ def interpolate(path: str, envs, is_path=True):
 #  the client controls the process. This makes scripting
 #  easy.
 
-@app.route("/files/<path:path>", methods=["PUT"], stream=True)
-async def upload(request, path):
-    content = b''
-    path = interpolate(path, os.environ)
-    dirname = os.path.dirname(path)
-    os.makedirs(dirname, exist_ok=True)
+@app.route("/files/<path:path>", methods=["HEAD"])
+async def stat(request, path):
+    """resume query, see `jaynes.uploads.stat`."""
+    headers = await uploads.head(interpolate(path, os.environ))
+    return text("", headers=headers)
 
-    print(">>", dirname, path)
 
-    # async with AIOFile(path, 'w+') as afp:
-    while True:
-        body = await request.stream.read()
-        if body is None:
-            break
-        content += body  # .decode('utf-8')
-        # await afp.write(content)
-        # await afp.fsync()
-    with open(path, "wb") as f:
-        f.write(content)
-    return json({"status": 1})
+@app.route("/files/<path:path>", methods=["PUT"], stream=True)
+async def upload(request, path):
+    """streams the body to `path`, or appends a chunk of a resumable upload, see `jaynes.uploads.put`."""
+    status, response = await uploads.put(interpolate(path, os.environ), request.args, request.stream.read)
+    return json(response, status=status)
 
 
 @app.route("/files/<path:path>", methods=["POST"], stream=True)
@@ -91,6 +84,8 @@ async def update(request, path):
         content += body  # .decode('utf-8')
         # await afp.write(content)
         # await afp.fsync()
+    # appends are not hashed, the next stat hashes the file again.
+    uploads.write_sha256(path)
     with open(path, 'wb' if overwrite else 'ab') as f:
         f.write(content)
     return json({"status": 1})
@@ -0,0 +1,128 @@
+"""
+Multiplexed SSH connections.
+
+Every ssh, scp and rsync call to a host pays for its own TCP and SSH handshake, which dominates the launch
+latency to far away hosts. A :class:`ControlMaster` keeps one background master connection per
+(user, host, port, key), and the commands of a launch run as sessions over its socket.
+
+Commands use `ControlMaster=no`, so they fall back to a direct connection when the master is gone, instead
+of becoming a master themselves. A master started by a command would hold on to the stdout of that command
+for `ControlPersist` seconds, and hang callers that read it to the end.
+"""
+import hashlib
+import os
+import shlex
+import subprocess
+import threading
+
+from .helpers import get_home_dir
+
+CONTROL_DIR = os.path.join(get_home_dir(), ".ssh", "jaynes")
+
+
+class ControlMaster:
+    """A background ssh master connection, shared by the commands to one host.
+
+    :param user: the ssh user
+    :param host: the ip address or the host name
+    :param port: the ssh port. Default 22
+    :param pem: path to the private key
+    :param password: log in with sshpass, for the master only. Sessions reuse its authentication.
+    :param persist: seconds the master stays up after its last session ends.
+    :param ssh_options: other options for the master, e.g. "-o StrictHostKeyChecking=no"
+    """
+
+    def __init__(self, user, host, port=None, pem=None, password=None, persist=600, ssh_options=""):
+        self.user, self.host, self.port, self.pem = user, host, port, pem
+        self.password = password
+        self.persist = persist
+        self.ssh_options = ssh_options
+        # unix socket paths are limited to ~100 characters, hence the hash.
+        key = hashlib.sha1(repr((user, host, port, pem)).encode()).hexdigest()[:16]
+        self.control_path = os.path.join(CONTROL_DIR, f"cm-{key}")
+        self.lock = threading.Lock()
+
+    def update(self, password=None, persist=None, ssh_options=""):
+        """adds the options of another caller. They apply the next time the master starts, e.g. after the first
+        caller failed to start it: the options are added to ours, a password is set, the longer persist wins."""
+        with self.lock:
+            if password is not None:
+                self.password = password
+            if persist is not None:
+                self.persist = max(self.persist, persist)
+            ours = _split_options(self.ssh_options)
+            missing = [o for o in _split_options(ssh_options) if o not in ours]
+            if missing:
+                self.ssh_options = " ".join([self.ssh_options, *(shlex.join(o) for o in missing)]).strip()
+
+    @property
+    def options(self):
+        """options for the ssh, scp and rsync -e commands that should run over the master."""
+        return f"-o ControlMaster=no -o ControlPath={self.control_path}"
+
+    @property
+    def target(self):
+        _port = "" if self.port is None else f"-p {self.port} "
+        _pem = "" if self.pem is None else f"-i {self.pem} "
+        return f"{_port}{_pem}{self.user}@{self.host}"
+
+    def start_script(self):
+        """a shell line that starts the master unless it is already up."""
+        start = f"ssh -o ControlMaster=yes -o ControlPath={self.control_path} -o ControlPersist={self.persist} " \
+                f"{self.ssh_options} -N -f {self.target}"
+        if self.password is not None:
+            start = f"sshpass -p '{self.password}' {start}"
+        return f"mkdir -p -m 700 {CONTROL_DIR} && ( {self.check_script()} || {start} ) </dev/null >/dev/null 2>&1"
+
+    def check_script(self):
+        return f"ssh -o ControlPath={self.control_path} -O check {self.target}"
+
+    def start(self, verbose=False):
+        """starts the master. Returns False when it could not connect, and commands then connect directly."""
+        with self.lock:
+            if verbose:
+                print(f"ssh control master for {self.user}@{self.host} at {self.control_path}")
+            return subprocess.call(self.start_script(), shell=True) == 0
+
+    def close(self):
+        subprocess.call(f"ssh -o ControlPath={self.control_path} -O exit {self.target}", shell=True,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# the ssh flags that take an argument.
+_ARGUMENT_FLAGS = set("-b -c -D -E -e -F -I -i -J -L -l -m -O -o -p -Q -R -S -W -w".split())
+
+
+def _split_options(ssh_options):
+    """the ssh options as a list of tuples, e.g. ("-o", "StrictHostKeyChecking=no")."""
+    tokens, options = shlex.split(ssh_options or ""), []
+    while tokens:
+        n = 2 if tokens[0] in _ARGUMENT_FLAGS else 1
+        options.append(tuple(tokens[:n]))
+        tokens = tokens[n:]
+    return options
+
+
+_masters = {}
+_masters_lock = threading.Lock()
+
+
+def get_control_master(user, host, port=None, pem=None, **kwargs):
+    """process-wide ControlMaster, shared by all launches to the same (user, host, port, key). The options of
+    later callers are added to the shared master, see :meth:`ControlMaster.update`."""
+    key = (user, host, port, pem)
+    with _masters_lock:
+        if key not in _masters:
+            _masters[key] = ControlMaster(user, host, port=port, pem=pem, **kwargs)
+        else:
+            _masters[key].update(**kwargs)
+        return _masters[key]
+
+
+def close_all():
+    """closes the masters of this process. They otherwise exit `persist` seconds after their last session."""
+    with _masters_lock:
+        masters = list(_masters.values())
+        _masters.clear()
+    for master in masters:
+        master.close()
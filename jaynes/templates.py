@@ -28,7 +28,8 @@ gce_terminate = lambda delay=30: f"""
 
 
 def ssh_remote_exec(user, ip_address, script_path, port=None, pem=None,
-                    profile=None, password=None, require_password=False, sudo=True, remote_script_dir=None):
+                    profile=None, password=None, require_password=False, sudo=True, remote_script_dir=None,
+                    control=None):
     """
     run script remotely via ssh agent. 
 
@@ -73,11 +74,15 @@ def ssh_remote_exec(user, ip_address, script_path, port=None, pem=None,
 
                 question: what script name does this use?
 
+    :param control: a running `jaynes.ssh_control.ControlMaster`. The commands run as sessions over its
+                    connection instead of opening their own, and reuse its authentication, so they skip sshpass.
     :return:
     """
 
     options = "" if password is None else "-T "
     options += "-o 'StrictHostKeyChecking=no'"
+    control_ = "" if control is None else control.options
+    options += f" {control_}"
 
     port_ = "" if port is None else f"-p {port}"
     pem_ = f'-i {pem}' if pem else ''
@@ -87,12 +92,12 @@ def ssh_remote_exec(user, ip_address, script_path, port=None, pem=None,
         remote_path = pathJoin(remote_script_dir, os.path.basename(script_path))
         # this should be factorized out.
         send_file = f"""ssh {options} {user}@{ip_address} {port_} {pem_} 'mkdir -p {remote_script_dir}'\n""" \
-                    f"""scp {port_.upper()} {pem_} {script_path} {user}@{ip_address}:{remote_script_dir}"""
+                    f"""scp -o 'StrictHostKeyChecking=no' {control_} {port_.upper()} {pem_} {script_path} {user}@{ip_address}:{remote_script_dir}"""
         if profile:
             launch = f'''ssh {options} {user}@{ip_address} {port_} {pem_} "sudo {"-kS " if require_password else ""}su - {profile}; {sudo_} bash {remote_path}"'''
         else:
             launch = f"""ssh {options} {user}@{ip_address} {port_} {pem_} '{sudo_} bash {remote_path}'"""
-        if password is not None:
+        if password is not None and control is None:
             send_file = f"sshpass -p '{password}' {send_file}"
             launch = f"sshpass -p '{password}' {launch}"
         return send_file, launch
@@ -101,6 +106,151 @@ def ssh_remote_exec(user, ip_address, script_path, port=None, pem=None,
             launch = f"""ssh {options} {user}@{ip_address} {port_} {pem_} 'sudo {"-kS " if require_password else ""}su - {profile}; {sudo_} bash -s'"""
         else:
             launch = f"""ssh {options} {user}@{ip_address} {port_} {pem_} '{sudo_} bash -s'"""
-        if password is not None:
+        if password is not None and control is None:
             launch = f"sshpass -p '{password}' {launch}"
         return None, launch
+
+
+def cached_unpack(cache_dir, key, fetch, host_path, link="hardlink"):
+    """
+    content-addressed code cache on the host. The first job to arrive runs `fetch` under a file lock, which
+    should extract the code into `$JAYNES_CACHE_TMP`. Later jobs with the same key skip the download and the
+    extraction, and link the cached tree into their `host_path`.
+
+    :param cache_dir: the cache root on the host, e.g. /var/cache/jaynes
+    :param key: the content hash of the code tree
+    :param fetch: script that downloads and extracts the code into `$JAYNES_CACHE_TMP`
+    :param host_path: where the job expects the code
+    :param link: one of "hardlink", "symlink" or "bind". "hardlink" shares inodes with the cache, so jobs
+                 should not modify their code in place. "bind" requires root. None only fills the cache.
+    """
+    if link is None:
+        link_script = ""
+    elif link == "hardlink":
+        link_script = f"mkdir -p {host_path} && cp -al $JAYNES_CACHE/. {host_path}/"
+    elif link == "symlink":
+        link_script = f"mkdir -p `dirname {host_path}` && rm -rf {host_path} && ln -s $JAYNES_CACHE {host_path}"
+    elif link == "bind":
+        link_script = f"mkdir -p {host_path} && mount --bind $JAYNES_CACHE {host_path}"
+    else:
+        raise NotImplementedError(f"cache link type {link} is not supported")
+
+    # `set -e` does not apply inside an `if` condition, hence the && chain.
+    fetch = " && \\\n            ".join(line.strip() for line in fetch.strip().splitlines() if line.strip())
+    return f"""
+mkdir -p {cache_dir}/code
+JAYNES_CACHE={cache_dir}/code/{key}
+(
+    flock 9
+    if [ -d $JAYNES_CACHE ]; then
+        echo "code cache hit $JAYNES_CACHE"
+    else
+        export JAYNES_CACHE_TMP=$JAYNES_CACHE.tmp-$$
+        mkdir -p $JAYNES_CACHE_TMP
+        if {fetch}; then
+            mv $JAYNES_CACHE_TMP $JAYNES_CACHE
+        else
+            rm -rf $JAYNES_CACHE_TMP
+            echo "jaynes: failed to fetch the code into $JAYNES_CACHE" >&2
+            exit 1
+        fi
+    fi
+) 9>$JAYNES_CACHE.lock || exit 1
+{link_script}
+"""
+
+
+def ranged_get(url, workers=8):
+    """
+    writes the object at `url` to stdout, downloading `workers` byte ranges in parallel with curl. The parts
+    are written out in order as they complete, so the output can be piped straight into `tar -x`. Falls back
+    to a single stream when the server does not report the size.
+
+    Kept to a single line, so that it can be used as a `fetch` step of :func:`cached_unpack`.
+
+    :param url: a presigned https url. It must not contain single quotes.
+    :param workers: the number of concurrent range requests.
+    """
+    return (
+        f"( JAYNES_URL='{url}'; "
+        f"""JAYNES_SIZE=$(curl -sfL -r 0-0 -D - -o /dev/null "$JAYNES_URL" | tr -d '\\r' | """
+        f"""awk -F/ 'tolower($1) ~ /^content-range:/ {{print $2}}'); """
+        f"""if [ -z "$JAYNES_SIZE" ]; then curl -sfL --retry 5 "$JAYNES_URL"; else """
+        f"JAYNES_PARTS=$(mktemp -d); JAYNES_CHUNK=$(( (JAYNES_SIZE + {workers} - 1) / {workers} )); JAYNES_PIDS=(); "
+        f"for i in $(seq 0 {workers - 1}); do "
+        f"JAYNES_START=$(( i * JAYNES_CHUNK )); [ $JAYNES_START -ge $JAYNES_SIZE ] && break; "
+        f"""curl -sfL --retry 5 -r $JAYNES_START-$(( JAYNES_START + JAYNES_CHUNK - 1 )) -o $JAYNES_PARTS/$i "$JAYNES_URL" & """
+        f"JAYNES_PIDS+=($!); done; "
+        f"""for i in "${{!JAYNES_PIDS[@]}}"; do """
+        f"wait ${{JAYNES_PIDS[$i]}} && cat $JAYNES_PARTS/$i && rm $JAYNES_PARTS/$i || exit 1; done; "
+        f"rm -rf $JAYNES_PARTS; fi )"
+    )
+
+
+def bootstrap_stub(fetch, sha256):
+    """
+    a small launch script that downloads the real one, checks its sha256 and runs it. Used in place of launch
+    scripts that are over the size limit of the EC2 user data or the GCE startup-script.
+
+    :param fetch: script that writes the launch script to `$JAYNES_SCRIPT`. Retried up to 5 times.
+    :param sha256: the hex digest of the launch script.
+    """
+    return f"""#!/bin/bash
+JAYNES_SCRIPT=$(mktemp /tmp/jaynes-launch.XXXXXX)
+for i in 1 2 3 4 5; do {fetch} && break; sleep $(( i * 2 )); done
+echo "{sha256}  $JAYNES_SCRIPT" | sha256sum -c --quiet - || {{ echo "jaynes: launch script failed verification" >&2; exit 1; }}
+exec bash $JAYNES_SCRIPT
+"""
+
+
+
+def gzip_base64(script):
+    """the script gzipped and base64 encoded, the way :func:`dispatch_script` embeds it."""
+    import base64
+    import gzip
+    return base64.encodebytes(gzip.compress(script.encode(), mtime=0)).decode()
+
+
+def dispatch_script(select, launch_scripts):
+    """
+    one launch script for several instances, that runs the launch script of this instance. The scripts are
+    embedded gzipped, since they mostly differ by the thunk.
+
+    :param select: script that prints the key of the instance, e.g. its launch index.
+    :param launch_scripts: dictionary of key -> launch script. The keys are case patterns, e.g. instance names.
+    """
+    cases = "".join(f"""'{key}') base64 -d <<'JAYNES_EOF' | gunzip > $JAYNES_SCRIPT
+{gzip_base64(script)}JAYNES_EOF
+;;
+""" for key, script in launch_scripts.items())
+    return f"""#!/bin/bash
+JAYNES_KEY=$({select})
+JAYNES_SCRIPT=$(mktemp /tmp/jaynes-launch.XXXXXX)
+case "$JAYNES_KEY" in
+{cases}*) echo "jaynes: no launch script for '$JAYNES_KEY'" >&2; exit 1;;
+esac
+exec bash $JAYNES_SCRIPT
+"""
+
+
+def launch_index_dispatch(launch_scripts):
+    """
+    the user data of a multi-count EC2 request, that picks the launch script by the `ami-launch-index` of the
+    instance.
+
+    :param launch_scripts: the launch script of each instance, in the order of the launch index.
+    """
+    token = "curl -sf -X PUT http://169.254.169.254/latest/api/token -H 'X-aws-ec2-metadata-token-ttl-seconds: 300'"
+    select = f"""curl -sf -H "X-aws-ec2-metadata-token: $({token})" \\
+http://169.254.169.254/latest/meta-data/ami-launch-index"""
+    return dispatch_script(select, dict(enumerate(launch_scripts)))
+
+
+def instance_name_dispatch(launch_scripts):
+    """
+    the startup-script of a GCE `bulkInsert`, that picks the launch script by the name of the instance.
+
+    :param launch_scripts: dictionary of instance name -> launch script.
+    """
+    select = "curl -sf http://metadata.google.internal/computeMetadata/v1/instance/name -H 'Metadata-Flavor: Google'"
+    return dispatch_script(select, launch_scripts)
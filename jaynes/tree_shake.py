@@ -0,0 +1,220 @@
+"""
+Dependency tree-shaking for code mounts.
+
+Starting from a thunk, finds the modules it needs from inside a project directory: the modules
+cloudpickle pickles by reference (the thunk's own module, and the globals used by functions and
+classes pickled by value), followed by the static imports of those modules. Only these files,
+plus declared data files, are packed into the mount.
+"""
+import ast
+import functools
+import glob
+import os
+import sys
+from types import BuiltinFunctionType, CodeType, FunctionType, MethodType, ModuleType
+
+# cloudpickle pickles objects from these modules by value, so their globals have to be followed.
+BY_VALUE_MODULES = ("__main__",)
+
+
+def _by_value(obj):
+    """mirrors cloudpickle: lambdas, local and `__main__` definitions can not be looked up by name."""
+    return obj.__module__ in BY_VALUE_MODULES or "<lambda>" in obj.__qualname__ or "<locals>" in obj.__qualname__
+
+
+def _code_names(code):
+    """global names used by a code object, including nested functions and comprehensions."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def seed_modules(obj):
+    """names of the modules the pickled `obj` refers to by reference."""
+    modules, seen, stack = set(), set(), [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (str, bytes, int, float, bool, complex)):
+            continue
+        seen.add(id(obj))
+
+        if isinstance(obj, ModuleType):
+            modules.add(obj.__name__)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, functools.partial):
+            stack.extend([obj.func, obj.args, obj.keywords])
+        elif isinstance(obj, MethodType):
+            stack.extend([obj.__func__, obj.__self__])
+        elif isinstance(obj, (staticmethod, classmethod)):
+            stack.append(obj.__func__)
+        elif isinstance(obj, property):
+            stack.extend([obj.fget, obj.fset, obj.fdel])
+        elif isinstance(obj, FunctionType):
+            if not _by_value(obj):
+                modules.add(obj.__module__)
+            else:
+                g, names = obj.__globals__, _code_names(obj.__code__)
+                used = [g[name] for name in names if name in g]
+                used += [cell.cell_contents for cell in obj.__closure__ or () if _has_contents(cell)]
+                stack.extend(used)
+                # like cloudpickle, also import the submodules accessed as attributes, e.g. `os.path`
+                for module in used:
+                    if isinstance(module, ModuleType):
+                        stack.extend(_submodules(module, names))
+                stack.extend([obj.__defaults__, obj.__kwdefaults__])
+        elif isinstance(obj, BuiltinFunctionType):
+            if getattr(obj, "__module__", None):
+                modules.add(obj.__module__)
+        elif isinstance(obj, type):
+            if not _by_value(obj):
+                modules.add(obj.__module__)
+            else:
+                stack.extend(obj.__bases__)
+                stack.extend(vars(obj).values())
+        else:
+            stack.append(type(obj))
+            stack.append(getattr(obj, "__dict__", None))
+    return modules
+
+
+def _submodules(module, names):
+    prefix = module.__name__ + "."
+    return [sub for name, sub in list(sys.modules.items())
+            if name.startswith(prefix) and set(name[len(prefix):].split(".")) <= names]
+
+
+def _has_contents(cell):
+    try:
+        cell.cell_contents
+    except ValueError:
+        return False
+    return True
+
+
+class ModuleFinder:
+    """Resolves module names to source files inside `root`, and follows their static imports.
+
+    :param root: the project directory. Modules outside of it are ignored.
+    :param search_paths: where top-level modules are looked up. Defaults to the entries of `sys.path`
+                         inside `root`, followed by `root` itself.
+
+    The resolved files and the imports of each file are cached, so that a finder kept around for many thunks
+    only parses the files that changed since.
+    """
+
+    def __init__(self, root, search_paths=None):
+        self.root = os.path.realpath(root)
+        if search_paths is None:
+            search_paths = [os.path.realpath(p or os.getcwd()) for p in sys.path]
+            search_paths = [p for p in search_paths if self.contains(p)] + [self.root]
+        self.search_paths = list(dict.fromkeys(search_paths))
+        # module name -> absolute file path, or None when not inside root.
+        self.files = {}
+        # (module name, path) -> (mtime of the file, the module names it imports)
+        self._imports = {}
+
+    def contains(self, path):
+        return path == self.root or path.startswith(self.root + os.sep)
+
+    def resolve(self, name):
+        if name in self.files:
+            return self.files[name]
+        path = None
+        module = sys.modules.get(name)
+        if module is not None and getattr(module, "__file__", None):
+            path = os.path.realpath(module.__file__)
+        elif module is None:
+            parts = name.split(".")
+            for base in self.search_paths:
+                for candidate in (os.path.join(base, *parts) + ".py", os.path.join(base, *parts, "__init__.py")):
+                    if os.path.isfile(candidate):
+                        path = os.path.realpath(candidate)
+                        break
+                if path:
+                    break
+        if path and not (self.contains(path) and path.endswith(".py")):
+            path = None
+        self.files[name] = path
+        return path
+
+    def imports(self, name, path):
+        """module names imported by the source file of module `name`. Cached until the file changes."""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return set()
+        cached = self._imports.get((name, path))
+        if cached is None or cached[0] != mtime:
+            cached = self._imports[name, path] = mtime, self._parse_imports(name, path)
+        return cached[1]
+
+    @staticmethod
+    def _parse_imports(name, path):
+        try:
+            with open(path, "rb") as f:
+                tree = ast.parse(f.read(), filename=path)
+        except (OSError, SyntaxError, ValueError):
+            return set()
+        package = name if os.path.basename(path) == "__init__.py" else name.rpartition(".")[0]
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    parts = package.split(".") if package else []
+                    if node.level - 1 > len(parts):
+                        continue
+                    base = ".".join(parts[:len(parts) - node.level + 1] + ([node.module] if node.module else []))
+                else:
+                    base = node.module
+                if base:
+                    names.add(base)
+                # `from pkg import name` can import the submodule pkg.name
+                names.update(f"{base}.{alias.name}" if base else alias.name for alias in node.names if alias.name != "*")
+        return names
+
+    def find(self, module_names):
+        """the source files of `module_names`, their parent packages and everything they import from `root`.
+
+        :return: a dictionary of module name -> absolute path of the source file.
+        """
+        found, stack = {}, list(module_names)
+        while stack:
+            name = stack.pop()
+            if name in found:
+                continue
+            # importing pkg.mod runs pkg/__init__.py first.
+            stack.extend(".".join(name.split(".")[:i]) for i in range(1, name.count(".") + 1))
+            found[name] = path = self.resolve(name)
+            if path:
+                stack.extend(self.imports(name, path))
+        return {name: path for name, path in found.items() if path}
+
+
+def find_files(root, obj, data_files=None, search_paths=None, finder=None):
+    """relative paths of the files under `root` needed to unpickle and run `obj`.
+
+    :param root: the local directory of the mount.
+    :param obj: the thunk, e.g. (fn, args, kwargs)
+    :param data_files: glob patterns relative to `root` that are always included.
+    :param search_paths: see :class:`ModuleFinder`
+    :param finder: a :class:`ModuleFinder` of `root` to reuse, with its caches.
+    """
+    finder = finder or ModuleFinder(root, search_paths)
+    files = {os.path.relpath(path, finder.root) for path in finder.find(seed_modules(obj)).values()}
+    for pattern in data_files or ():
+        for path in glob.glob(os.path.join(finder.root, pattern), recursive=True):
+            files.add(os.path.relpath(path, finder.root))
+    return sorted(files)
+
+
+def find_modules(root, obj, search_paths=None, finder=None):
+    """names of the modules under `root` needed to unpickle and run `obj`."""
+    return sorted((finder or ModuleFinder(root, search_paths)).find(seed_modules(obj)))
@@ -0,0 +1,160 @@
+"""
+The file side of the resumable upload protocol of the jaynes server, kept free of sanic so that it can be
+tested, and served from a plain http server as well. The HEAD and PUT routes of `jaynes.server` only adapt the
+request to `head` and `put`.
+
+A completed file at `path` has its sha256 in the `path.sha256` sidecar. Partial uploads are appended to
+`path.part`, and only moved into place when the sha256 of the whole file matches.
+"""
+import asyncio
+import hashlib
+import os
+
+from .helpers import hash_file
+
+
+def write_sha256(path, sha256=None):
+    """rewrites the sidecar of `path`. Removes it when `sha256` is None, for writes that are not hashed."""
+    sidecar = path + ".sha256"
+    if sha256 is None:
+        try:
+            os.remove(sidecar)
+        except FileNotFoundError:
+            pass
+        return
+    with open(sidecar, "w") as f:
+        f.write(sha256)
+
+
+def stat(path):
+    """the resume headers of `path`. Blocks on hashing the file when it has no sidecar.
+
+    `X-Jaynes-Offset` is the number of bytes of the partial upload already on disk, `X-Jaynes-Sha256` the
+    hash of the completed file, if there is one.
+    """
+    part_path = path + ".part"
+    headers = {"X-Jaynes-Offset": str(os.path.getsize(part_path) if os.path.exists(part_path) else 0)}
+    if os.path.exists(path):
+        headers["X-Jaynes-Size"] = str(os.path.getsize(path))
+        try:
+            with open(path + ".sha256", "r") as f:
+                headers["X-Jaynes-Sha256"] = f.read().strip()
+        except FileNotFoundError:
+            headers["X-Jaynes-Sha256"] = hash_file(path).hexdigest()
+            write_sha256(path, headers["X-Jaynes-Sha256"])
+    return headers
+
+
+# running sha256 of the partial uploads, keyed by path: (offset, hash). Recomputed from disk after a restart.
+_partial_hashes = {}
+
+
+class PartialUpload:
+    """one chunk of a resumable upload to `path`, appended to `path.part` at `offset`.
+
+    Call :meth:`open`, then :meth:`write` the body as it streams in, then :meth:`close`. Both return
+    (http status, json response).
+
+    :param path: the destination file
+    :param offset: where the chunk goes. Has to match the bytes already received, or be 0 to restart.
+    """
+
+    def __init__(self, path, offset):
+        self.path = path
+        self.part_path = path + ".part"
+        self.offset = offset
+        self.file = None
+        self.running = None
+        self.chunk_hash = hashlib.sha256()
+
+    def open(self):
+        """:return: a 409 with the offset of the server when the offset does not match, else None"""
+        current = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+        if self.offset not in (0, current):
+            return 409, {"status": 0, "error": "offset mismatch", "offset": current}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        known_offset, running = _partial_hashes.get(self.path, (None, None))
+        if self.offset == 0:
+            running = hashlib.sha256()
+        elif known_offset != self.offset:
+            running = hash_file(self.part_path)
+        self.running = running
+        self.file = open(self.part_path, "r+b" if self.offset else "wb")
+        self.file.seek(self.offset)
+        self.file.truncate()
+
+    def write(self, body):
+        self.file.write(body)
+        self.chunk_hash.update(body)
+        self.running.update(body)
+
+    def close(self, chunk_sha256=None, sha256=None):
+        """checks the chunk, and moves the file into place when this is the last chunk, i.e. `sha256` is set."""
+        end = self.file.tell()
+        self.file.close()
+
+        if chunk_sha256 and chunk_sha256 != self.chunk_hash.hexdigest():
+            with open(self.part_path, "r+b") as f:
+                f.truncate(self.offset)
+            _partial_hashes.pop(self.path, None)
+            return 400, {"status": 0, "error": "chunk checksum mismatch", "offset": self.offset}
+        _partial_hashes[self.path] = (end, self.running)
+
+        if sha256 is None:
+            return 200, {"status": 1, "offset": end}
+
+        del _partial_hashes[self.path]
+        if self.running.hexdigest() != sha256:
+            os.remove(self.part_path)
+            return 400, {"status": 0, "error": "file checksum mismatch", "offset": 0}
+        # no stale hash in between.
+        write_sha256(self.path)
+        os.replace(self.part_path, self.path)
+        write_sha256(self.path, sha256)
+        return 200, {"status": 1, "offset": end, "sha256": sha256}
+
+
+async def head(path):
+    """the resume headers of `path`, see `stat`. Hashes off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, stat, path)
+
+
+async def put(path, args, read):
+    """
+    Without an `offset` in `args`, streams the body to `path`.
+
+    Resumable uploads send chunks with `offset=<n>&chunk_sha256=<hex>`, which are appended to `<path>.part`.
+    The offset has to match the bytes already received, or be 0 to restart. The last chunk also carries
+    `sha256=<hex>` of the whole file, and the file is only moved into place if that matches.
+
+    :param args: the query arguments
+    :param read: coroutine function returning the next piece of the body, None at the end.
+    :return: (http status, json response)
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    offset = args.get("offset", None)
+    if offset is None:
+        sha256 = hashlib.sha256()
+        write_sha256(path)
+        with open(path, "wb") as f:
+            while True:
+                body = await read()
+                if body is None:
+                    break
+                f.write(body)
+                sha256.update(body)
+        write_sha256(path, sha256.hexdigest())
+        return 200, {"status": 1}
+
+    partial = PartialUpload(path, int(offset))
+    # resuming after a restart re-hashes the partial file.
+    conflict = await asyncio.get_running_loop().run_in_executor(None, partial.open)
+    if conflict:
+        return conflict
+    while True:
+        body = await read()
+        if body is None:
+            break
+        partial.write(body)
+    return partial.close(args.get("chunk_sha256", None), args.get("sha256", None))
@@ -0,0 +1,38 @@
+import subprocess
+from types import SimpleNamespace
+
+from jaynes.launchers.base_launcher import concurrent_steps, setup_steps
+
+
+def test_failed_setup_step(tmp_path):
+    script = concurrent_steps([("S3Code /tmp/code", "sleep 0.2; touch code"),
+                               ("GSCode /tmp/data", "echo downloading; false; echo extracted"),
+                               ("Docker prefetch", "true")],
+                              on_failure="echo terminating") + "echo launched"
+    out = subprocess.run(["bash", "-c", script], cwd=tmp_path, capture_output=True, text=True)
+    assert out.returncode == 1
+    assert "setup step failed: GSCode /tmp/data" in out.stderr
+    assert out.stderr.count("setup step failed") == 1
+    assert "GSCode /tmp/data finished, exit code 1" in out.stdout
+    assert "terminating" in out.stdout and "launched" not in out.stdout and "extracted" not in out.stdout
+    # the barrier still waits for the other steps.
+    assert (tmp_path / "code").exists()
+
+    ok = subprocess.run(["bash", "-c", concurrent_steps([("a", "true"), ("b", "true")]) + "echo launched"],
+                        capture_output=True, text=True)
+    assert ok.returncode == 0 and "host setup done" in ok.stdout and "launched" in ok.stdout
+
+
+def test_prefetch_after_runner_setup():
+    pull = "docker image inspect ubuntu >/dev/null 2>&1 || docker pull ubuntu"
+    runners = [SimpleNamespace(prefetch_script=pull, setup_script=""),
+               SimpleNamespace(prefetch_script=pull.replace("ubuntu", "private/image"),
+                               setup_script="docker login registry")]
+    script = setup_steps(runners=runners)
+    assert "docker pull ubuntu" in script
+    assert "private/image" not in script
+
+    # a failed pull is not fatal.
+    runners = [SimpleNamespace(prefetch_script="false", setup_script="")]
+    out = subprocess.run(["bash", "-c", setup_steps(runners=runners) + "echo launched"], capture_output=True, text=True)
+    assert out.returncode == 0 and "launched" in out.stdout
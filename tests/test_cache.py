@@ -0,0 +1,33 @@
+import time
+
+from jaynes.cache import DiskCache, client
+
+
+def test_disk_cache(tmp_path, monkeypatch):
+    calls = []
+
+    @DiskCache("lookups", ttl=60, max_entries=2, cache_dir=str(tmp_path))
+    def lookup(family, project="deeplearning"):
+        calls.append(family)
+        return f"{project}/{family}"
+
+    assert lookup("pytorch") == lookup("pytorch") == "deeplearning/pytorch"
+    # a new process reads the same entry from disk.
+    key = (lookup.__qualname__, ("pytorch",), [])
+    assert DiskCache("lookups", cache_dir=str(tmp_path)).get(key) == "deeplearning/pytorch"
+    assert calls == ["pytorch"]
+
+    lookup("tf"), lookup("jax")
+    assert len(list((tmp_path / "lookups").iterdir())) == 2
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    lookup("jax")
+    assert calls == ["pytorch", "tf", "jax", "jax"]
+
+
+def test_client():
+    created = []
+    factory = lambda: created.append(1) or object()
+    assert client("test", factory) is client("test", factory)
+    assert len(created) == 1
@@ -0,0 +1,38 @@
+import yaml
+
+from jaynes.helpers import Deferred, hydrate, materialize
+
+
+def test_deferred_mounts():
+    created = []
+
+    class Mount:
+        def __init__(self, **kwargs):
+            created.append(kwargs)
+
+    class Loader(yaml.SafeLoader):
+        pass
+
+    Loader.add_constructor("!mounts.Mount", hydrate(Mount, dict(user="ge")))
+
+    config = yaml.load("""
+    modes:
+      a:
+        mounts:
+          - !mounts.Mount &code
+            path: /home/{user}/code
+          - !mounts.Mount
+            path: /data
+      b:
+        mounts:
+          - *code
+    """, Loader=Loader)
+
+    assert not created
+    assert isinstance(config["modes"]["a"]["mounts"][0], Deferred)
+
+    mounts = materialize(config["modes"]["b"]["mounts"])
+    assert created == [dict(path="/home/ge/code")]
+    # anchors share the instance
+    assert materialize(config["modes"]["a"]["mounts"])[0] is mounts[0]
+    assert len(created) == 2
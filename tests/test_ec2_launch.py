@@ -0,0 +1,124 @@
+import pytest
+
+from jaynes.launchers import ec2_launch
+
+
+class Throttled(Exception):
+    response = {"Error": {"Code": "RequestLimitExceeded"}}
+
+
+class FakeEC2:
+    def __init__(self, throttle=0):
+        self.calls = []
+        self.tokens = []
+        self.throttle = throttle
+
+    def run_instances(self, MinCount, MaxCount, **kwargs):
+        self.tokens.append(kwargs["ClientToken"])
+        if kwargs["InstanceType"] == "fail":
+            raise RuntimeError("InsufficientInstanceCapacity")
+        if self.throttle:
+            self.throttle -= 1
+            raise Throttled()
+        self.calls.append(dict(count=MaxCount, **kwargs))
+        start = len(self.calls) * 100
+        # not in the order of the launch index.
+        return {"Instances": [{"InstanceId": f"i-{start + i}", "AmiLaunchIndex": i} for i in reversed(range(MaxCount))]}
+
+
+def test_bulk_launch(monkeypatch):
+    client = FakeEC2(throttle=2)
+    monkeypatch.setattr(ec2_launch, "ec2_client", lambda region=None: client)
+    monkeypatch.setattr(ec2_launch.time, "sleep", lambda s: None)
+
+    config = dict(image_id="ami-1", instance_type="c5.large", key_name="k", security_group="sg", name="sweep")
+    launcher = ec2_launch.EC2(**config)
+    launcher.instance_plan.extend([dict(config, launch_script="a"), dict(config, instance_type="p3.2xlarge",
+                                                                         launch_script="b"),
+                                   dict(config, launch_script="a")])
+    monkeypatch.setattr(launcher, "plan_instance", lambda verbose=None: None)
+
+    ids = launcher.execute()
+    # the two plans with the same instance config share one request.
+    assert sorted(c["count"] for c in client.calls) == [1, 2]
+    assert ids[0] != ids[2] and ids[0][:-1] == ids[2][:-1]
+    assert ids[0] < ids[2]
+    assert all(c["TagSpecifications"] == [dict(ResourceType="instance", Tags=[dict(Key="Name", Value="sweep")])]
+               for c in client.calls)
+    assert launcher.instance_plan == []
+
+
+def test_launch_errors(monkeypatch):
+    client = FakeEC2(throttle=1)
+    monkeypatch.setattr(ec2_launch, "ec2_client", lambda region=None: client)
+    monkeypatch.setattr(ec2_launch.time, "sleep", lambda s: None)
+
+    config = dict(image_id="ami-1", instance_type="c5.large", key_name="k", security_group="sg")
+    # one worker, so that the throttled request goes first.
+    launcher = ec2_launch.EC2(**config, launch_workers=1)
+    launcher.instance_plan.extend([dict(config, launch_script="a"), dict(config, instance_type="fail",
+                                                                         launch_script="b")])
+    monkeypatch.setattr(launcher, "plan_instance", lambda verbose=None: None)
+
+    with pytest.raises(RuntimeError, match=r"1 of 2 instances failed to launch, launched: \['i-100'\]"):
+        launcher.execute()
+    # the retry after the throttling reuses the token of the request.
+    assert client.tokens[0] == client.tokens[1] != client.tokens[2]
+
+
+def test_runners_share_a_request(monkeypatch):
+    from jaynes.runners import Simple
+
+    client = FakeEC2()
+    monkeypatch.setattr(ec2_launch, "ec2_client", lambda region=None: client)
+    launcher = ec2_launch.EC2(type="ec2", image_id="ami-1", instance_type="c5.large", key_name="k",
+                              security_group="sg")
+    for lr in [0.1, 0.2]:
+        if launcher.last_runner:
+            launcher.plan_instance()
+        launcher.add_runner(Simple(mounts=[]).build(print, lr=lr))
+
+    assert launcher.execute() == ["i-100", "i-101"]
+    call, = client.calls
+    assert call["count"] == 2 and "ami-launch-index" in call["UserData"]
+
+
+def test_launch_index_dispatch(tmp_path):
+    import subprocess
+    from jaynes.templates import launch_index_dispatch
+
+    script = launch_index_dispatch(["echo first", "echo second"])
+    for index, expected in [(0, "first"), (1, "second")]:
+        # the instance metadata service answers with the launch index.
+        fake_curl = f"curl() {{ echo {index}; }}; export -f curl\n"
+        out = subprocess.run(["bash", "-c", fake_curl + script], capture_output=True, text=True)
+        assert out.returncode == 0 and out.stdout.strip() == expected
+
+    out = subprocess.run(["bash", "-c", "curl() { echo 2; }\n" + script], capture_output=True, text=True)
+    assert out.returncode == 1 and "no launch script" in out.stderr
+
+
+def test_bootstrap_stub(tmp_path):
+    import hashlib
+    import subprocess
+    from jaynes.launchers.base_launcher import stage_launch_script
+    from jaynes.templates import bootstrap_stub
+
+    script = "echo launched\n" * 2000
+    assert stage_launch_script(script[:100], ec2_launch.EC2_USER_DATA_LIMIT) == script[:100]
+    try:
+        stage_launch_script(script, ec2_launch.EC2_USER_DATA_LIMIT)
+        assert False, "oversized scripts need a script_prefix"
+    except ValueError:
+        pass
+
+    (tmp_path / "launch.sh").write_text(script)
+    sha256 = hashlib.sha256(script.encode()).hexdigest()
+    stub = bootstrap_stub(f"cp {tmp_path}/launch.sh $JAYNES_SCRIPT", sha256)
+    assert len(stub) < 1024
+    out = subprocess.run(["bash", "-c", stub], capture_output=True, text=True)
+    assert out.returncode == 0 and out.stdout.count("launched") == 2000
+
+    (tmp_path / "launch.sh").write_text(script + "echo tampered\n")
+    out = subprocess.run(["bash", "-c", stub], capture_output=True, text=True)
+    assert out.returncode != 0 and "tampered" not in out.stdout
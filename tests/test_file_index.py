@@ -0,0 +1,71 @@
+import os
+
+from jaynes.file_index import FileIndex, FileSelection, IgnoreRules
+
+
+def touch(root, *paths):
+    for p in paths:
+        path = os.path.join(root, p)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(p)
+
+
+def test_ignore_rules():
+    rules = IgnoreRules(["*.pkl", "/data/", "checkpoints/", "!keep.pkl", "docs/**/*.png"])
+    assert rules.match("a/b/model.pkl", False)
+    assert rules.match("keep.pkl", False) is False
+    assert rules.match("data", True)
+    assert rules.match("src/data", True) is None
+    assert rules.match("src/checkpoints", True)
+    assert rules.match("src/checkpoints", False) is None
+    assert rules.match("docs/a/b/fig.png", False)
+    assert rules.match("docs/fig.png", False)
+
+
+def test_selection(tmp_path):
+    root = str(tmp_path)
+    touch(root, "main.py", "pkg/__init__.py", "pkg/model.pkl", "data/x.npy", "pkg/sub/.gitignore",
+          "pkg/sub/run.py", "pkg/sub/out.log", "a.egg-info/PKG-INFO", ".git/HEAD")
+    with open(os.path.join(root, ".gitignore"), "w") as f:
+        f.write("data/\n*.pkl\n")
+    with open(os.path.join(root, "pkg/sub/.gitignore"), "w") as f:
+        f.write("*.log\n")
+
+    selection = FileSelection(root, excludes="--exclude='*.egg-info'")
+    assert selection.files() == ["main.py", "pkg/__init__.py", "pkg/sub/run.py"]
+
+    first = selection.tree_hash()
+    assert first == selection.tree_hash()
+    touch(root, "pkg/sub/run.py")
+    with open(os.path.join(root, "pkg/sub/run.py"), "a") as f:
+        f.write("# changed")
+    assert first != selection.tree_hash()
+
+
+def test_index_persistence(tmp_path):
+    root, index_dir = str(tmp_path / "project"), str(tmp_path / "index")
+    touch(root, "a.py", "b.py")
+
+    index = FileIndex(root, index_dir=index_dir)
+    files = index.scan()
+    tree_hash = index.tree_hash(files)
+    index.save()
+
+    reloaded = FileIndex(root, index_dir=index_dir)
+    assert reloaded.entries == index.entries
+    assert reloaded.tree_hash(reloaded.scan()) == tree_hash
+
+
+def test_index_shared_by_selections(tmp_path):
+    root = str(tmp_path)
+    touch(root, "a.py", "b.pkl")
+    index = FileIndex(root, index_dir=None)
+
+    assert index.scan() == ["a.py", "b.pkl"]
+    assert index.scan([IgnoreRules(["*.pkl"])]) == ["a.py"]
+    assert set(index.entries) == {"a.py", "b.pkl"}
+
+    os.remove(os.path.join(root, "b.pkl"))
+    index.scan()
+    assert set(index.entries) == {"a.py"}
@@ -0,0 +1,160 @@
+import pytest
+
+from jaynes.launchers import gcp_launch
+
+
+class HttpError(Exception):
+    def __init__(self, status):
+        self.resp = type("Response", (), {"status": status})()
+
+
+class FakeCompute:
+    def __init__(self, flaky=()):
+        self.batches = []
+        self.flaky = set(flaky)
+
+    def instances(self):
+        return self
+
+    def insert(self, **kwargs):
+        return "insert", kwargs
+
+    def bulkInsert(self, **kwargs):
+        return "bulkInsert", kwargs
+
+    def new_batch_http_request(self):
+        compute, calls = self, []
+
+        class Batch:
+            def add(self, request, callback, request_id):
+                calls.append((request, callback, request_id))
+
+            def execute(self):
+                compute.batches.append([request for request, *_ in calls])
+                for (method, kwargs), callback, request_id in calls:
+                    name = kwargs['body'].get('name')
+                    if name in compute.flaky:
+                        compute.flaky.remove(name)
+                        callback(request_id, None, HttpError(503))
+                    else:
+                        callback(request_id, {'id': f"{method}-{name or len(kwargs['body']['perInstanceProperties'])}"}, None)
+
+        return Batch()
+
+
+def config(name, zone="us-west1-a", instance_type="n1-standard-1"):
+    return dict(project="p", zone=zone, body=dict(name=name, machineType=f"zones/{zone}/machineTypes/{instance_type}"))
+
+
+def test_insert_instances(monkeypatch):
+    compute = FakeCompute(flaky=["c"])
+    monkeypatch.setattr(gcp_launch, "compute_client", lambda: compute)
+    monkeypatch.setattr(gcp_launch.time, "sleep", lambda s: None)
+
+    configs = [config("a"), config("b", instance_type="n1-standard-8"), config("c", zone="us-east1-b"),
+               config("d"), config("e", instance_type="n1-standard-8")]
+    ids = gcp_launch.insert_instances(configs, batch_size=2)
+    assert ids == ["bulkInsert-2", "bulkInsert-2", "insert-c", "bulkInsert-2", "bulkInsert-2"]
+    # three calls in two batches, then the failed insert alone.
+    assert [len(b) for b in compute.batches] in ([2, 1, 1], [1, 2, 1])
+    bulk = next(kwargs for method, kwargs in compute.batches[0] + compute.batches[1] if method == "bulkInsert")
+    assert bulk['body']['instanceProperties']['machineType'] in ("n1-standard-1", "n1-standard-8")
+    assert "name" not in bulk['body']['instanceProperties']
+    # the retry of "c" sends the requestId of its first attempt.
+    first, = [kwargs for method, kwargs in compute.batches[0] + compute.batches[1] if kwargs['body'].get('name') == "c"]
+    (_, retried), = compute.batches[2]
+    assert retried['requestId'] == first['requestId']
+    assert len({kwargs['requestId'] for batch in compute.batches[:2] for _, kwargs in batch}) == 3
+
+
+def test_bulk_insert_startup_scripts(monkeypatch):
+    import subprocess
+
+    compute = FakeCompute()
+    monkeypatch.setattr(gcp_launch, "compute_client", lambda: compute)
+    configs = [gcp_launch.gce_instance_config(f"echo {name}", project_id="p", zone="us-west1-a",
+                                              instance_type="n1-standard-1", image_id="image", name=name,
+                                              tags=dict(sweep="lr"))
+               for name in ["job-a", "job-b"]]
+    assert gcp_launch.insert_instances(configs) == ["bulkInsert-2", "bulkInsert-2"]
+    (method, call), = compute.batches[0]
+    items = call['body']['instanceProperties']['metadata']['items']
+    assert method == "bulkInsert" and [item['key'] for item in items] == ["startup-script", "sweep"]
+
+    # the instance picks its script by its name.
+    for name in ["job-a", "job-b"]:
+        fake_curl = f"curl() {{ echo {name}; }}\n"
+        out = subprocess.run(["bash", "-c", fake_curl + items[0]['value']], capture_output=True, text=True)
+        assert out.returncode == 0 and out.stdout.strip() == name
+
+    # the embedded scripts are kept under the metadata limit.
+    assert gcp_launch.group_configs(configs, limit=100) == [[0], [1]]
+
+
+def test_insert_nothing():
+    assert gcp_launch.insert_instances([]) == []
+    assert gcp_launch.launch_gcp([]) == []
+
+
+class FakePoller:
+    """operations are DONE, and instances RUNNING, after being polled `rounds` times. Polling the `missing`
+    operations fails with a 404."""
+
+    def __init__(self, rounds=2, missing=()):
+        self.rounds = rounds
+        self.missing = set(missing)
+        self.polls = {}
+        self.batches = 0
+
+    def zoneOperations(self):
+        return self
+
+    def instances(self):
+        return self
+
+    def get(self, project, zone, operation=None, instance=None):
+        return operation or instance, "DONE" if operation else "RUNNING"
+
+    def new_batch_http_request(self):
+        poller, calls = self, []
+
+        class Batch:
+            def add(self, request, callback, request_id):
+                calls.append((request, callback, request_id))
+
+            def execute(self):
+                poller.batches += 1
+                for (name, done), callback, request_id in calls:
+                    if name in poller.missing:
+                        callback(request_id, None, HttpError(404))
+                        continue
+                    poller.polls[name] = poller.polls.get(name, 0) + 1
+                    status = done if poller.polls[name] >= poller.rounds else "PENDING"
+                    callback(request_id, {"name": name, "status": status}, None)
+
+        return Batch()
+
+
+def test_wait_for_instances(monkeypatch):
+    compute = FakePoller()
+    monkeypatch.setattr(gcp_launch, "compute_client", lambda: compute)
+    monkeypatch.setattr(gcp_launch.time, "sleep", lambda s: None)
+
+    configs = [config(name) for name in "abc"]
+    results = gcp_launch.wait_for_instances(configs, ["op-1", "op-1", "op-2"])
+    assert sorted(key[-1] for key in results) == ["a", "b", "c", "op-1", "op-2"]
+    # operations and instances are polled together, in one batch per round.
+    assert compute.batches == 4
+
+
+def test_wait_for_missing_operation(monkeypatch):
+    compute = FakePoller(missing=["op-2"])
+    monkeypatch.setattr(gcp_launch, "compute_client", lambda: compute)
+    monkeypatch.setattr(gcp_launch.time, "sleep", lambda s: None)
+
+    configs = [config(name) for name in "ab"]
+    with pytest.raises(Exception, match="1 operations failed") as e:
+        gcp_launch.wait_for_instances(configs, ["op-1", "op-2"])
+    assert "op-2" in str(e.value) and "HttpError" in str(e.value)
+    # the instance of the other operation is still waited for.
+    assert compute.polls == {"op-1": 2, "a": 2}
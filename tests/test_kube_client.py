@@ -0,0 +1,122 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from jaynes.kube_client import KubeClient
+
+
+class FakeAPIServer(BaseHTTPRequestHandler):
+    throttled = set()
+
+    def do_POST(self):
+        job = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        name = job["metadata"]["name"]
+        assert self.headers["Authorization"] == "Bearer secret"
+        assert self.path == f"/apis/batch/v1/namespaces/{job['metadata']['namespace']}/jobs"
+        # every job is rate limited once.
+        if name not in self.throttled:
+            self.throttled.add(name)
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        body = json.dumps(dict(job, metadata=dict(job["metadata"], uid=f"uid-{name}"))).encode()
+        self.send_response(201)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_create_jobs(tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPIServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    kubeconfig = tmp_path / "config"
+    kubeconfig.write_text(json.dumps({
+        "current-context": "lab",
+        "contexts": [{"name": "lab", "context": {"cluster": "c", "user": "u", "namespace": "sweeps"}}],
+        "clusters": [{"name": "c", "cluster": {"server": f"http://127.0.0.1:{server.server_port}"}}],
+        "users": [{"name": "u", "user": {"token": "secret"}}],
+    }))
+    try:
+        client = KubeClient.from_kubeconfig(str(kubeconfig))
+        jobs = [{"apiVersion": "batch/v1", "kind": "Job", "metadata": {"name": f"job-{i}", "namespace": None}}
+                for i in range(20)]
+        created = client.create_jobs(jobs, workers=4)
+        assert created == [dict(name=f"job-{i}", uid=f"uid-job-{i}") for i in range(20)]
+    finally:
+        server.shutdown()
+
+
+class LossyAPIServer(BaseHTTPRequestHandler):
+    """creates the job, but fails the response of the first POST of `lossy` jobs with a 503."""
+    jobs = {}
+    lossy = set()
+
+    def reply(self, status, obj=None):
+        body = json.dumps(obj or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        job = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        name = job["metadata"]["name"]
+        if name in self.jobs:
+            return self.reply(409, {"reason": "AlreadyExists"})
+        self.jobs[name] = dict(job, metadata=dict(job["metadata"], uid=f"uid-{name}"))
+        if name in self.lossy:
+            return self.reply(503)
+        self.reply(201, self.jobs[name])
+
+    def do_GET(self):
+        self.reply(200, self.jobs[self.path.rsplit("/", 1)[-1]])
+
+    def log_message(self, *args):
+        pass
+
+
+def test_create_job_after_lost_response():
+    import pytest
+    import requests
+
+    handler = type("Handler", (LossyAPIServer,), dict(jobs={}, lossy={"job-0"}))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = KubeClient(f"http://127.0.0.1:{server.server_port}", namespace="sweeps")
+        job = {"apiVersion": "batch/v1", "kind": "Job", "metadata": {"name": "job-0"}}
+        # the retry conflicts with the job of the first attempt.
+        assert client.create_job(job) == dict(name="job-0", uid="uid-job-0")
+        # a job of the same name from before is still a conflict.
+        with pytest.raises(requests.HTTPError):
+            client.create_job(job)
+    finally:
+        server.shutdown()
+
+
+def test_kubeconfig_data_files(tmp_path):
+    import base64
+    import os
+    import stat
+
+    data = lambda s: base64.b64encode(s.encode()).decode()
+    kubeconfig = tmp_path / "config"
+    kubeconfig.write_text(json.dumps({
+        "current-context": "a",
+        "contexts": [{"name": "a", "context": {"cluster": "c", "user": "alice"}},
+                     {"name": "b", "context": {"cluster": "c", "user": "bob"}}],
+        "clusters": [{"name": "c",
+                      "cluster": {"server": "https://10.0.0.1", "certificate-authority-data": data("ca")}}],
+        "users": [{"name": name, "user": {"client-certificate-data": data(f"{name} crt"),
+                                          "client-key-data": data(f"{name} key")}} for name in ("alice", "bob")],
+    }))
+    alice = KubeClient.from_kubeconfig(str(kubeconfig), "a").session
+    bob = KubeClient.from_kubeconfig(str(kubeconfig), "b").session
+    assert alice.cert[1] != bob.cert[1]
+    assert open(alice.cert[1]).read() == "alice key" and open(bob.cert[1]).read() == "bob key"
+    for path in (alice.verify, *alice.cert):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
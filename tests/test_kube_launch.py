@@ -0,0 +1,160 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from jaynes.kube_client import KubeClient
+from jaynes.launchers.kube_launch import AdmissionQueue, SweepTracker, job_duration
+
+
+class FakeCluster:
+    """finishes the oldest running job for every event of the watch."""
+
+    def __init__(self, flaky=()):
+        self.running, self.order, self.peak = [], [], 0
+        self.flaky = set(flaky)
+
+    def create_jobs(self, jobs, **_):
+        created = [None if job["metadata"]["name"] in self.flaky else
+                   dict(name=job["metadata"]["name"], uid=f"uid-{job['metadata']['name']}") for job in jobs]
+        self.order += [c["name"] for c in created if c]
+        self.running += [c["uid"] for c in created if c]
+        self.peak = max(self.peak, len(self.running))
+        if None in created:
+            self.flaky.clear()
+            error = RuntimeError("1 of 3 jobs failed")
+            error.created = created
+            raise error
+        return created
+
+    def stream_jobs(self, namespace, label_selector):
+        yield "SYNC", [{"metadata": {"uid": uid}} for uid in self.running]
+        while self.running:
+            uid = self.running.pop(0)
+            status = {"conditions": [{"type": "Complete", "status": "True"}]}
+            yield "MODIFIED", {"metadata": {"uid": uid}, "status": status}
+
+
+def test_admission_queue():
+    cluster = FakeCluster()
+    queue = AdmissionQueue(cluster, "jaynes/sweep=test", max_active=3)
+    for i in range(10):
+        queue.push({"metadata": {"name": f"job-{i}"}}, priority=1 if i in (7, 8) else 0)
+
+    created = queue.run()
+    assert cluster.peak == 3
+    assert cluster.order == ["job-7", "job-8", "job-0", "job-1", "job-2", "job-3", "job-4", "job-5", "job-6", "job-9"]
+    assert [c["name"] for c in created] == cluster.order
+
+
+def test_admission_queue_partial_failure():
+    cluster = FakeCluster(flaky=["job-1"])
+    queue = AdmissionQueue(cluster, "jaynes/sweep=test", max_active=3)
+    for i in range(5):
+        queue.push({"metadata": {"name": f"job-{i}"}})
+
+    with pytest.raises(RuntimeError):
+        queue.run()
+    # the created jobs are recorded, and the failed one is queued again at its place.
+    assert [c["name"] for c in queue.created] == ["job-0", "job-2"]
+    assert [entry[-1]["metadata"]["name"] for entry in sorted(queue.heap)] == ["job-1", "job-3", "job-4"]
+
+    assert [c["name"] for c in queue.run()] == ["job-0", "job-2", "job-1", "job-3", "job-4"]
+    assert cluster.peak == 3
+
+
+def job(name, rv, state=None):
+    status = {"startTime": "2021-06-01T00:00:00Z", "active": 1}
+    if state:
+        status = {"startTime": "2021-06-01T00:00:00Z", "completionTime": "2021-06-01T00:01:30Z",
+                  "conditions": [{"type": state, "status": "True"}]}
+    return {"metadata": {"name": name, "resourceVersion": rv}, "status": status}
+
+
+class FakeWatch(KubeClient):
+    """a watch that drops the connection, and then expires the resourceVersion."""
+
+    def __init__(self):
+        self.lists, self.watches = 0, []
+
+    def list_jobs(self, namespace=None, label_selector=None):
+        self.lists += 1
+        items = [job("a", "1"), job("b", "1")] if self.lists == 1 else [job("a", "5", "Complete"), job("b", "5")]
+        return {"items": items, "metadata": {"resourceVersion": str(self.lists * 4 - 3)}}
+
+    def watch_jobs(self, namespace=None, label_selector=None, resource_version=None, timeout=300):
+        import requests
+
+        self.watches.append(resource_version)
+        if len(self.watches) == 1:
+            yield {"type": "ADDED", "object": job("c", "2")}
+            raise requests.ConnectionError()
+        elif len(self.watches) == 2:
+            yield {"type": "ERROR", "object": {"kind": "Status", "code": 410}}
+        else:
+            yield {"type": "BOOKMARK", "object": {"metadata": {"resourceVersion": "6"}}}
+            yield {"type": "MODIFIED", "object": job("b", "7", "Failed")}
+
+
+def test_sweep_tracker():
+    client = FakeWatch()
+    tracker = SweepTracker(client, "test", expected=2, verbose=False)
+    counts = tracker.run()
+    # resumed after the drop, and listed again after the 410.
+    assert client.watches == ["1", "2", "5"] and client.lists == 2
+    assert counts == dict(succeeded=1, failed=1, running=0, pending=0, deleted=0)
+    assert tracker.durations() == {"a": 90, "b": 90}
+    assert job_duration(job("c", "1"), now=datetime(2021, 6, 1, 0, 0, 10, tzinfo=timezone.utc)) == 10
+
+
+class QuietWatch(KubeClient):
+    """a sweep with one running job, whose watches end without any event."""
+
+    def __init__(self):
+        self.timeouts = []
+
+    def list_jobs(self, namespace=None, label_selector=None):
+        return {"items": [job("a", "1")], "metadata": {"resourceVersion": "1"}}
+
+    def watch_jobs(self, namespace=None, label_selector=None, resource_version=None, timeout=300):
+        import time
+
+        self.timeouts.append(timeout)
+        time.sleep(0.05)
+        yield from ()
+
+
+def test_sweep_tracker_timeout():
+    import time
+
+    client = QuietWatch()
+    start = time.time()
+    counts = SweepTracker(client, "test", expected=1, verbose=False).run(timeout=0.3)
+    assert time.time() - start < 1
+    assert counts["running"] == 1
+    # the watches end by the deadline.
+    assert client.timeouts and max(client.timeouts) == 1
+
+
+def test_deleted_jobs():
+    tracker = SweepTracker(None, "test", expected=3, verbose=False)
+    tracker.update("SYNC", [job("a", "1"), job("b", "1"), job("c", "1")])
+    tracker.update("MODIFIED", job("a", "2", "Complete"))
+    # deleted by ttlSecondsAfterFinished, by hand while running, and after it failed.
+    tracker.update("DELETED", job("a", "3", "Complete"))
+    tracker.update("DELETED", job("b", "3"))
+    tracker.update("MODIFIED", job("c", "4", "Failed"))
+    tracker.update("DELETED", job("c", "5", "Failed"))
+    assert tracker.counts() == dict(succeeded=1, failed=1, running=0, pending=0, deleted=1)
+    assert tracker.done
+
+    # a relist after a 410 does not forget the finished jobs.
+    tracker.update("SYNC", [])
+    assert tracker.counts()["succeeded"] == 1 and tracker.done
+
+    # a sweep with every job deleted before it finished.
+    tracker = SweepTracker(None, "test", expected=2, verbose=False)
+    tracker.update("SYNC", [job("a", "1"), job("b", "1")])
+    tracker.update("DELETED", job("a", "2"))
+    assert not tracker.done
+    tracker.update("DELETED", job("b", "2"))
+    assert tracker.counts()["deleted"] == 2 and tracker.done
@@ -0,0 +1,92 @@
+import pytest
+
+from jaynes import mounts
+from jaynes.jaynes import RUN
+from jaynes.ssh_control import ControlMaster
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    (tmp_path / "code").mkdir()
+    (tmp_path / "code" / "main.py").write_text("print('hello')")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(RUN, "config_root", str(tmp_path))
+    return tmp_path
+
+
+def test_node_cache(project):
+    mount = mounts.S3Code(prefix="s3://bucket/code", local_path="code", name="code", volume="jobs",
+                          node_cache="/var/cache/jaynes")
+    key = mount.code_hash()
+    assert mount.volumes == [{"name": "jaynes-code-cache",
+                              "hostPath": {"path": "/var/cache/jaynes", "type": "DirectoryOrCreate"}}]
+    assert mount.volume_mount == {"name": "jaynes-code-cache", "mountPath": str(project / "code"),
+                                  "subPath": f"code/{key}", "readOnly": True}
+    init = mount.init_container
+    assert init["volumeMounts"] == [{"name": "jaynes-code-cache", "mountPath": "/jaynes-cache"}]
+    assert init["args"][0] == "-c"
+    assert f"JAYNES_CACHE=/jaynes-cache/code/{key}" in init["args"][1]
+    assert "aws s3 cp s3://bucket/code/code.tar" in init["args"][1]
+
+    claim = mounts.S3Code(prefix="s3://bucket/code", local_path="code", name="code", volume="jobs",
+                          node_cache_claim="code-cache")
+    assert claim.volumes == [{"name": "jaynes-code-cache", "persistentVolumeClaim": {"claimName": "code-cache"}}]
+    assert claim.volume_mount["subPath"] == f"code/{key}"
+
+
+def test_file_list_matches_code_hash(project):
+    mount = mounts.S3Code(prefix="s3://bucket/code", local_path="code", name="code", volume="jobs",
+                          node_cache="/var/cache/jaynes")
+    key = mount.code_hash()
+    # added after the cache key was computed, so not packed under it.
+    (project / "code" / "late.py").write_text("")
+    mount.write_file_list()
+    with open(mount.file_list) as f:
+        assert f.read().split("\0") == ["main.py"]
+    assert mount.code_hash() == key
+
+
+def test_rsync_delta(project, monkeypatch):
+    scripts = []
+    monkeypatch.setattr(mounts.Mount, "upload", lambda self, verbose=None: scripts.append(self.local_script))
+    monkeypatch.setattr(ControlMaster, "start", lambda self, verbose=False: True)
+
+    mount = mounts.SSHCode(local_path="code", host_path="/tmp/job-1", rsync=True, gitignore=True)
+    sync_dir = mount.sync_dir
+    assert sync_dir.startswith("/tmp/jaynes-sync/") and sync_dir.split("-")[-2] == "code"
+    assert f"cp -al {sync_dir} /tmp/job-1.tmp-$$" in mount.host_setup
+
+    mount.upload(username="ubuntu", ip="10.0.0.1", pem="~/.ssh/id_rsa")
+    *_, mkdir, rsync = scripts[0].strip().splitlines()
+    assert mkdir.endswith(f"ubuntu@10.0.0.1 mkdir -p {sync_dir}")
+    assert rsync.startswith("rsync -azR --delete --exclude='*__pycache__' ")
+    assert "--filter=':- .gitignore'" in rsync
+    assert "-e 'ssh -o ControlMaster=no -o ControlPath=" in rsync
+    assert rsync.endswith(f"{project / 'code'}/./. ubuntu@10.0.0.1:{sync_dir}/")
+
+    # the sessions reuse the authentication of the master.
+    mount.upload(username="ubuntu", ip="10.0.0.2", password="secret")
+    assert "sshpass" not in scripts[1]
+
+
+def test_rsync_snapshot(project, tmp_path):
+    import subprocess
+
+    # projects with the same directory name get their own sync_dir.
+    (project / "other" / "code").mkdir(parents=True)
+    mount = mounts.SSHCode(local_path="code", rsync=True, sync_dir=str(tmp_path / "sync"))
+    assert mounts.SSHCode(local_path="code", rsync=True).sync_dir != \
+           mounts.SSHCode(local_path="other/code", rsync=True).sync_dir
+
+    (tmp_path / "sync").mkdir()
+    (tmp_path / "sync" / "main.py").write_text("v1")
+    host_path = mount.host_path
+    try:
+        assert subprocess.run(["bash", "-c", mount.host_setup]).returncode == 0
+        # the next sync does not change the code of the running jobs.
+        (tmp_path / "sync" / "main.py").unlink()
+        (tmp_path / "sync" / "main.py").write_text("v2")
+        assert subprocess.run(["bash", "-c", mount.host_setup]).returncode == 0
+        assert open(f"{host_path}/main.py").read() == "v1"
+    finally:
+        subprocess.run(["rm", "-rf", host_path])
@@ -22,6 +22,26 @@ def test_empty():
     assert 1 == thunk(*args, **kwargs), "result should be 1"
     print('test empty input succeeded!')
 
+
+def test_by_value(tmp_path, monkeypatch):
+    import sys
+
+    from jaynes.param_codec import pickle_by_value
+
+    (tmp_path / "local_project.py").write_text("def fn(a):\n    return a * 2\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import local_project
+
+    with pickle_by_value(["local_project"]):
+        code = serialize(local_project.fn, [21])
+
+    # the thunk no longer needs the module to be importable.
+    monkeypatch.delitem(sys.modules, "local_project")
+    (tmp_path / "local_project.py").unlink()
+    thunk, args, kwargs = deserialize(code)
+    assert 42 == thunk(*args, **kwargs)
+
+
 if __name__ == "__main__":
     test()
     test_empty()
@@ -0,0 +1,186 @@
+import os
+
+from jaynes import s3_sync
+
+
+def test_push_only_uploads_changes(tmp_path, monkeypatch):
+    uploaded = []
+    monkeypatch.setattr(s3_sync, "aws_cp", lambda src, dst, region=None: uploaded.append(dst) or True)
+
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "logs" / "metrics.log").write_text("step 1\n")
+    (tmp_path / "checkpoint.pt").write_bytes(b"0" * 4096)
+
+    pusher = s3_sync.Pusher(str(tmp_path), "s3://bucket/run/")
+    assert pusher.flush() == 2
+    # small files are flushed first
+    assert uploaded == ["s3://bucket/run/logs/metrics.log", "s3://bucket/run/checkpoint.pt"]
+
+    uploaded.clear()
+    assert pusher.flush() == 0
+
+    with open(tmp_path / "logs" / "metrics.log", "a") as f:
+        f.write("step 2\n")
+    assert pusher.flush() == 1
+    assert uploaded == ["s3://bucket/run/logs/metrics.log"]
+
+
+def test_host_script(tmp_path):
+    import subprocess
+
+    script = s3_sync.host_script("--help", name="test_s3_sync").replace("/tmp/", f"{tmp_path}/")
+    out = subprocess.check_output(["bash", "-c", script + " wait"])
+    assert b"incremental sync" in out
+    assert os.path.exists(tmp_path / "test_s3_sync.py")
+    # only the push side goes onto the host.
+    assert "class Pusher" in s3_sync.host_source() and "class Puller" not in s3_sync.host_source()
+
+
+def test_host_script_push(tmp_path, monkeypatch):
+    import subprocess
+
+    host, bucket = tmp_path / "host", tmp_path / "bucket"
+    (host / "logs").mkdir(parents=True)
+    (host / "logs" / "a.log").write_text("step 1\n")
+    # a fake aws cli, that copies into the bucket directory.
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "aws").write_text(f"""#!/bin/bash
+dst={bucket}/${{4#s3://bucket/}}
+mkdir -p $(dirname $dst) && cp $3 $dst
+""")
+    (tmp_path / "bin" / "aws").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+
+    script = s3_sync.host_script(str(host), "s3://bucket", "--once", name="test_s3_sync")
+    subprocess.check_call(["bash", "-c", script.replace("/tmp/test_s3_sync", f"{tmp_path}/test_s3_sync") + " wait"])
+    assert (bucket / "logs" / "a.log").read_text() == "step 1\n"
+
+
+class FakeS3:
+    def __init__(self, objects, page_size=2):
+        self.objects = objects
+        self.page_size = page_size
+        self.calls = []
+
+    def get_paginator(self, _):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(k for k in client.objects if k.startswith(Prefix))
+                for i in range(0, len(keys), client.page_size):
+                    yield {"Contents": [dict(Key=k, ETag=str(hash(client.objects[k])), Size=len(client.objects[k]))
+                                        for k in keys[i:i + client.page_size]]}
+
+        return Paginator()
+
+    def download_file(self, bucket, key, path):
+        self.calls.append(("download", key))
+        with open(path, "wb") as f:
+            f.write(self.objects[key])
+
+    def get_object(self, Bucket, Key, Range):
+        import io
+        self.calls.append(("range", Key, Range))
+        start = int(Range[len("bytes="):-1])
+        return {"Body": io.BytesIO(self.objects[Key][start:])}
+
+
+def test_pull_incremental(tmp_path):
+    s3 = FakeS3({"run/a.log": b"line 1\n", "run/b.pkl": b"x", "run/c/d.json": b"{}", "run/m.csv": b"1,2\n"})
+    puller = s3_sync.Puller("s3://bucket/run", str(tmp_path), client=s3, tail=["*.log"])
+    assert puller.pull() == 4
+    assert puller.pull() == 0
+
+    s3.calls.clear()
+    s3.objects["run/a.log"] += b"line 2\n"
+    s3.objects["run/b.pkl"] = b"yy"
+    # not declared append-only.
+    s3.objects["run/m.csv"] = b"1,3\n2,4\n"
+    assert s3_sync.Puller("s3://bucket/run", str(tmp_path), client=s3, tail=["*.log"]).pull() == 3
+    assert sorted(s3.calls) == [("download", "run/b.pkl"), ("download", "run/m.csv"),
+                                ("range", "run/a.log", "bytes=0-")]
+    assert (tmp_path / "a.log").read_bytes() == b"line 1\nline 2\n"
+    assert (tmp_path / "m.csv").read_bytes() == b"1,3\n2,4\n"
+    assert (tmp_path / "c" / "d.json").read_bytes() == b"{}"
+
+
+def test_pull_rewritten_tail(tmp_path, monkeypatch):
+    monkeypatch.setattr(s3_sync.Puller, "TAIL_OVERLAP", 4)
+    s3 = FakeS3({"run/a.log": b"line 1\n"})
+    puller = s3_sync.Puller("s3://bucket/run", str(tmp_path), client=s3, tail=["*.log"])
+    puller.pull()
+
+    # rewritten, and longer: the local copy is replaced instead of appended to.
+    s3.calls.clear()
+    s3.objects["run/a.log"] = b"line 0\nline 3\n"
+    assert puller.pull() == 1
+    assert s3.calls == [("range", "run/a.log", "bytes=3-"), ("download", "run/a.log")]
+    assert (tmp_path / "a.log").read_bytes() == b"line 0\nline 3\n"
+
+
+def test_pack_small_files(tmp_path, monkeypatch):
+    import shutil
+
+    bucket = tmp_path / "bucket"
+
+    def fake_cp(src, dst, region=None):
+        dst = bucket / dst[len("s3://bucket/"):]
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(src, dst)
+        return True
+
+    monkeypatch.setattr(s3_sync, "aws_cp", fake_cp)
+
+    host = tmp_path / "host"
+    (host / "metrics").mkdir(parents=True)
+    for i in range(5):
+        (host / "metrics" / f"{i}.json").write_text(f'{{"step": {i}}}')
+    (host / "checkpoint.pt").write_bytes(b"0" * 4096)
+
+    pusher = s3_sync.Pusher(str(host), "s3://bucket", pack_below=1024)
+    assert pusher.flush() == 6
+    assert (bucket / "checkpoint.pt").exists()
+    assert not (bucket / "metrics").exists()
+
+    # a packed file that grows past the threshold moves out of the segments.
+    (host / "metrics" / "0.json").write_text("0" * 2048)
+    assert pusher.flush() == 1
+
+    reader = s3_sync.SegmentReader(str(bucket))
+    assert reader.list() == ["checkpoint.pt", *(f"metrics/{i}.json" for i in range(5))]
+    assert reader.read("metrics/3.json") == b'{"step": 3}'
+    assert reader.read("metrics/0.json") == b"0" * 2048
+
+    reader.extract(str(tmp_path / "out"))
+    assert (tmp_path / "out" / "metrics" / "4.json").read_text() == '{"step": 4}'
+    assert not (tmp_path / "out" / "metrics" / "0.json").exists()
+
+
+def test_tombstone_after_upload(tmp_path, monkeypatch, capsys):
+    uploaded, fail = [], {"s3://bucket/big.bin"}
+
+    def fake_cp(src, dst, region=None):
+        if dst in fail:
+            fail.discard(dst)
+            raise OSError("connection reset")
+        uploaded.append(dst)
+        return True
+
+    monkeypatch.setattr(s3_sync, "aws_cp", fake_cp)
+    (tmp_path / "big.bin").write_bytes(b"0" * 10)
+    pusher = s3_sync.Pusher(str(tmp_path), "s3://bucket", pack_below=100)
+    assert pusher.flush() == 1
+    assert pusher.packed == {"big.bin"}
+
+    (tmp_path / "big.bin").write_bytes(b"0" * 200)
+    uploaded.clear()
+    assert pusher.flush() == 1
+    assert "connection reset" in capsys.readouterr().err
+    # the failed upload sends no tombstone, and is retried.
+    assert uploaded == [] and pusher.packed == {"big.bin"}
+
+    assert pusher.flush() == 1
+    assert uploaded[0] == "s3://bucket/big.bin"
+    assert uploaded[1].endswith(".json")
+    assert pusher.packed == set()
@@ -0,0 +1,185 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from jaynes.jaynes import Session
+
+
+class FakeMount:
+    per_host = tree_shake = by_value = False
+
+    def __init__(self, name, log, barrier=None, error=None, event=None):
+        self.name, self.log, self.barrier, self.error, self.event = name, log, barrier, error, event
+
+    def upload(self, verbose=None, **host):
+        self.log.append(f"start {self.name}")
+        if self.event:
+            self.event.wait(timeout=5)
+        if self.barrier:
+            # times out unless the other uploads run at the same time.
+            self.barrier.wait(timeout=5)
+        if self.error:
+            raise self.error
+        self.log.append(f"done {self.name}")
+
+
+class FakeLauncher:
+    UPLOAD_PER_HOST = False
+    last_runner = True
+
+    def __init__(self, mounts, log):
+        self.all_mounts, self.log = mounts, log
+
+    def setup_host(self, verbose=None):
+        pass
+
+    def execute(self, verbose=None):
+        self.log.append("launch")
+
+
+def test_concurrent_uploads():
+    log, barrier = [], threading.Barrier(3)
+    mounts = [FakeMount(f"m{i}", log, barrier) for i in range(3)]
+    session = Session()
+    session.launcher = FakeLauncher(mounts, log)
+
+    # a mount of another launch, which this launch does not wait for.
+    other = threading.Event()
+    session.upload_mount([FakeMount("other", [], event=other)])
+
+    session.upload_mount(mounts)
+    session.execute()
+    other.set()
+    # the launch waits for all of its uploads.
+    assert sorted(log[:3]) == ["start m0", "start m1", "start m2"]
+    assert log[-1] == "launch" and sorted(log[3:-1]) == ["done m0", "done m1", "done m2"]
+    # the other upload still runs on the pool.
+    assert session._upload_pool is not None
+    session.wait_for_uploads()
+    assert session._upload_pool is None
+
+
+def test_upload_error():
+    log = []
+    mounts = [FakeMount("ok", log), FakeMount("broken", log, error=OSError("no such bucket"))]
+    session = Session()
+    session.launcher = FakeLauncher(mounts, log)
+
+    session.upload_mount(mounts)
+    with pytest.raises(OSError, match="no such bucket"):
+        session.execute()
+    assert "launch" not in log
+
+
+class ShakenMount(FakeMount):
+    tree_shake = True
+    selection = SimpleNamespace(local_abs="/tmp/project")
+
+    def __init__(self, log):
+        super().__init__("shaken", log)
+        self.files = set()
+
+    def shake(self, fn, *args, **kwargs):
+        new = {f"{fn.__name__}.py"} - self.files
+        self.files |= new
+        return new
+
+
+def test_upload_shaken_mount_again():
+    log = []
+    mount = ShakenMount(log)
+    session = Session()
+    session.launcher = FakeLauncher([mount], log)
+
+    session.upload_mount([mount])
+    session.shake_mounts([mount], print)
+    session.execute()
+    # the same files are already uploaded.
+    session.shake_mounts([mount], print)
+    session.execute()
+    assert log == ["start shaken", "done shaken", "launch", "launch"]
+    # a function with files that were not uploaded yet.
+    session.shake_mounts([mount], len)
+    session.execute()
+    assert log[3:] == ["launch", "start shaken", "done shaken", "launch"]
+
+
+class ByValueMount(FakeMount):
+    by_value, by_value_limit, by_value_fallback = True, 1 << 18, False
+
+    def __init__(self, root, data_files=None):
+        super().__init__("by_value", [])
+        self.selection = SimpleNamespace(local_abs=str(root))
+        self.data_files = data_files
+
+    def local_modules(self, fn, *args, **kwargs):
+        return ["local_project"]
+
+
+def test_build_thunk_by_value(tmp_path, monkeypatch):
+    from jaynes import jaynes as jaynes_module
+    from jaynes.runners import Simple
+
+    (tmp_path / "local_project.py").write_text("def fn(a):\n    return a * 2\n")
+    (tmp_path / "vocab.txt").write_text("a b c")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import local_project
+
+    payloads = []
+    serialize = jaynes_module.serialize
+    monkeypatch.setattr(jaynes_module, "serialize", lambda *a: payloads.append(serialize(*a)) or payloads[-1])
+    session = Session()
+
+    # the measured thunk is the one that is built.
+    mount = ByValueMount(tmp_path)
+    runner = Simple(mounts=[mount])
+    session.build_thunk(runner, runner.build, runner.build_encoded, local_project.fn, 21)
+    assert len(payloads) == 1 and payloads[0] in runner.main_script and not mount.by_value_fallback
+
+    # data files can not be carried by the thunk, so the mount is uploaded.
+    mount = ByValueMount(tmp_path, data_files=["*.txt"])
+    runner = Simple(mounts=[mount])
+    session.build_thunk(runner, runner.build, runner.build_encoded, local_project.fn, 21)
+    assert mount.by_value_fallback and len(payloads) == 1
+
+
+def test_concurrent_sessions(tmp_path):
+    config_path = tmp_path / ".jaynes.yml"
+    config_path.write_text("""
+modes:
+  a:
+    launch: {type: ssh, ip: 10.0.0.1, username: ubuntu}
+    runner: !runners.Simple {envs: "MODE=a"}
+    mounts: []
+  b:
+    launch: {type: ssh, ip: 10.0.0.2, username: ubuntu}
+    runner: !runners.Simple {envs: "MODE=b"}
+    mounts: []
+""")
+    barrier, sessions, errors = threading.Barrier(2), {}, []
+
+    def launch(mode, n):
+        try:
+            session = sessions[mode] = Session()
+            session.config(mode, config_path=str(config_path))
+            barrier.wait(timeout=5)
+            for i in range(n):
+                session.add(print, mode, i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=launch, args=args) for args in [("a", 2), ("b", 3)]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    a, b = sessions["a"], sessions["b"]
+    assert (a.mode, b.mode) == ("a", "b")
+    assert a.launcher is not b.launcher
+    assert (a.launcher.config["ip"], b.launcher.config["ip"]) == ("10.0.0.1", "10.0.0.2")
+    assert (len(a.launcher.runners), len(b.launcher.runners)) == (2, 3)
+    assert all("MODE=a" in r.run_script for r in a.launcher.runners)
+    assert all("MODE=b" in r.run_script for r in b.launcher.runners)
@@ -0,0 +1,40 @@
+from jaynes.ssh_control import get_control_master
+from jaynes.templates import ssh_remote_exec
+
+
+def test_shared_control_master():
+    control = get_control_master("ubuntu", "10.0.0.1", port=2222, pem="~/.ssh/key.pem")
+    assert control is get_control_master("ubuntu", "10.0.0.1", port=2222, pem="~/.ssh/key.pem")
+    assert control is not get_control_master("ubuntu", "10.0.0.1", port=2222)
+    assert len(control.control_path) < 100
+
+    send_file, launch = ssh_remote_exec("ubuntu", "10.0.0.1", "/tmp/launch.sh", port=2222, pem="~/.ssh/key.pem",
+                                        remote_script_dir="/tmp/jaynes", control=control)
+    # every command runs over the master, without becoming a master itself.
+    assert send_file.count(control.options) == 2 and control.options in launch
+    assert "ControlMaster=no" in control.options and "ControlMaster=yes" in control.start_script()
+
+
+def test_sessions_skip_sshpass():
+    control = get_control_master("ubuntu", "10.0.0.3", password="secret")
+    assert control.start_script().count("sshpass -p 'secret'") == 1
+
+    send_file, launch = ssh_remote_exec("ubuntu", "10.0.0.3", "/tmp/launch.sh", password="secret",
+                                        remote_script_dir="/tmp/jaynes", control=control)
+    assert "sshpass" not in send_file + launch
+    # without a master, the commands log in on their own.
+    send_file, launch = ssh_remote_exec("ubuntu", "10.0.0.3", "/tmp/launch.sh", password="secret",
+                                        remote_script_dir="/tmp/jaynes")
+    assert send_file.startswith("sshpass -p 'secret' ") and launch.startswith("sshpass -p 'secret' ")
+
+
+def test_later_options_are_kept():
+    # the mount upload comes first, without the options of the launcher.
+    control = get_control_master("ubuntu", "10.0.0.4", persist=60)
+    assert get_control_master("ubuntu", "10.0.0.4", password="secret", persist=600,
+                              ssh_options="-o StrictHostKeyChecking=no -o 'ConnectTimeout=10'") is control
+    get_control_master("ubuntu", "10.0.0.4", ssh_options="-o StrictHostKeyChecking=no")
+    assert control.ssh_options == "-o StrictHostKeyChecking=no -o ConnectTimeout=10"
+    assert control.password == "secret" and control.persist == 600
+    start = control.start_script()
+    assert "-o StrictHostKeyChecking=no" in start and start.count("sshpass") == 1
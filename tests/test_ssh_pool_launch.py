@@ -0,0 +1,48 @@
+from jaynes.launchers import ssh_pool_launch
+from jaynes.runners import Docker, Simple
+
+PROBE_OUTPUT = """0, 200, 24000, 0
+1, 23000, 24000, 97
+2, 10, 24000, 0
+---
+3.20 2.10 1.00 2/1234 5678
+16
+60000
+"""
+
+
+def test_parse_probe():
+    status = ssh_pool_launch.parse_probe(PROBE_OUTPUT)
+    assert status == dict(gpus=3, free_gpus=[0, 2], load=0.2, cpus=16, mem_free=60000)
+    # hosts without GPUs
+    assert ssh_pool_launch.parse_probe(PROBE_OUTPUT[PROBE_OUTPUT.index("---"):])['gpus'] == 0
+
+
+def test_ssh_pool(monkeypatch):
+    statuses = {"busy": dict(free_gpus=[3], load=0.9, mem_free=1000),
+                "idle": dict(free_gpus=[0, 1, 2, 3], load=0.1, mem_free=1000),
+                "down": None}
+    probes, launches = [], {}
+    probe = staticmethod(lambda ip, **_: probes.append(ip) or statuses[ip])
+    monkeypatch.setattr(ssh_pool_launch.SSHPool, "probe", probe)
+    monkeypatch.setattr(ssh_pool_launch, "make_launch_script", lambda runners, **_: [r.run_script for r in runners])
+    monkeypatch.setattr(ssh_pool_launch, "ssh", lambda script, ip, **_: launches.update({ip: script}))
+    monkeypatch.setattr(ssh_pool_launch, "_probes", {})
+
+    launcher = ssh_pool_launch.SSHPool(hosts=[dict(ip="busy"), dict(ip="idle", max_jobs=3), dict(ip="down")],
+                                       max_jobs=2, gpus_per_job=1, type="ssh_pool")
+    for i in range(4):
+        launcher.add_runner(Simple(mounts=[]).build(print, i))
+    placement = launcher.execute()
+    assert sorted(placement) == ["busy", "idle", "idle", "idle"]
+    assert "export CUDA_VISIBLE_DEVICES=3" in launches["busy"][0]
+    assert [s.split("\n")[1] for s in launches["idle"]] == [f"export CUDA_VISIBLE_DEVICES={i}" for i in range(3)]
+
+    # the cached probes are reused, and the GPUs taken since the probe are not handed out again. Docker runners
+    # get the GPUs in place of their `gpus` option, since the container does not see CUDA_VISIBLE_DEVICES.
+    launcher.add_runner(Docker(image="pytorch", envs="LANG=utf-8", gpus="all", name="job-4", mounts=[])
+                        .build(print, 4))
+    assert launcher.execute() == ["idle"]
+    assert """docker run -i --env LANG=utf-8  --gpus '"device=3"'""" in launches["idle"][0]
+    assert "--gpus=all" not in launches["idle"][0] and "CUDA_VISIBLE_DEVICES" not in launches["idle"][0]
+    assert sorted(probes) == ["busy", "down", "idle"]
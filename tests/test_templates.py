@@ -0,0 +1,77 @@
+import os
+import subprocess
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from jaynes.templates import cached_unpack, ranged_get
+
+
+def run(script):
+    return subprocess.run(["bash", "-c", script], capture_output=True, text=True)
+
+
+def test_cached_unpack(tmp_path):
+    (tmp_path / "code").mkdir()
+    (tmp_path / "code" / "main.py").write_text("print('hello')")
+    tarball = tmp_path / "code.tar.gz"
+    with tarfile.open(tarball, "w:gz") as tar:
+        tar.add(tmp_path / "code", arcname=".")
+    cache_dir = tmp_path / "cache"
+    fetch = f"tar -xzf {tarball} -C $JAYNES_CACHE_TMP"
+
+    miss = run(cached_unpack(cache_dir, "abc", fetch, tmp_path / "job-1"))
+    assert miss.returncode == 0 and "cache hit" not in miss.stdout
+    assert (tmp_path / "job-1" / "main.py").read_text() == "print('hello')"
+
+    os.remove(tarball)
+    hit = run(cached_unpack(cache_dir, "abc", fetch, tmp_path / "job-2"))
+    assert hit.returncode == 0 and "cache hit" in hit.stdout
+    assert (tmp_path / "job-2" / "main.py").read_text() == "print('hello')"
+
+    failed = run(cached_unpack(cache_dir, "def", fetch, tmp_path / "job-3") + "echo launched")
+    assert failed.returncode == 1 and "failed to fetch" in failed.stderr
+    assert "launched" not in failed.stdout
+    assert not (tmp_path / "job-3").exists()
+    assert sorted(os.listdir(cache_dir / "code")) == ["abc", "abc.lock", "def.lock"]
+
+
+class RangeServer(BaseHTTPRequestHandler):
+    """serves `data` with byte range support, like a presigned S3 GET."""
+    data = b""
+    ranges = []
+
+    def do_GET(self):
+        if self.headers.get("Range"):
+            start, end = map(int, self.headers["Range"][len("bytes="):].split("-"))
+            end = min(end, len(self.data) - 1)
+            self.ranges.append((start, end))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(self.data)}")
+            body = self.data[start:end + 1]
+        else:
+            self.send_response(200)
+            body = self.data
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_ranged_get():
+    handler = type("Handler", (RangeServer,), dict(data=os.urandom(100_000), ranges=[]))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/code.tar?X-Amz-Signature=abc&X-Amz-Expires=3600"
+        out = subprocess.run(["bash", "-c", ranged_get(url, workers=4)], capture_output=True)
+        assert out.returncode == 0 and out.stdout == handler.data
+        # the size probe, then 4 parts.
+        assert sorted(handler.ranges) == [(0, 0), (0, 24_999), (25_000, 49_999), (50_000, 74_999), (75_000, 99_999)]
+
+        missing = subprocess.run(["bash", "-c", ranged_get("http://127.0.0.1:1/code.tar")], capture_output=True)
+        assert missing.returncode != 0
+    finally:
+        server.shutdown()
@@ -0,0 +1,73 @@
+import os
+import textwrap
+
+from jaynes.tree_shake import find_files
+
+
+def write(root, path, source=""):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(textwrap.dedent(source))
+
+
+def test_find_files(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    write(root, "proj/__init__.py")
+    write(root, "proj/train.py", """
+        import numbers
+        from . import models
+        from .utils.io import save
+
+        def train(lr):
+            return models.Net(lr), save
+        """)
+    write(root, "proj/models.py", "from proj.utils import config\nclass Net: pass\n")
+    write(root, "proj/utils/__init__.py")
+    write(root, "proj/utils/io.py", "def save(): pass\n")
+    write(root, "proj/utils/config.py")
+    write(root, "proj/unused.py", "import proj.train\n")
+    write(root, "data/vocab.txt", "a b c")
+    write(root, "data/cache.bin")
+    monkeypatch.syspath_prepend(root)
+
+    from proj.train import train
+
+    assert find_files(root, (train, (), {}), data_files=["data/*.txt"]) == [
+        "data/vocab.txt", "proj/__init__.py", "proj/models.py", "proj/train.py",
+        "proj/utils/__init__.py", "proj/utils/config.py", "proj/utils/io.py"]
+
+    # functions pickled by value are followed through the globals they use.
+    from proj import utils
+
+    def thunk():
+        return utils.io.save()
+
+    assert find_files(root, (thunk, (), {})) == ["proj/__init__.py", "proj/utils/__init__.py", "proj/utils/io.py"]
+
+
+def test_finder_cache(tmp_path, monkeypatch):
+    from jaynes.tree_shake import ModuleFinder
+
+    root = str(tmp_path)
+    write(root, "app/__init__.py")
+    write(root, "app/main.py", "from app import util\ndef main(): pass\n")
+    write(root, "app/util.py")
+    write(root, "app/extra.py")
+    monkeypatch.syspath_prepend(root)
+    from app.main import main
+
+    parsed = []
+    parse = ModuleFinder._parse_imports
+    monkeypatch.setattr(ModuleFinder, "_parse_imports", staticmethod(lambda name, path: parsed.append(name)
+                                                                     or parse(name, path)))
+    finder = ModuleFinder(root)
+    for _ in range(3):
+        assert find_files(root, (main, (), {}), finder=finder) == ["app/__init__.py", "app/main.py", "app/util.py"]
+    assert sorted(parsed) == ["app", "app.main", "app.util"]
+
+    # a changed file is parsed again.
+    write(root, "app/main.py", "from app import util, extra\ndef main(): pass\n")
+    os.utime(os.path.join(root, "app/main.py"), ns=(1, 1))
+    assert "app/extra.py" in find_files(root, (main, (), {}), finder=finder)
+    assert sorted(parsed) == ["app", "app.extra", "app.main", "app.main", "app.util"]
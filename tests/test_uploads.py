@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import pytest
+
+from jaynes import client as client_module, uploads
+from jaynes.client import JaynesClient
+
+
+class FileServer(BaseHTTPRequestHandler):
+    """serves `jaynes.uploads.head` and `jaynes.uploads.put`, which the HEAD and PUT routes of `jaynes.server`
+    adapt the sanic request to. `tamper(path, params, body)` can change the body of a chunk, e.g. to corrupt it."""
+    root = None
+    tamper = None
+
+    def target(self):
+        url = urlsplit(self.path)
+        return os.path.join(self.root, unquote(url.path)[len("/files/"):]), dict(parse_qsl(url.query))
+
+    def do_HEAD(self):
+        path, _ = self.target()
+        self.send_response(200)
+        for k, v in asyncio.run(uploads.head(path)).items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def do_PUT(self):
+        path, params = self.target()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.tamper:
+            body = self.tamper(path, params, body)
+        pieces = [body[:1000], body[1000:], None]
+
+        async def read():
+            return pieces.pop(0)
+
+        status, response = asyncio.run(uploads.put(path, params, read))
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(client_module.time, "sleep", lambda _: None)
+    handler = type("Handler", (FileServer,), dict(root=str(tmp_path / "server")))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield handler, JaynesClient(f"http://127.0.0.1:{server.server_port}")
+    server.shutdown()
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path), hashlib.sha256(data).hexdigest()
+
+
+def test_upload_resume(tmp_path, server):
+    handler, client = server
+    file, sha256 = write(tmp_path / "data.bin", os.urandom(10_000))
+    dest = tmp_path / "server" / "out" / "data.bin"
+    lost = []
+
+    # the server lost the first chunk, and answers the second with a 409 and its offset.
+    def lose_chunk(path, params, body):
+        if params["offset"] == "4096" and not lost:
+            lost.append(params["offset"])
+            os.truncate(path + ".part", 0)
+        return body
+
+    handler.tamper = staticmethod(lose_chunk)
+    assert client.upload_file(file, "out/data.bin", chunk_size=4096) == sha256
+    assert lost
+    assert dest.read_bytes() == open(file, "rb").read()
+    assert not os.path.exists(f"{dest}.part")
+    assert client.stat("out/data.bin") == dict(offset=0, sha256=sha256)
+
+
+def test_chunk_checksum_mismatch(tmp_path, server):
+    handler, client = server
+    file, sha256 = write(tmp_path / "data.bin", os.urandom(10_000))
+    corrupted = []
+
+    def corrupt_once(path, params, body):
+        if params["offset"] == "4096" and not corrupted:
+            corrupted.append(params["offset"])
+            return b"x" + body[1:]
+        return body
+
+    handler.tamper = staticmethod(corrupt_once)
+    assert client.upload_file(file, "data.bin", chunk_size=4096) == sha256
+    assert corrupted and (tmp_path / "server" / "data.bin").read_bytes() == open(file, "rb").read()
+
+
+def test_file_checksum_mismatch(tmp_path):
+    path = str(tmp_path / "data.bin")
+    partial = uploads.PartialUpload(path, 0)
+    assert partial.open() is None
+    partial.write(b"abc")
+    status, response = partial.close(hashlib.sha256(b"abc").hexdigest(), sha256=hashlib.sha256(b"abd").hexdigest())
+    assert status == 400 and response["offset"] == 0
+    assert not os.path.exists(path) and not os.path.exists(path + ".part")
+
+
+def test_empty_file(tmp_path, server):
+    _, client = server
+    file, sha256 = write(tmp_path / "empty", b"")
+    assert client.upload_file(file, "empty") == sha256
+    assert (tmp_path / "server" / "empty").read_bytes() == b""
+    assert client.stat("empty")["sha256"] == sha256
+
+
+def test_stale_sidecar(tmp_path, server):
+    _, client = server
+    file, sha256 = write(tmp_path / "data.bin", b"new")
+    (tmp_path / "server").mkdir()
+    (tmp_path / "server" / "data.bin").write_bytes(b"old")
+    uploads.write_sha256(str(tmp_path / "server" / "data.bin"))
+    assert client.stat("data.bin")["sha256"] == hashlib.sha256(b"old").hexdigest()
+    assert client.upload_file(file, "data.bin") == sha256
+    assert client.stat("data.bin")["sha256"] == sha256
+
+
+def test_put_whole_file(tmp_path, server):
+    _, client = server
+    data = os.urandom(3000)
+    r = client.session.put(client.server + "/files/whole.bin", data=data)
+    assert r.status_code == 200 and r.json() == {"status": 1}
+    assert (tmp_path / "server" / "whole.bin").read_bytes() == data
+    assert client.stat("whole.bin")["sha256"] == hashlib.sha256(data).hexdigest()